@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+Benchmarks and load tests for the ShopCart service
+"""
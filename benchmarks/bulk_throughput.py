@@ -0,0 +1,83 @@
+"""
+Bulk Import and Export Benchmark
+
+Measures the rows per second of the bulk import and export against the
+database in DATABASE_URI (a temporary SQLite file by default), and of
+creating the same rows one at a time with ShopCart.create() for reference.
+
+Usage:
+  python -m benchmarks.bulk_throughput --rows 100000
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+
+def measure(function, *args):
+    """ Calls function and returns its result, the seconds taken and the peak memory """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def report(operation, fmt, rows, elapsed, peak=None):
+    """ Prints one result as a JSON line """
+    result = {"operation": operation, "format": fmt, "rows": rows, "rows_per_second": round(rows / elapsed)}
+    if peak is not None:
+        result["peak_mib"] = round(peak / 2**20, 1)
+    print(json.dumps(result))
+
+
+def main():
+    """ Runs the benchmark and prints the results as JSON lines """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--single-rows", type=int, default=2000, help="rows created one at a time")
+    args = parser.parse_args()
+
+    tempdir = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URI", "sqlite:///" + os.path.join(tempdir.name, "bench.db"))
+    # pylint: disable=import-outside-toplevel
+    from service import app, bulk
+    from service.models import ShopCart, db
+
+    db.drop_all()
+    db.create_all()
+    paths = {fmt: os.path.join(tempdir.name, "carts." + fmt) for fmt in bulk.FORMATS}
+    with open(paths["csv"], "w", encoding="utf-8") as source:
+        source.write(",".join(bulk.COLUMNS) + "\n")
+        for index in range(args.rows):
+            source.write("{},{},item {},{},{}\n".format(index // 10, index % 10, index, 1 + index % 5, 9.99))
+
+    # import the CSV, export it as NDJSON, then import that NDJSON again
+    for fmt, export_fmt in (("csv", "ndjson"), ("ndjson", "csv")):
+        ShopCart.query.delete()
+        db.session.commit()
+        with open(paths[fmt], encoding="utf-8") as source:
+            count, elapsed, peak = measure(bulk.import_rows, source, fmt)
+        report("import", fmt, count, elapsed, peak)
+        with open(paths[export_fmt], "w", encoding="utf-8") as output:
+            with app.test_request_context():
+                count, elapsed, peak = measure(bulk.copy_to, output, export_fmt)
+        report("export", export_fmt, count, elapsed, peak)
+
+    ShopCart.query.delete()
+    db.session.commit()
+    start = time.perf_counter()
+    for index in range(args.single_rows):
+        ShopCart(customer_id=index // 10, product_id=index % 10, name="item",
+                 quantity=1, price=9.99).create()
+    report("create one at a time", "orm", args.single_rows, time.perf_counter() - start)
+    db.session.remove()
+    tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
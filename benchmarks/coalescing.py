@@ -0,0 +1,111 @@
+"""
+Request Coalescing Benchmark
+
+Starts gunicorn with one threaded worker on a temporary SQLite file and
+sends bursts of concurrent GET /shopcarts/{customer_id} and
+GET /shopcarts/{customer_id}/items requests for the same customer, the
+pattern of a page whose components load the cart at the same time. The
+burst is run with COALESCE_READS off and on.
+
+Usage:
+  python -m benchmarks.coalescing --burst 32 --rounds 50 --items 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from benchmarks.sqlite_workers import free_port, wait_for
+
+# the server under test only enables the bulk import with an admin key
+ADMIN_KEY = "benchmark"
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def burst(base_url, size, latencies, errors):
+    """ Sends size concurrent reads of the same cart and waits for all of them """
+    start = threading.Barrier(size)
+
+    def read(url):
+        start.wait()
+        began = time.perf_counter()
+        try:
+            urllib.request.urlopen(url, timeout=30).read()
+            latencies.append(time.perf_counter() - began)
+        except OSError:
+            errors.append(url)
+
+    urls = ["{}/shopcarts/1".format(base_url), "{}/shopcarts/1/items".format(base_url)]
+    threads = [threading.Thread(target=read, args=(urls[index % 2],)) for index in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run(coalesce, args):
+    """ Starts gunicorn and measures the bursts """
+    with tempfile.TemporaryDirectory() as tempdir:
+        port = free_port()
+        env = dict(os.environ)
+        env.update({
+            "DATABASE_URI": "sqlite:///" + os.path.join(tempdir, "bench.db"),
+            "COALESCE_READS": "true" if coalesce else "false",
+            "ADMIN_API_KEY": ADMIN_KEY,
+        })
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--workers", "1", "--threads", str(args.burst),
+             "--log-level", "critical", "--bind", "127.0.0.1:{}".format(port), "service:app"],
+            env=env,
+        )
+        try:
+            base_url = "http://127.0.0.1:{}".format(port)
+            wait_for(base_url + "/shopcarts")
+            body = "".join(
+                json.dumps({"customer_id": 1, "product_id": index, "name": "item",
+                            "quantity": 1, "price": 1.5}) + "\n"
+                for index in range(args.items)
+            ).encode()
+            urllib.request.urlopen(urllib.request.Request(
+                base_url + "/admin/shopcarts/import", data=body, method="POST",
+                headers={"Content-Type": "application/x-ndjson", "X-Api-Key": ADMIN_KEY}
+            )).read()
+            latencies, errors = [], []
+            began = time.perf_counter()
+            for _ in range(args.rounds):
+                burst(base_url, args.burst, latencies, errors)
+            elapsed = time.perf_counter() - began
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        "coalesce": coalesce,
+        "requests_per_second": round(len(latencies) / elapsed),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "errors": len(errors),
+    }
+
+
+def main():
+    """ Runs the benchmark with and without coalescing and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--burst", type=int, default=32, help="concurrent reads per burst")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--items", type=int, default=200, help="items in the cart")
+    args = parser.parse_args()
+    for coalesce in (False, True):
+        print(json.dumps(run(coalesce, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Response Compression Benchmark
+
+Starts gunicorn on a temporary SQLite file, loads a large number of cart
+rows and then fetches GET /shopcarts with each Accept-Encoding, reporting
+the bytes on the wire, the time to first byte and the total time.
+
+Usage:
+  python -m benchmarks.compression --rows 20000 --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import http.client
+import urllib.request
+from benchmarks.sqlite_workers import free_port, wait_for
+
+ENCODINGS = ("identity", "gzip", "br")
+# the server under test only enables the bulk import with an admin key
+ADMIN_KEY = "benchmark"
+
+
+def fetch(port, path, encoding):
+    """ Returns the bytes received, the time to first byte and the total time """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    start = time.perf_counter()
+    connection.request("GET", path, headers={"Accept-Encoding": encoding})
+    response = connection.getresponse()
+    first = response.read(1)
+    ttfb = time.perf_counter() - start
+    size = len(first) + len(response.read())
+    elapsed = time.perf_counter() - start
+    applied = response.getheader("Content-Encoding", "identity")
+    connection.close()
+    return size, ttfb, elapsed, applied
+
+
+def seed(base_url, rows):
+    """ Loads rows into the service with one bulk import """
+    body = "".join(
+        json.dumps({"customer_id": index // 10, "product_id": index % 10,
+                    "name": "item {}".format(index), "quantity": 1 + index % 5, "price": 9.99}) + "\n"
+        for index in range(rows)
+    ).encode()
+    request = urllib.request.Request(base_url + "/admin/shopcarts/import", data=body, method="POST",
+                                     headers={"Content-Type": "application/x-ndjson", "X-Api-Key": ADMIN_KEY})
+    urllib.request.urlopen(request, timeout=120).read()
+
+
+def main():
+    """ Runs the benchmark and prints the results as JSON lines """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        port = free_port()
+        env = dict(os.environ)
+        env.update({
+            "DATABASE_URI": "sqlite:///" + os.path.join(tempdir, "bench.db"),
+            "ADMIN_API_KEY": ADMIN_KEY,
+        })
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--workers", "1", "--log-level", "critical",
+             "--bind", "127.0.0.1:{}".format(port), "service:app"],
+            env=env,
+        )
+        try:
+            base_url = "http://127.0.0.1:{}".format(port)
+            wait_for(base_url + "/shopcarts")
+            seed(base_url, args.rows)
+            for encoding in ENCODINGS:
+                results = [fetch(port, "/shopcarts", encoding) for _ in range(args.repeat)]
+                print(json.dumps({
+                    "accept_encoding": encoding,
+                    "content_encoding": results[-1][3],
+                    "rows": args.rows,
+                    "bytes": results[-1][0],
+                    "ttfb_ms": round(min(result[1] for result in results) * 1000, 1),
+                    "total_ms": round(min(result[2] for result in results) * 1000, 1),
+                }))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
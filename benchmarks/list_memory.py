@@ -0,0 +1,98 @@
+"""
+List Memory Benchmark
+
+Measures the peak resident memory of encoding every ShopCart as a JSON
+list, on a temporary SQLite file seeded with --rows items:
+
+* orm: the previous list path, one ShopCart instance, one serialize()
+  dict and one marshalled OrderedDict per row before the JSON encoding
+* rows: ShopCart.rows() and encode_rows(), one CartRow per row
+* export: the NDJSON bulk export, which streams one batch at a time
+
+Every path runs in a fresh process and reports the growth of its peak
+resident memory (VmHWM) over its resident memory before the path ran.
+
+Usage:
+  python -m benchmarks.list_memory --rows 1000000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+PATHS = ("orm", "rows", "export")
+
+
+def memory(field):
+    """ Returns a memory field of /proc/self/status in MiB """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_path(path):
+    """ Encodes every ShopCart with one path and prints its peak memory """
+    # pylint: disable=import-outside-toplevel
+    from flask_restx import marshal
+    from service import app, bulk
+    from service.models import ShopCart
+    from service.routes import create_model, encode_rows
+
+    app.logger.setLevel("CRITICAL")
+    with app.app_context():
+        before = memory("VmRSS")
+        began = time.perf_counter()
+        if path == "orm":
+            results = [shopcart.serialize() for shopcart in ShopCart.all()]
+            size = len(json.dumps(marshal(results, create_model)))
+        elif path == "rows":
+            size = len(encode_rows([ShopCart.rows()]))
+        else:
+            size = sum(len(chunk) for chunk in bulk.export_rows("ndjson"))
+        print(json.dumps({
+            "path": path,
+            "bytes": size,
+            "seconds": round(time.perf_counter() - began, 2),
+            "peak_rss_growth_mib": round(memory("VmHWM") - before, 1),
+        }))
+
+
+def main():
+    """ Seeds the items, then runs every path in its own process """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--path", choices=PATHS, help="runs one path in this process")
+    args = parser.parse_args()
+    if args.path:
+        run_path(args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(tempdir, "bench.db")
+        os.environ.setdefault("TRACING_ENABLED", "false")
+        os.environ.setdefault("WARMUP_ENABLED", "false")
+        # pylint: disable=import-outside-toplevel
+        from service import app
+        from service.models import ShopCart, db, reset_db
+        app.logger.setLevel("CRITICAL")
+        with app.app_context():
+            reset_db()
+            for start in range(0, args.rows, 10000):
+                ShopCart.insert_rows([
+                    {"customer_id": row // 10, "product_id": row % 10, "name": "item {}".format(row % 10),
+                     "quantity": row % 7 + 1, "price": 1.5}
+                    for row in range(start, min(start + 10000, args.rows))
+                ])
+            db.session.commit()
+        for path in PATHS:
+            subprocess.run([sys.executable, "-m", "benchmarks.list_memory", "--path", path], check=True)
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Hot Lookup Benchmark
+
+Measures the CPU time of the lookups behind almost every request,
+ShopCart.find on the composite key, ShopCart.list_by_customer_id and the
+Cart.find of the cart header, on a
+temporary SQLite file. The session is emptied before every lookup, like
+at the start of a request, so the identity map never answers for the
+database.
+
+Usage:
+  python -m benchmarks.lookups --customers 1000 --items 10 --lookups 20000
+
+The "before" numbers of a change come from the same command run in a
+checkout of its parent commit with this file copied in, for example:
+
+  git worktree add /tmp/before <commit>~1
+  cp benchmarks/lookups.py /tmp/before/benchmarks/
+  (cd /tmp/before && python -m benchmarks.lookups --customers 1000 --items 10 --lookups 20000)
+
+Trees older than ShopCart.list_by_customer_id list the items with
+find_by_customer_id(...).all(), which is what the routes ran before.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+
+def measure(name, function, lookups, clear):
+    """ Runs function lookups times and returns the CPU microseconds per call """
+    for _ in range(min(lookups, 500)):
+        clear()
+        function()
+    began = time.process_time()
+    for _ in range(lookups):
+        clear()
+        function()
+    cpu = time.process_time() - began
+    return {"lookup": name, "lookups": lookups, "cpu_us_per_lookup": round(cpu / lookups * 1e6, 1)}
+
+
+def main():
+    """ Seeds carts, measures each lookup and prints the results as JSON lines """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=10, help="items per cart")
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(tempdir, "bench.db")
+        os.environ.setdefault("TRACING_ENABLED", "false")
+        # pylint: disable=import-outside-toplevel
+        from service import app
+        from service.models import Cart, ShopCart, db, reset_db
+        app.logger.setLevel("CRITICAL")
+        with app.app_context():
+            reset_db()
+            ShopCart.insert_rows(
+                {"customer_id": customer_id, "product_id": product_id, "name": "item",
+                 "quantity": 1, "price": 1.5}
+                for customer_id in range(args.customers) for product_id in range(args.items)
+            )
+            db.session.commit()
+            keys = [(random.randrange(args.customers), random.randrange(args.items)) for _ in range(1024)]
+            position = [0]
+
+            def next_key():
+                position[0] = (position[0] + 1) % len(keys)
+                return keys[position[0]]
+
+            list_items = getattr(ShopCart, "list_by_customer_id", None) or (
+                lambda customer_id: ShopCart.find_by_customer_id(customer_id).all()
+            )
+            results = [
+                measure("find", lambda: ShopCart.find(next_key()), args.lookups, db.session.expunge_all),
+                measure("list_by_customer_id", lambda: list_items(next_key()[0]),
+                        args.lookups, db.session.expunge_all),
+                measure("cart_header", lambda: Cart.find(next_key()[0]), args.lookups, db.session.expunge_all),
+            ]
+        for result in results:
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
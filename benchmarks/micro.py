@@ -0,0 +1,537 @@
+"""
+Micro-benchmark Suite
+
+Times the hot paths of the models and every route of service/routes.py
+in-process, against an in-memory SQLite database that is seeded with
+--carts carts of 5 items before each case:
+
+* model cases call ShopCart.serialize, ShopCart.deserialize,
+  check_content_type, ShopCart.find, find_by_customer_id and
+  list_by_customer_id, the lookups start from an empty session
+* route cases send one request through the Flask test client and fail
+  when a response has another status than the one expected, cases that
+  delete or check out rows get carts of their own for every call
+
+Every case is called a few times to warm up, then for --repeat rounds of
+--iterations calls. The minimum, median and mean time of one call over
+the rounds are written as JSON, and compare reads two of these files and
+exits with 1 when the median of a case grew by more than --threshold.
+
+Usage:
+  python -m benchmarks.micro run --output baseline.json
+  python -m benchmarks.micro run --output current.json --filter route
+  python -m benchmarks.micro compare baseline.json current.json --threshold 0.1
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+from datetime import datetime, timezone
+
+ITEMS_PER_CART = 5
+# the customers of the carts a destructive case gets for each of its calls
+FRESH = 100000
+# the routes of the Swagger UI and the static files are not benchmarked
+SKIPPED_ENDPOINTS = ("doc", "root", "specs", "static", "restx_doc.static")
+CASES = {}
+
+
+def case(name, method=None, rule=None):
+    """Registers a case under name
+
+    The decorated factory is called with the number of calls the case will
+    get and an ExitStack that is closed after the case, and returns the
+    function that is timed, which is called with the index of the call.
+
+    Args:
+        name (str): the name of the case in the results
+        method (str): the method of the route the case covers
+        rule (str): the rule of the route the case covers
+    """
+    def register(factory):
+        CASES[name] = (factory, (method, rule) if rule else None)
+        return factory
+    return register
+
+
+def item(customer_id, product_id):
+    """ Returns the values of a ShopCart item """
+    return {"customer_id": customer_id, "product_id": product_id, "name": "item {}".format(product_id),
+            "quantity": 1, "price": 1.5}
+
+
+def seed(customer_ids):
+    """ Inserts a cart of ITEMS_PER_CART items for each customer """
+    # pylint: disable=import-outside-toplevel
+    from service import app
+    from service.models import Cart, ShopCart, db
+    customer_ids = list(customer_ids)
+    with app.app_context():
+        ShopCart.insert_rows(
+            item(customer_id, product_id) for customer_id in customer_ids for product_id in range(ITEMS_PER_CART)
+        )
+        Cart.rebuild(customer_ids)
+        db.session.commit()
+
+
+def request(method, url, expected, **options):
+    """Returns a function that sends a request with the test client
+
+    url is formatted with i, the index of the call, and fresh, the
+    customer of the cart seeded for the call. Options that are callables
+    are called with the index of the call.
+    """
+    # pylint: disable=import-outside-toplevel
+    from service import app
+    client = app.test_client()
+    send = getattr(client, method.lower())
+    if app.config.get("ADMIN_API_KEY"):
+        options.setdefault("headers", {})["X-Api-Key"] = app.config["ADMIN_API_KEY"]
+
+    def call(index):
+        response = send(url.format(i=index, fresh=FRESH + index), **{
+            name: value(index) if callable(value) else value for name, value in options.items()
+        })
+        # read the body, streamed responses only run when they are read
+        response.get_data()
+        response.close()
+        if response.status_code != expected:
+            raise AssertionError("{} {} answered {} instead of {}".format(
+                method, url.format(i=index, fresh=FRESH + index), response.status_code, expected))
+    return call
+
+
+######################################################################
+#  M O D E L   C A S E S
+######################################################################
+@case("model ShopCart.serialize")
+def serialize_case(count, stack):
+    # pylint: disable=unused-argument,import-outside-toplevel
+    from service import app
+    from service.models import ShopCart
+    stack.enter_context(app.app_context())
+    shopcart = ShopCart(**item(1, 1))
+    return lambda index: shopcart.serialize()
+
+
+@case("model ShopCart.deserialize")
+def deserialize_case(count, stack):
+    # pylint: disable=unused-argument,import-outside-toplevel
+    from service import app
+    from service.models import ShopCart
+    stack.enter_context(app.app_context())
+    data = item(1, 1)
+    return lambda index: ShopCart().deserialize(data)
+
+
+@case("model check_content_type")
+def check_content_type_case(count, stack):
+    # pylint: disable=unused-argument,import-outside-toplevel
+    from service import app
+    from service.routes import check_content_type
+    stack.enter_context(app.test_request_context(method="POST", headers={"Content-Type": "application/json"}))
+    return lambda index: check_content_type("application/json")
+
+
+def lookup_case(lookup):
+    """ Returns a factory of a case that calls lookup(index) on an empty session """
+    def factory(count, stack):
+        # pylint: disable=unused-argument,import-outside-toplevel
+        from service import app
+        from service.models import db
+        stack.enter_context(app.app_context())
+
+        def call(index):
+            db.session.remove()
+            lookup(index)
+        return call
+    return factory
+
+
+def _find(index):
+    from service.models import ShopCart  # pylint: disable=import-outside-toplevel
+    ShopCart.find((index % 1000 + 1, index % ITEMS_PER_CART))
+
+
+def _find_by_customer_id(index):
+    from service.models import ShopCart  # pylint: disable=import-outside-toplevel
+    ShopCart.find_by_customer_id(index % 1000 + 1).all()
+
+
+def _list_by_customer_id(index):
+    from service.models import ShopCart  # pylint: disable=import-outside-toplevel
+    ShopCart.list_by_customer_id(index % 1000 + 1)
+
+
+case("model ShopCart.find")(lookup_case(_find))
+case("model ShopCart.find_by_customer_id")(lookup_case(_find_by_customer_id))
+case("model ShopCart.list_by_customer_id")(lookup_case(_list_by_customer_id))
+
+
+######################################################################
+#  R O U T E   C A S E S
+######################################################################
+@case("route GET /", "GET", "/")
+def index_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/", 200)
+
+
+@case("route GET /assets/<filename>", "GET", "/assets/<path:filename>")
+def asset_case(count, stack):
+    # pylint: disable=unused-argument,import-outside-toplevel
+    from service import app, assets
+    # the assets are built in a copy, the static folder of the tree is left alone
+    static_folder = os.path.join(stack.enter_context(tempfile.TemporaryDirectory()), "static")
+    shutil.copytree(app.static_folder, static_folder, ignore=shutil.ignore_patterns(assets.DIST))
+    stack.callback(setattr, app, "static_folder", app.static_folder)
+    app.static_folder = static_folder
+    manifest = assets.build(static_folder, app.config["COMPRESS_MIN_SIZE"])
+    return request("GET", "/assets/" + manifest["js/rest_api.js"], 200, headers={"Accept-Encoding": "gzip"})
+
+
+@case("route GET /health/live", "GET", "/health/live")
+def liveness_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/health/live", 200)
+
+
+@case("route GET /health/ready", "GET", "/health/ready")
+def readiness_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/health/ready", 200)
+
+
+@case("route GET /shopcarts?product_id", "GET", "/shopcarts")
+def list_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts?product_id=3", 200)
+
+
+@case("route GET /shopcarts?limit", "GET", "/shopcarts")
+def list_page_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts?limit=100", 200)
+
+
+@case("route POST /shopcarts", "POST", "/shopcarts")
+def create_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("POST", "/shopcarts", 201, json=lambda index: item(FRESH + index, 1))
+
+
+@case("route GET /shopcarts/<customer_id>", "GET", "/shopcarts/<int:customer_id>")
+def read_cart_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts/7", 200)
+
+
+@case("route DELETE /shopcarts/<customer_id>", "DELETE", "/shopcarts/<int:customer_id>")
+def delete_cart_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("DELETE", "/shopcarts/{fresh}", 204)
+
+
+@case("route GET /shopcarts/<customer_id>/items", "GET", "/shopcarts/<int:customer_id>/items")
+def read_items_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts/7/items", 200)
+
+
+@case("route DELETE /shopcarts/<customer_id>/items", "DELETE", "/shopcarts/<int:customer_id>/items")
+def delete_items_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("DELETE", "/shopcarts/{fresh}/items", 204)
+
+
+@case("route POST /shopcarts/<customer_id>/items", "POST", "/shopcarts/<int:customer_id>/items")
+def create_item_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("POST", "/shopcarts/7/items", 201, json=lambda index: item(7, FRESH + index))
+
+
+@case("route GET /shopcarts/<customer_id>/summary", "GET", "/shopcarts/<int:customer_id>/summary")
+def summary_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts/7/summary", 200)
+
+
+@case("route PUT /shopcarts/<customer_id>/checkout", "PUT", "/shopcarts/<int:customer_id>/checkout")
+def checkout_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("PUT", "/shopcarts/{fresh}/checkout", 200)
+
+
+@case("route PUT /shopcarts/<customer_id>/merge", "PUT", "/shopcarts/<int:customer_id>/merge")
+def merge_case(count, stack):
+    # pylint: disable=unused-argument
+    # every call merges a cart of its own into customer 7
+    seed(range(FRESH, FRESH + count))
+    return request("PUT", "/shopcarts/7/merge?source={fresh}&policy=sum", 200)
+
+
+@case("route GET /shopcarts/<customer_id>/items/<product_id>", "GET",
+      "/shopcarts/<int:customer_id>/items/<int:product_id>")
+def read_item_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/shopcarts/7/items/3", 200)
+
+
+@case("route PUT /shopcarts/<customer_id>/items/<product_id>", "PUT",
+      "/shopcarts/<int:customer_id>/items/<int:product_id>")
+def update_item_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("PUT", "/shopcarts/7/items/3", 200,
+                   json=lambda index: dict(item(7, 3), quantity=index % 10 + 1))
+
+
+@case("route DELETE /shopcarts/<customer_id>/items/<product_id>", "DELETE",
+      "/shopcarts/<int:customer_id>/items/<int:product_id>")
+def delete_item_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("DELETE", "/shopcarts/{fresh}/items/3", 204)
+
+
+@case("route PUT /shopcarts/<customer_id>/items/<product_id>/checkout", "PUT",
+      "/shopcarts/<int:customer_id>/items/<int:product_id>/checkout")
+def checkout_item_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("PUT", "/shopcarts/{fresh}/items/3/checkout", 200)
+
+
+@case("route GET /products/<product_id>/demand", "GET", "/products/<int:product_id>/demand")
+def demand_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/products/3/demand", 200)
+
+
+@case("route DELETE /admin/shopcarts", "DELETE", "/admin/shopcarts")
+def reset_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("DELETE", "/admin/shopcarts", 204)
+
+
+@case("route POST /admin/shopcarts/clear", "POST", "/admin/shopcarts/<any(clear, rebuild):operation>")
+def clear_case(count, stack):
+    # pylint: disable=unused-argument
+    seed(range(FRESH, FRESH + count))
+    return request("POST", "/admin/shopcarts/clear", 200, json=lambda index: {"customer_ids": [FRESH + index]})
+
+
+@case("route POST /admin/shopcarts/rebuild", "POST", "/admin/shopcarts/<any(clear, rebuild):operation>")
+def rebuild_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("POST", "/admin/shopcarts/rebuild", 200,
+                   json=lambda index: {"customer_ids": list(range(index % 100 * 10 + 1, index % 100 * 10 + 11))})
+
+
+@case("route GET /admin/shopcarts/export", "GET", "/admin/shopcarts/export")
+def export_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/admin/shopcarts/export?format=ndjson", 200)
+
+
+@case("route POST /admin/shopcarts/import", "POST", "/admin/shopcarts/import")
+def import_case(count, stack):
+    # pylint: disable=unused-argument
+    def body(index):
+        return "".join(
+            json.dumps(item(FRESH + index, product_id)) + "\n" for product_id in range(ITEMS_PER_CART)
+        )
+    return request("POST", "/admin/shopcarts/import", 201, data=body, content_type="application/x-ndjson")
+
+
+@case("route GET /admin/shopcarts/events", "GET", "/admin/shopcarts/events")
+def events_case(count, stack):
+    # pylint: disable=unused-argument
+    return request("GET", "/admin/shopcarts/events?limit=100", 200)
+
+
+@case("route GET /admin/shopcarts/events/stream", "GET", "/admin/shopcarts/events/stream")
+def stream_case(count, stack):
+    # pylint: disable=unused-argument
+    # STREAM_MAX_SECONDS is 0, the stream ends after its first line
+    return request("GET", "/admin/shopcarts/events/stream", 200)
+
+
+def enable_profiler(stack):
+    """ Returns a profiler installed for the case with an admin key """
+    # pylint: disable=import-outside-toplevel
+    from service import app, profiler
+    profile = profiler.Profiler()
+    stack.callback(app.extensions.__setitem__, "profiler", app.extensions.get("profiler"))
+    stack.callback(app.config.__setitem__, "ADMIN_API_KEY", app.config.get("ADMIN_API_KEY"))
+    stack.callback(profile.stop)
+    app.extensions["profiler"] = profile
+    app.config["ADMIN_API_KEY"] = app.config.get("ADMIN_API_KEY") or "benchmark"
+    return profile
+
+
+@case("route POST /admin/profile", "POST", "/admin/profile")
+def start_profile_case(count, stack):
+    # pylint: disable=unused-argument
+    profile = enable_profiler(stack)
+    start = request("POST", "/admin/profile?seconds=60&memory=false", 202)
+
+    def call(index):
+        start(index)
+        profile.stop()
+    return call
+
+
+@case("route GET /admin/profile", "GET", "/admin/profile")
+def read_profile_case(count, stack):
+    # pylint: disable=unused-argument
+    profile = enable_profiler(stack)
+    profile.start(0.2, memory=False)
+    profile.stop()
+    return request("GET", "/admin/profile", 200)
+
+
+######################################################################
+#  R U N   A N D   C O M P A R E
+######################################################################
+def uncovered_routes(app):
+    """ Returns the routes of the service that no case covers """
+    covered = {route for _, route in CASES.values() if route}
+    return sorted(
+        (method, rule.rule)
+        for rule in app.url_map.iter_rules() if rule.endpoint not in SKIPPED_ENDPOINTS
+        for method in rule.methods - {"HEAD", "OPTIONS"}
+        if (method, rule.rule) not in covered
+    )
+
+
+def measure(name, factory, args):
+    """ Reseeds the database, runs one case and returns its timings """
+    # pylint: disable=import-outside-toplevel
+    from service import app
+    from service.models import reset_db
+    with app.app_context():
+        reset_db()
+    seed(range(1, args.carts + 1))
+    warmup = min(args.iterations, 10)
+    with contextlib.ExitStack() as stack:
+        call = factory(warmup + args.iterations * args.repeat, stack)
+        for index in range(warmup):
+            call(index)
+        rounds = []
+        for first in range(warmup, warmup + args.iterations * args.repeat, args.iterations):
+            began = time.perf_counter()
+            for index in range(first, first + args.iterations):
+                call(index)
+            rounds.append((time.perf_counter() - began) / args.iterations * 1e6)
+    median = statistics.median(rounds)
+    return {
+        "name": name,
+        "min_us": round(min(rounds), 2),
+        "median_us": round(median, 2),
+        "mean_us": round(statistics.mean(rounds), 2),
+        "ops_per_second": round(1e6 / median, 1),
+    }
+
+
+def run(args):
+    """ Runs the cases and writes their results as JSON """
+    os.environ["DATABASE_URI"] = "sqlite://"
+    # the chunks of a fan-out share the single in-memory connection
+    os.environ["FANOUT_WORKERS"] = "1"
+    os.environ["STREAM_MAX_SECONDS"] = "0"
+    # the administrative routes need a key, and the reset route a test environment
+    os.environ.setdefault("ADMIN_API_KEY", "benchmark")
+    os.environ["TESTING"] = "true"
+    os.environ.setdefault("TRACING_ENABLED", "false")
+    os.environ.setdefault("WARMUP_ENABLED", "false")
+    # pylint: disable=import-outside-toplevel
+    import sqlalchemy
+    from service import app
+    app.logger.setLevel("CRITICAL")
+
+    for method, rule in uncovered_routes(app):
+        print("warning: no case covers {} {}".format(method, rule), file=sys.stderr)
+    benchmarks = []
+    for name, (factory, _) in CASES.items():
+        if args.filter and args.filter not in name:
+            continue
+        result = measure(name, factory, args)
+        print(json.dumps(result))
+        benchmarks.append(result)
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "iterations": args.iterations,
+            "repeat": args.repeat,
+            "carts": args.carts,
+        },
+        "benchmarks": benchmarks,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    return 0
+
+
+def compare(args):
+    """ Prints the change of every case and returns 1 when one regressed """
+    def load(path):
+        with open(path, encoding="utf-8") as file:
+            return {result["name"]: result for result in json.load(file)["benchmarks"]}
+
+    base, new = load(args.base), load(args.new)
+    key = args.stat + "_us"
+    regressions = 0
+    for name in list(base) + [name for name in new if name not in base]:
+        if name not in new or name not in base:
+            print(json.dumps({"name": name, "status": "removed" if name not in new else "added"}))
+            continue
+        change = new[name][key] / base[name][key] - 1
+        if change > args.threshold:
+            verdict = "regression"
+            regressions += 1
+        elif change < -args.threshold:
+            verdict = "improvement"
+        else:
+            verdict = "ok"
+        print(json.dumps({"name": name, "base_us": base[name][key], "new_us": new[name][key],
+                          "change": round(change, 3), "status": verdict}))
+    if regressions:
+        print("{} of {} cases regressed by more than {:.0%}".format(regressions, len(base), args.threshold),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def main():
+    """ Runs the suite or compares two of its result files """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the cases and write their results")
+    run_parser.add_argument("--output", default="benchmarks.json", help="the JSON file of the results")
+    run_parser.add_argument("--iterations", type=int, default=200, help="calls per round")
+    run_parser.add_argument("--repeat", type=int, default=5, help="rounds per case")
+    run_parser.add_argument("--carts", type=int, default=1000, help="carts seeded before each case")
+    run_parser.add_argument("--filter", help="only run the cases whose name holds this text")
+    run_parser.set_defaults(function=run)
+    compare_parser = commands.add_parser("compare", help="flag the cases that regressed")
+    compare_parser.add_argument("base", help="the results to compare against")
+    compare_parser.add_argument("new", help="the new results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="the tolerated relative slowdown")
+    compare_parser.add_argument("--stat", choices=("min", "median", "mean"), default="median")
+    compare_parser.set_defaults(function=compare)
+    args = parser.parse_args()
+    sys.exit(args.function(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Product Catalog Benchmark
+
+Compares the layout where every cart item holds the name and price of its
+product with the layout where they are stored once in the product table
+and read through the ProductCache. Each layout is seeded with the same
+--rows items in its own SQLite file, and the benchmark reports:
+
+* the size of each file after VACUUM
+* the p50 and p99 latency of reading the items of one cart as CartRows,
+  with a warm cache and with a cache cleared before every read
+* the time to read every item as CartRows
+
+Usage:
+  python -m benchmarks.product_catalog --rows 1000000 --products 10000
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, create_engine, select
+
+ITEMS_PER_CART = 10
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def define(layout):
+    """ Returns the metadata and tables of a layout """
+    metadata = MetaData()
+    columns = [
+        Column("customer_id", Integer, primary_key=True),
+        Column("product_id", Integer, primary_key=True),
+        Column("quantity", Integer),
+    ]
+    if layout == "denormalized":
+        columns[2:2] = [Column("name", String(128))]
+        columns.append(Column("price", Float))
+    items = Table("shop_cart", metadata, *columns)
+    products = Table(
+        "product", metadata,
+        Column("product_id", Integer, primary_key=True, autoincrement=False),
+        Column("name", String(128)),
+        Column("price", Float),
+    )
+    return metadata, items, products
+
+
+def seed(engine, layout, args):
+    """ Creates the tables of a layout and loads the same items in both """
+    metadata, items, products = define(layout)
+    tables = [items] if layout == "denormalized" else [items, products]
+    metadata.create_all(engine, tables=tables)
+    catalog = {
+        product_id: {"name": "Product {} in the catalog of the store".format(product_id),
+                     "price": round(1 + product_id % 100 * 0.25, 2)}
+        for product_id in range(args.products)
+    }
+    generator = random.Random(0)
+    with engine.begin() as connection:
+        if layout == "normalized":
+            connection.execute(products.insert(), [
+                dict(values, product_id=product_id) for product_id, values in catalog.items()
+            ])
+        batch = []
+        for customer_id in range(args.rows // ITEMS_PER_CART):
+            for product_id in generator.sample(range(args.products), ITEMS_PER_CART):
+                row = {"customer_id": customer_id, "product_id": product_id, "quantity": customer_id % 7 + 1}
+                if layout == "denormalized":
+                    row.update(catalog[product_id])
+                batch.append(row)
+            if len(batch) >= 10000:
+                connection.execute(items.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(items.insert(), batch)
+    with engine.connect() as connection:
+        connection.exec_driver_sql("VACUUM")
+    return items, products
+
+
+def reader(engine, layout, items, products, cache):
+    """ Returns a function that reads CartRows with a statement """
+    from service.models import CartRow  # pylint: disable=import-outside-toplevel
+
+    if layout == "denormalized":
+        def read(statement):
+            with engine.connect() as connection:
+                return [CartRow._make(row) for row in connection.execute(statement)]
+        return read
+
+    def load(connection, product_ids):
+        return {
+            row.product_id: {"name": row.name, "price": row.price}
+            for row in connection.execute(
+                select(products.c.product_id, products.c.name, products.c.price)
+                .where(products.c.product_id.in_(product_ids))
+            )
+        }
+
+    def read(statement):
+        with engine.connect() as connection:
+            rows = connection.execute(statement).all()
+            values = cache.get_many({row.product_id for row in rows}, lambda missing: load(connection, missing))
+        return [
+            CartRow(row.customer_id, row.product_id, values[row.product_id]["name"], row.quantity,
+                    values[row.product_id]["price"])
+            for row in rows
+        ]
+    return read
+
+
+def run(layout, path, args):
+    """ Seeds one layout and measures its size and list latencies """
+    # pylint: disable=import-outside-toplevel
+    from service.catalog import ProductCache
+    from service.models import CartRow
+
+    engine = create_engine("sqlite:///" + path)
+    items, products = seed(engine, layout, args)
+    cache = ProductCache(size=args.products, ttl=3600)
+    read = reader(engine, layout, items, products, cache)
+    columns = [items.c[name] for name in CartRow._fields if name in items.c]
+    carts = args.rows // ITEMS_PER_CART
+    generator = random.Random(1)
+    result = {"layout": layout, "rows": args.rows, "file_mib": round(os.path.getsize(path) / 2 ** 20, 1)}
+
+    for mode in ("warm", "cold"):
+        latencies = []
+        for _ in range(args.reads):
+            if mode == "cold":
+                cache.clear()
+            began = time.perf_counter()
+            read(select(*columns).where(items.c.customer_id == generator.randrange(carts)))
+            latencies.append(time.perf_counter() - began)
+        result["cart_{}_p50_ms".format(mode)] = round(percentile(latencies, 0.5) * 1000, 3)
+        result["cart_{}_p99_ms".format(mode)] = round(percentile(latencies, 0.99) * 1000, 3)
+
+    began = time.perf_counter()
+    count = len(read(select(*columns)))
+    result["full_list_seconds"] = round(time.perf_counter() - began, 2)
+    result["listed"] = count
+    engine.dispose()
+    return result
+
+
+def main():
+    """ Measures both layouts and prints the results as JSON lines """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000, help="cart items")
+    parser.add_argument("--products", type=int, default=10000, help="distinct products")
+    parser.add_argument("--reads", type=int, default=2000, help="cart reads per cache mode")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tempdir:
+        # the service is only imported for its cache and row type
+        os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(tempdir, "service.db")
+        os.environ.setdefault("TRACING_ENABLED", "false")
+        os.environ.setdefault("WARMUP_ENABLED", "false")
+        for layout in ("denormalized", "normalized"):
+            print(json.dumps(run(layout, os.path.join(tempdir, layout + ".db"), args)))
+
+
+if __name__ == "__main__":
+    main()
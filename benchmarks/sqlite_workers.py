@@ -0,0 +1,112 @@
+"""
+SQLite Throughput Benchmark
+
+Compares the tuned SQLite profile against the plain driver defaults by
+running gunicorn with several workers on a SQLite file and driving a mix of
+cart writes and reads at it from many client threads.
+
+Usage:
+  python -m benchmarks.sqlite_workers --workers 4 --clients 16 --seconds 10
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+
+def free_port():
+    """ Returns a TCP port that nothing is listening on """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    """ Waits until the service answers on url """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Service did not start on " + url)
+
+
+def client(base_url, client_id, deadline, results):
+    """Adds items to a cart and reads the cart back until the deadline"""
+    ok, errors, product_id = 0, 0, 0
+    while time.time() < deadline:
+        product_id += 1
+        body = json.dumps({"customer_id": client_id, "product_id": product_id,
+                           "name": "item", "quantity": 1, "price": 1.0}).encode()
+        requests = [
+            urllib.request.Request(
+                "{}/shopcarts/{}/items".format(base_url, client_id), data=body,
+                headers={"Content-Type": "application/json"}, method="POST"
+            ),
+            urllib.request.Request("{}/shopcarts/{}".format(base_url, client_id)),
+        ]
+        for req in requests:
+            try:
+                urllib.request.urlopen(req, timeout=30).read()
+                ok += 1
+            except OSError:
+                errors += 1
+    results.append((ok, errors))
+
+
+def run(profile, args):
+    """ Starts gunicorn with the profile and measures its throughput """
+    with tempfile.TemporaryDirectory() as tempdir:
+        port = free_port()
+        env = dict(os.environ)
+        env.update({
+            "DATABASE_URI": "sqlite:///" + os.path.join(tempdir, "bench.db"),
+            "SQLITE_PROFILE": profile,
+        })
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--workers", str(args.workers),
+             "--log-level", "critical", "--bind", "127.0.0.1:{}".format(port), "service:app"],
+            env=env,
+        )
+        try:
+            base_url = "http://127.0.0.1:{}".format(port)
+            wait_for(base_url + "/shopcarts")
+            results = []
+            deadline = time.time() + args.seconds
+            threads = [
+                threading.Thread(target=client, args=(base_url, client_id + 1, deadline, results))
+                for client_id in range(args.clients)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+    ok = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return {"profile": profile, "requests_per_second": ok / args.seconds, "errors": errors}
+
+
+def main():
+    """ Runs the benchmark for both profiles and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=int, default=10)
+    args = parser.parse_args()
+    for profile in ("default", "tuned"):
+        print(json.dumps(run(profile, args)))
+
+
+if __name__ == "__main__":
+    main()
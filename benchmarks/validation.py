@@ -0,0 +1,65 @@
+"""
+Payload Validation Benchmark
+
+Measures the cost per payload of validating a ShopCart body with the
+precompiled validator against the previous path, which checked the body
+with the Flask-RESTX model schema and then converted it in
+ShopCart.deserialize() with exceptions for bad data.
+
+Usage:
+  python -m benchmarks.validation --iterations 100000
+"""
+import json
+import argparse
+import timeit
+
+VALID = {"customer_id": 1, "product_id": 2, "name": "item", "quantity": 3, "price": 4.5}
+INVALID = {"customer_id": "one", "product_id": 2, "name": "item", "price": 4.5}
+
+
+def report(path, payload, iterations, elapsed):
+    """ Prints one result as a JSON line """
+    print(json.dumps({
+        "path": path, "payload": payload, "iterations": iterations,
+        "microseconds_per_payload": round(elapsed / iterations * 1e6, 2),
+    }))
+
+
+def main():
+    """ Runs the benchmark and prints the results as JSON lines """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    from service import validation
+    from service.models import DataValidationError
+    from service.routes import create_model
+
+    def previous(data):
+        try:
+            create_model.validate(data)
+        except Exception:  # pylint: disable=broad-except
+            return None
+        try:
+            return {
+                "customer_id": int(data["customer_id"]),
+                "product_id": int(data["product_id"]),
+                "name": data["name"],
+                "quantity": int(data["quantity"]),
+                "price": float(data["price"]),
+            }
+        except (KeyError, TypeError, ValueError) as error:
+            try:
+                raise DataValidationError("Invalid ShopCart: {}".format(error))
+            except DataValidationError:
+                return None
+
+    for name, payload in (("valid", VALID), ("invalid", INVALID)):
+        for path, function in (("previous", previous), ("precompiled", validation.shopcart.validate)):
+            elapsed = timeit.timeit(lambda: function(payload), number=args.iterations)  # pylint: disable=cell-var-from-loop
+            report(path, name, args.iterations, elapsed)
+
+
+if __name__ == "__main__":
+    main()
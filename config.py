@@ -18,3 +18,113 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Request tracing
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() in ("true", "1", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "memory")  # memory or file
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.ndjson")
+TRACE_MEMORY_SPANS = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))  # spans the memory exporter keeps
+
+# Abandoned cart expiry
+CART_TTL_SECONDS = int(os.getenv("CART_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+CART_PURGE_INTERVAL = int(os.getenv("CART_PURGE_INTERVAL", "0"))  # seconds, 0 disables the job
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+
+# Archival of checked out items
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "0"))  # seconds, 0 disables the job
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+
+# Partitioning and sharding by customer_id
+SHOPCART_PARTITIONS = int(os.getenv("SHOPCART_PARTITIONS", "0"))  # PostgreSQL hash partitions
+SHARD_DATABASE_URIS = [
+    uri.strip() for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri.strip()
+]
+
+# Read replicas for GET requests
+REPLICA_DATABASE_URIS = [
+    uri.strip() for uri in os.getenv("REPLICA_DATABASE_URIS", "").split(",") if uri.strip()
+]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+REPLICA_STICKY_MAX = int(os.getenv("REPLICA_STICKY_MAX", "100000"))  # customers remembered per worker
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+
+# SQLite profile, used when DATABASE_URI is a sqlite:// URI
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "tuned")  # tuned or default
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # milliseconds
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))  # negative is KiB
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))  # 0 opens a connection per checkout
+
+# Administrative endpoints require this value in the X-Api-Key header, they are disabled when it is unset
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+# Test environments, DELETE /admin/shopcarts only resets the database when it is set
+TESTING = os.getenv("TESTING", "false").lower() in ("true", "1", "yes")
+
+# Rate limiting per client address and per customer_id
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() in ("true", "1", "yes")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory or redis
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+CUSTOMER_RATE_LIMIT = float(os.getenv("CUSTOMER_RATE_LIMIT", "10"))  # requests per second
+CUSTOMER_RATE_BURST = float(os.getenv("CUSTOMER_RATE_BURST", "20"))
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "50"))  # requests per second
+CLIENT_RATE_BURST = float(os.getenv("CLIENT_RATE_BURST", "100"))
+RATE_LIMIT_LIST_COST = float(os.getenv("RATE_LIMIT_LIST_COST", "10"))  # tokens for GET /shopcarts
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))  # proxies that set X-Forwarded-For
+
+# Load shedding, 0 disables the concurrency limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "0"))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "0"))  # seconds to wait for a slot
+
+# Response compression, brotli is used when the brotli package is installed
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() in ("true", "1", "yes")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))  # bytes
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Concurrent identical cart reads share one query
+COALESCE_READS = os.getenv("COALESCE_READS", "true").lower() in ("true", "1", "yes")
+
+# Change feed of the cart_event outbox
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", "100"))
+FEED_MAX_WAIT = float(os.getenv("FEED_MAX_WAIT", "30"))  # seconds a long poll may wait
+FEED_POLL_INTERVAL = float(os.getenv("FEED_POLL_INTERVAL", "0.5"))
+FEED_SETTLE_SECONDS = float(os.getenv("FEED_SETTLE_SECONDS", "1"))  # not used on PostgreSQL
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_MAX_SECONDS = float(os.getenv("STREAM_MAX_SECONDS", "300"))
+EVENT_RETENTION_SECONDS = int(os.getenv("EVENT_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))
+
+# Rows per product demand counter, more rows spread the locks of hot products
+PRODUCT_COUNTER_SLOTS = int(os.getenv("PRODUCT_COUNTER_SLOTS", "16"))
+
+# Worker warmup and the readiness probe
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("true", "1", "yes")
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))  # pooled connections opened per database
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))  # seconds
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "1"))  # seconds a check is reused
+
+# Compiled statements kept per engine, raise it when the cache keeps missing
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "500"))
+
+# Admin operations over many customers, see service/executor.py
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "4"))  # keep it below the connection pool size
+FANOUT_CHUNK_SIZE = int(os.getenv("FANOUT_CHUNK_SIZE", "100"))  # customers per transaction
+
+# Guards of GET /shopcarts, 0 disables a guard
+LIST_MAX_ROWS = int(os.getenv("LIST_MAX_ROWS", "10000"))  # items of a list without limit, and of a page
+LIST_MAX_SCAN_ROWS = int(os.getenv("LIST_MAX_SCAN_ROWS", "100000"))  # rows a list without limit may scan
+LIST_STATEMENT_TIMEOUT = int(os.getenv("LIST_STATEMENT_TIMEOUT", "5000"))  # milliseconds
+
+# The in-process cache of product names and prices, see service/catalog.py
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "60"))  # seconds another worker's change may go unseen
+
+# The asyncio variant in service/asgi.py, the URI defaults to DATABASE_URI with an async driver
+ASYNC_DATABASE_URI = os.getenv("ASYNC_DATABASE_URI", "")
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "20"))
+
+# Sampling profiler of a worker behind /admin/profile, also needs ADMIN_API_KEY, see service/profiler.py
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() in ("true", "1", "yes")
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))  # seconds between samples
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
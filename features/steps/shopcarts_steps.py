@@ -21,6 +21,7 @@ For information on Waiting until elements are present in the HTML see:
     https://selenium-python.readthedocs.io/waits.html
 """
 import json
+from os import getenv
 import requests
 from behave import given
 from compare import expect
@@ -29,16 +30,15 @@ from compare import expect
 @given('the following shopcarts')
 def step_impl(context):
     """ Delete all ShopCarts and load new ones """
-    headers = {'Content-Type': 'application/json'}
-    # list all of the shopcarts and delete them one by one
-    context.resp = requests.get(context.base_url + '/shopcarts', headers=headers)
-    expect(context.resp.status_code).to_equal(200)
-    for shopcart in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/shopcarts/' + str(shopcart["customer_id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
-    
-    # load the database with new shopcarts
-    create_url = context.base_url + '/shopcarts'
+    admin_headers = {}
+    if getenv('ADMIN_API_KEY'):
+        admin_headers['X-Api-Key'] = getenv('ADMIN_API_KEY')
+    # delete every shopcart in one call
+    context.resp = requests.delete(context.base_url + '/admin/shopcarts', headers=admin_headers)
+    expect(context.resp.status_code).to_equal(204)
+
+    # load the database with new shopcarts in one bulk import
+    rows = []
     for row in context.table:
         data = {
             "customer_id": row['customer_id'],
@@ -47,6 +47,8 @@ def step_impl(context):
             "quantity": row['quantity'],
             "price": row['price'],
         }
-        payload = json.dumps(data)
-        context.resp = requests.post("{}/{}/items".format(create_url, data['customer_id']), data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+        rows.append(json.dumps(data))
+    import_headers = dict(admin_headers, **{'Content-Type': 'application/x-ndjson'})
+    context.resp = requests.post(context.base_url + '/admin/shopcarts/import',
+                                 data="\n".join(rows) + "\n", headers=import_headers)
+    expect(context.resp.status_code).to_equal(201)
@@ -0,0 +1,15 @@
+"""
+Gunicorn configuration
+
+The background jobs of service/jobs.py run in the server workers only,
+importing the service (tests, the flask CLI, benchmarks) never starts
+them.
+"""
+
+
+def post_worker_init(worker):
+    """ Starts the background jobs once the worker has loaded the app """
+    # pylint: disable=import-outside-toplevel
+    from service import app, jobs
+    worker.log.info("Starting the background jobs of worker %s", worker.pid)
+    jobs.start_jobs(app)
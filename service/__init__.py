@@ -1,44 +1,14 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+Importing a module of the package does not start the service. The Flask
+app of the synchronous service is set up by service/server.py the first
+time service.app is used or service.routes is imported.
 """
-import os
-import sys
-import logging
-from flask import Flask
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
 
-# Import the routes After the Flask app is created
-from service import routes, models
-
-# Set up logging for production
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    routes.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service initialized!")
+def __getattr__(name):
+    if name == "app":
+        from service.server import app  # pylint: disable=import-outside-toplevel
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,11 @@
+"""
+Flask Application
+
+Creates the Flask app and loads its config. Nothing else happens on
+import: the synchronous service is set up on the app by service/server.py,
+and the asyncio variant in service/asgi.py uses the models without it.
+"""
+from flask import Flask
+
+app = Flask("service")
+app.config.from_object("config")
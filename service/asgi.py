@@ -0,0 +1,441 @@
+"""
+ShopCart Service, asyncio variant
+
+Serves the cart routes of service/routes.py with the same request and
+response bodies from Quart on an async SQLAlchemy session, so a request
+waiting on the database holds a coroutine instead of a worker thread.
+
+  hypercorn --workers 1 --bind 0.0.0.0:$PORT service.asgi:app
+
+The database is reached through asyncpg or aiosqlite: ASYNC_DATABASE_URI,
+or DATABASE_URI with the driver swapped. The mapped classes, the payload
+validation and the change tracking of the cart headers, product counters
+and outbox are shared with the synchronous service, which is not set up
+here: no Flask app, background jobs, warmup or synchronous pools. The
+tables are created when the server starts. Sharding, replicas and the
+admin endpoints stay on the synchronous service.
+
+Paths:
+------
+GET /shopcarts - Returns a list all of the ShopCarts
+POST /shopcarts - creates a new ShopCart record in the database
+POST /shopcarts/{customer_id}/items - add an item to the shopcart for customer_id
+GET /shopcarts/{customer_id} - Returns the ShopCart with a given id number
+GET /shopcarts/{customer_id}/items - Returns the ShopCart with a given id number
+GET /shopcarts/{customer_id}/summary - Returns the item count, quantity and subtotal of a ShopCart
+GET /shopcarts/{customer_id}/items/{product_id} - Returns an item in the ShopCart with a given id number
+PUT /shopcarts/{customer_id}/items/{product_id} - updates a ShopCart record in the database
+DELETE /shopcarts/{customer_id}/items/{product_id} - deletes an item from the ShopCart
+PUT /shopcarts/{customer_id}/checkout - checkout all items in the shopcart
+PUT /shopcarts/{customer_id}/merge - moves the items of another ShopCart into the shopcart
+PUT /shopcarts/{customer_id}/items/{product_id}/checkout - checkout one item in the shopcart
+DELETE /shopcarts/{customer_id} - deletes a ShopCart record in the database
+GET /products/{product_id}/demand - Returns the number of ShopCarts holding a product and their quantity
+GET /health/live - answers while the worker is running
+GET /health/ready - answers 200 once the database responds
+"""
+import asyncio
+from quart import Quart, jsonify, request, url_for
+from sqlalchemy import func, orm, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from service import status, validation
+from service.guards import QueryTooExpensive
+from service.models import (
+    FIND_SHOPCART, LIST_SHOPCARTS, MERGE_POLICIES, Cart, DataValidationError, ProductCounter, ShopCart,
+    cart_subtotal, check_out, db, fill_products, list_rows, merge_carts, product_cache, track_changes
+)
+
+app = Quart(__name__)
+app.config.from_object("config")
+
+
+def async_uri(uri):
+    """ Returns the URI of the async driver for a synchronous database URI """
+    for prefix, replacement in (("postgres://", "postgresql+asyncpg://"),
+                                ("postgresql://", "postgresql+asyncpg://"),
+                                ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+                                ("sqlite://", "sqlite+aiosqlite://")):
+        if uri.startswith(prefix):
+            return replacement + uri[len(prefix):]
+    return uri
+
+
+class CartSession(orm.Session):
+    """The synchronous session behind every AsyncSession of this app"""
+
+
+track_changes(CartSession)
+
+
+def create_engine(config):
+    """ Returns the async engine, a bounded pool except on SQLite """
+    uri = config.get("ASYNC_DATABASE_URI") or async_uri(config["SQLALCHEMY_DATABASE_URI"])
+    options = {"query_cache_size": config.get("STATEMENT_CACHE_SIZE", 500)}
+    if not uri.startswith("sqlite"):
+        options["pool_size"] = config.get("ASYNC_POOL_SIZE", 20)
+    return create_async_engine(uri, **options)
+
+
+engine = create_engine(app.config)
+product_cache.configure(app.config.get("PRODUCT_CACHE_SIZE", 10000), app.config.get("PRODUCT_CACHE_TTL", 60))
+Session = orm.sessionmaker(
+    engine, class_=AsyncSession, sync_session_class=CartSession, expire_on_commit=False,
+    info={"product_counter_slots": app.config.get("PRODUCT_COUNTER_SLOTS", 16)},
+)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def abort(code, message):
+    """ Returns an error with the body Flask-RESTX sends for abort() """
+    app.logger.error(message)
+    return {"message": message}, code
+
+
+def not_found(message):
+    """ Returns a 404 with the body Flask-RESTX sends for NotFound """
+    return {"message": message}, status.HTTP_404_NOT_FOUND
+
+
+async def read_payload():
+    """Validates the JSON body of the request
+
+    Returns:
+        the values and None, or None and the error response
+    """
+    content_type = request.headers.get("Content-Type")
+    if content_type != "application/json":
+        return None, abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/json")
+    values, errors = validation.shopcart.validate(await request.get_json(silent=True))
+    if errors:
+        return None, invalid_payload("Invalid ShopCart: " + validation.describe(errors), errors)
+    return values, None
+
+
+def invalid_payload(message, errors):
+    """ Returns a 400 response that lists every invalid field """
+    app.logger.error(message)
+    return {
+        "status_code": status.HTTP_400_BAD_REQUEST,
+        "error": "Bad Request",
+        "message": message,
+        "errors": errors,
+    }, status.HTTP_400_BAD_REQUEST
+
+
+async def commit(session):
+    """Commits the changes of a request
+
+    Returns:
+        None, or the error response once the session is rolled back when
+        the flush refuses the changes
+    """
+    try:
+        await session.commit()
+    except DataValidationError as error:
+        await session.rollback()
+        return invalid_payload(str(error), [{"field": None, "message": str(error)}])
+    return None
+
+
+async def find_item(session, customer_id, product_id):
+    """ Returns an item that is not checked out, with its product, or None """
+    result = await session.execute(FIND_SHOPCART, {"customer_id": customer_id, "product_id": product_id})
+    shopcart = result.scalars().first()
+    if shopcart is not None:
+        await session.run_sync(fill_products, [shopcart])
+    return shopcart
+
+
+async def list_items(session, customer_id):
+    """ Returns the items of a cart that are not checked out, with their products """
+    shopcarts = (await session.execute(LIST_SHOPCARTS, {"customer_id": customer_id})).scalars().all()
+    return await session.run_sync(fill_products, shopcarts)
+
+
+######################################################################
+#  H E A L T H   P R O B E S
+######################################################################
+@app.route("/health/live")
+async def liveness():
+    """Answers as long as the worker can serve requests"""
+    return {"status": "ok"}, status.HTTP_200_OK
+
+
+@app.route("/health/ready")
+async def readiness():
+    """Answers 200 once the database responds within HEALTH_CHECK_TIMEOUT"""
+    try:
+        async with engine.connect() as connection:
+            await asyncio.wait_for(connection.execute(text("SELECT 1")),
+                                   app.config.get("HEALTH_CHECK_TIMEOUT", 2.0))
+    except Exception as exc:  # pylint: disable=broad-except
+        app.logger.warning("Database is unavailable: %s", exc)
+        return {"status": "unavailable", "checks": {"primary": type(exc).__name__}}, \
+            status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ok", "checks": {"primary": "ok"}}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts
+######################################################################
+@app.route("/shopcarts", methods=["GET"], strict_slashes=False)
+async def list_shopcarts():
+    """Returns all of the products in ShopCarts"""
+    app.logger.info("Request for product list")
+    max_rows = app.config["LIST_MAX_ROWS"]
+    try:
+        price = float(request.args["price"]) if request.args.get("price") else None
+        quantity = int(request.args["quantity"]) if request.args.get("quantity") else None
+        product_id = int(request.args["product_id"]) if request.args.get("product_id") else None
+        limit = int(request.args["limit"]) if request.args.get("limit") else None
+        after = tuple(int(value) for value in request.args["after"].split(",")) if "after" in request.args else None
+    except ValueError:
+        return abort(status.HTTP_400_BAD_REQUEST, "The filters, limit and after must be numbers")
+    if limit is not None and (limit < 1 or (max_rows and limit > max_rows)):
+        return abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and {}".format(max_rows))
+    if after is not None and len(after) != 2:
+        return abort(status.HTTP_400_BAD_REQUEST,
+                     "after must be the customer_id,product_id of the last ShopCart of a page")
+    async with Session() as session:
+        try:
+            rows = await session.run_sync(
+                list_rows, price, quantity, product_id,
+                limit=limit or (max_rows + 1 if max_rows else None), after=after,
+                max_scan_rows=None if limit else app.config["LIST_MAX_SCAN_ROWS"],
+                timeout=app.config["LIST_STATEMENT_TIMEOUT"],
+            )
+            if not limit and max_rows and len(rows) > max_rows:
+                raise QueryTooExpensive("The query matches more than {} ShopCarts".format(max_rows))
+        except QueryTooExpensive as error:
+            return abort(status.HTTP_400_BAD_REQUEST, "{}. Add a product_id or price filter, or page through "
+                                                      "the ShopCarts with limit and after".format(error))
+    headers = {}
+    if limit and len(rows) == limit:
+        params = dict(request.args, after="{},{}".format(rows[-1].customer_id, rows[-1].product_id))
+        headers["Link"] = '<{}>; rel="next"'.format(url_for("list_shopcarts", _external=True, **params))
+    app.logger.info("Returning %d shopcarts", len(rows))
+    return jsonify([row._asdict() for row in rows]), status.HTTP_200_OK, headers
+
+
+@app.route("/shopcarts", methods=["POST"], strict_slashes=False)
+async def create_shopcarts():
+    """Creates a ShopCart"""
+    app.logger.info("Request to create a ShopCart")
+    values, response = await read_payload()
+    if response:
+        return response
+    location_url = url_for("get_shopcarts", customer_id=values["customer_id"], _external=True)
+    app.logger.info("Shopcart for customer [%s] created.", values["customer_id"])
+    return {"customer_id": values["customer_id"]}, status.HTTP_201_CREATED, {"Location": location_url}
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}
+#  PATH: /shopcarts/{int:customer_id}/items
+######################################################################
+@app.route("/shopcarts/<int:customer_id>", methods=["GET"])
+@app.route("/shopcarts/<int:customer_id>/items", methods=["GET"])
+async def get_shopcarts(customer_id):
+    """Retrieve a single ShopCart with all items in it"""
+    app.logger.info("Request for shopcart with id: %s", customer_id)
+    async with Session() as session:
+        if await session.get(Cart, customer_id) is None:
+            return not_found("ShopCart with id '{}' was not found.".format(customer_id))
+        results = [shopcart.serialize() for shopcart in await list_items(session, customer_id)]
+    app.logger.info("Returning %d shopcarts", len(results))
+    return jsonify(results), status.HTTP_200_OK
+
+
+@app.route("/shopcarts/<int:customer_id>", methods=["DELETE"])
+async def delete_shopcarts(customer_id):
+    """Delete a Shopcart"""
+    app.logger.info("Request to delete shopcart with id: %s", customer_id)
+    async with Session() as session:
+        for shopcart in await list_items(session, customer_id):
+            await session.delete(shopcart)
+        await session.commit()
+    app.logger.info("Shopcart with ID [%s] delete complete.", customer_id)
+    return "", status.HTTP_204_NO_CONTENT
+
+
+@app.route("/shopcarts/<int:customer_id>/items", methods=["POST"])
+async def create_shopcarts_with_item(customer_id):
+    """Add an item to an existing ShopCart"""
+    app.logger.info("Request to create a ShopCart")
+    values, response = await read_payload()
+    if response:
+        return response
+    if values["customer_id"] != customer_id:
+        return abort(status.HTTP_400_BAD_REQUEST,
+                     "Customer ID in data must be {} as requested in URI. ".format(customer_id))
+    shopcart = ShopCart(**values)
+    async with Session() as session:
+        if await find_item(session, shopcart.customer_id, shopcart.product_id):
+            return abort(status.HTTP_400_BAD_REQUEST,
+                         "ShopCart with customer id = {} and product id = {} already exists"
+                         .format(customer_id, shopcart.product_id))
+        session.add(shopcart)
+        response = await commit(session)
+        if response:
+            return response
+    location_url = url_for("get_shopcarts_with_item_id", customer_id=shopcart.customer_id,
+                           product_id=shopcart.product_id, _external=True)
+    app.logger.info("Shopcart for customer [%s] for product [%s] created.", shopcart.customer_id, shopcart.product_id)
+    return shopcart.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/summary
+######################################################################
+@app.route("/shopcarts/<int:customer_id>/summary", methods=["GET"])
+async def get_shopcart_summary(customer_id):
+    """Retrieve the totals of a ShopCart"""
+    app.logger.info("Request for summary of shopcart with id: %s", customer_id)
+    async with Session() as session:
+        cart = await session.get(Cart, customer_id)
+        if cart is None:
+            return not_found("ShopCart with id '{}' was not found.".format(customer_id))
+        subtotal = await session.run_sync(cart_subtotal, customer_id)
+    return cart.serialize(subtotal), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/checkout
+######################################################################
+@app.route("/shopcarts/<int:customer_id>/checkout", methods=["PUT"])
+async def checkout_shopcarts(customer_id):
+    """Checkout a Shopcart"""
+    app.logger.info("Request to checkout shopcart with id: %s", customer_id)
+    async with Session() as session:
+        await session.run_sync(check_out, customer_id)
+        await session.commit()
+    app.logger.info("Shopcart with ID [%s] checkout complete.", customer_id)
+    return "", status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/merge
+######################################################################
+@app.route("/shopcarts/<int:customer_id>/merge", methods=["PUT"])
+async def merge_shopcarts(customer_id):
+    """Merge a ShopCart into another"""
+    source = request.args.get("source", type=int)
+    policy = request.args.get("policy", "sum")
+    if source is None or policy not in MERGE_POLICIES:
+        return abort(status.HTTP_400_BAD_REQUEST,
+                     "source must be a customer id and policy one of {}".format(", ".join(MERGE_POLICIES)))
+    app.logger.info("Request to merge shopcart %s into shopcart %s", source, customer_id)
+    async with Session() as session:
+        try:
+            await session.run_sync(merge_carts, source, customer_id, policy)
+        except DataValidationError as error:
+            app.logger.error(str(error))
+            return {
+                "status_code": status.HTTP_400_BAD_REQUEST,
+                "error": "Bad Request",
+                "message": str(error),
+            }, status.HTTP_400_BAD_REQUEST
+        await session.commit()
+        results = [shopcart.serialize() for shopcart in await list_items(session, customer_id)]
+    return jsonify(results), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/items/{int:product_id}
+######################################################################
+@app.route("/shopcarts/<int:customer_id>/items/<int:product_id>", methods=["GET"])
+async def get_shopcarts_with_item_id(customer_id, product_id):
+    """Retrieve a single ShopCart with specified item"""
+    app.logger.info("Request for shopcart with id: %s", customer_id)
+    async with Session() as session:
+        shopcart = await find_item(session, customer_id, product_id)
+    if not shopcart:
+        return not_found("ShopCart with id '{}' was not found.".format(customer_id))
+    app.logger.info("Returning shopcart: %s", shopcart.name)
+    return shopcart.serialize(), status.HTTP_200_OK
+
+
+@app.route("/shopcarts/<int:customer_id>/items/<int:product_id>", methods=["PUT"])
+async def update_shopcarts(customer_id, product_id):
+    """Update a shopcart"""
+    app.logger.info("Request to update shopcart with id [%s] for product [%s]", customer_id, product_id)
+    if request.headers.get("Content-Type") != "application/json":
+        return (await read_payload())[1]
+    async with Session() as session:
+        shopcart = await find_item(session, customer_id, product_id)
+        if not shopcart:
+            return not_found("Shopcart with id '{}' for product '{}' was not found.".format(customer_id, product_id))
+        values, response = await read_payload()
+        if response:
+            return response
+        for name, value in values.items():
+            setattr(shopcart, name, value)
+        shopcart.customer_id = customer_id
+        shopcart.product_id = product_id
+        response = await commit(session)
+        if response:
+            return response
+    app.logger.info("shopcart with ID [%s] for product [%s] updated.", customer_id, product_id)
+    return shopcart.serialize(), status.HTTP_200_OK
+
+
+@app.route("/shopcarts/<int:customer_id>/items/<int:product_id>", methods=["DELETE"])
+async def delete_item_shopcarts(customer_id, product_id):
+    """Delete an item from a Shopcart"""
+    app.logger.info("Request to delete product with id [%s] for shopcart [%s]", customer_id, product_id)
+    async with Session() as session:
+        shopcart = await find_item(session, customer_id, product_id)
+        if not shopcart:
+            return not_found("Shopcart with id '{}' for product '{}' was not found.".format(customer_id, product_id))
+        await session.delete(shopcart)
+        await session.commit()
+    app.logger.info("shopcart with ID [%s] for product [%s] deleted.", customer_id, product_id)
+    return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/items/{int:product_id}/checkout
+######################################################################
+@app.route("/shopcarts/<int:customer_id>/items/<int:product_id>/checkout", methods=["PUT"])
+async def checkout_item_shopcarts(customer_id, product_id):
+    """Checkout an item in a Shopcart"""
+    app.logger.info("Request to checkout product with id [%s] for shopcart [%s]", customer_id, product_id)
+    async with Session() as session:
+        shopcart = await find_item(session, customer_id, product_id)
+        if not shopcart:
+            return not_found("Shopcart with id '{}' for product '{}' was not found.".format(customer_id, product_id))
+        await session.run_sync(check_out, customer_id, product_id)
+        await session.commit()
+    app.logger.info("shopcart with ID [%s] for product [%s] checked out.", customer_id, product_id)
+    return "", status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{int:product_id}/demand
+######################################################################
+@app.route("/products/<int:product_id>/demand", methods=["GET"])
+async def get_product_demand(product_id):
+    """Retrieve the demand for a product"""
+    app.logger.info("Request for demand of product with id: %s", product_id)
+    async with Session() as session:
+        row = (await session.execute(select(
+            func.coalesce(func.sum(ProductCounter.cart_count), 0),
+            func.coalesce(func.sum(ProductCounter.quantity_total), 0),
+        ).where(ProductCounter.product_id == product_id))).one()
+    return {"product_id": product_id, "cart_count": int(row[0]), "quantity_total": int(row[1])}, \
+        status.HTTP_200_OK
+
+
+@app.before_serving
+async def create_tables():
+    """ Creates the tables that do not exist yet """
+    async with engine.begin() as connection:
+        await connection.run_sync(db.Model.metadata.create_all)
+
+
+@app.after_serving
+async def dispose_engine():
+    """ Closes the pooled connections when the server stops """
+    await engine.dispose()
@@ -0,0 +1,124 @@
+"""
+Static Assets
+
+Builds the static UI for production and serves the result.
+
+"flask build-assets" copies every file under service/static to
+service/static/dist with a content hash in its name, writes gzip (and
+brotli when available) copies of the text files next to it, and records
+the names in dist/manifest.json. index.html is then served with its links
+rewritten to the fingerprinted names under /assets/, and those files are
+served with the precompressed copy the client accepts and a one year,
+immutable Cache-Control header. Without a build the original files are
+served from /static/ as before.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from service import compression
+
+logger = logging.getLogger("flask.app")
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".html", ".svg", ".json", ".txt")
+MAX_AGE = 365 * 24 * 60 * 60
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+_lock = threading.Lock()
+
+
+def fingerprint(path, content):
+    """ Adds the first 12 hex digits of the content hash to a file name """
+    name, extension = os.path.splitext(path)
+    return "{}.{}{}".format(name, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def build(static_folder, min_size=1024):
+    """Fingerprints and precompresses the static files
+
+    Args:
+        static_folder (string): the folder with the static files
+        min_size (int): files smaller than this are not precompressed
+
+    Returns:
+        the manifest, a dict of original to fingerprinted relative paths
+    """
+    output = os.path.join(static_folder, DIST)
+    shutil.rmtree(output, ignore_errors=True)
+    manifest = {}
+    for root, folders, files in os.walk(static_folder):
+        if root == static_folder and DIST in folders:
+            folders.remove(DIST)
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            path = os.path.relpath(source, static_folder).replace(os.sep, "/")
+            if path == "index.html":
+                continue
+            with open(source, "rb") as file:
+                content = file.read()
+            target = fingerprint(path, content)
+            _write(os.path.join(output, target), content)
+            if path.endswith(PRECOMPRESS_EXTENSIONS) and len(content) >= min_size:
+                for encoding in compression.encodings():
+                    _write(os.path.join(output, target + SUFFIXES[encoding]),
+                           compression.compress(content, encoding, 9))
+            manifest[path] = target
+    _write(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    logger.info("Built %d static assets in %s", len(manifest), output)
+    return manifest
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def load_manifest(static_folder):
+    """ Returns the manifest of the last build or None """
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST), encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def index_html(app):
+    """Returns index.html with links to the fingerprinted assets
+
+    The page is built once per process. Returns None when the assets
+    have not been built.
+    """
+    cached = app.extensions.get("assets")
+    if cached is not None:
+        return cached or None
+    with _lock:
+        manifest = load_manifest(app.static_folder)
+        html = ""
+        if manifest:
+            with open(os.path.join(app.static_folder, "index.html"), encoding="utf-8") as file:
+                html = file.read()
+            for path, target in manifest.items():
+                html = html.replace("static/" + path, "assets/" + target)
+        app.extensions["assets"] = html
+    return html or None
+
+
+def precompressed(static_folder, filename, accept_encodings):
+    """Picks the precompressed copy of an asset the client accepts
+
+    Returns:
+        a (file name, encoding) tuple, the encoding is None for the original
+    """
+    available = tuple(
+        encoding for encoding in compression.encodings()
+        if os.path.isfile(os.path.join(static_folder, DIST, filename + SUFFIXES[encoding]))
+    )
+    encoding = compression.negotiate(accept_encodings, available) if available else None
+    if encoding is None:
+        return filename, None
+    return filename + SUFFIXES[encoding], encoding
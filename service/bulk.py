@@ -0,0 +1,266 @@
+"""
+Bulk Import and Export
+
+Streams the shop_cart table in and out as CSV or newline delimited JSON
+without holding more than one batch of rows in memory.
+
+* Exports read through a streaming cursor, server side on PostgreSQL, and
+  are produced one batch at a time.
+* Imports use COPY ... FROM STDIN for CSV on PostgreSQL and batched
+  multi-row INSERTs everywhere else. Both check the rows with the same
+  rules and update the headers, counters and outbox. The whole import
+  runs in one transaction so a bad row leaves the table untouched.
+
+The name and price of a row come from the product table unless the item
+overrides them. An import adds the products that are missing and keeps
+the other values in the overrides of the rows, like a ShopCart does.
+"""
+import io
+import csv
+import json
+import logging
+from sqlalchemy import column, select, table
+from sqlalchemy.exc import IntegrityError
+from service import sharding, validation
+from service.models import (
+    ITEM_COLUMNS, ROW_COLUMNS, Cart, CartEvent, Product, ProductCounter, ShopCart, DataValidationError,
+    _release_checked_out, cart_rows, db
+)
+
+logger = logging.getLogger("flask.app")
+
+COLUMNS = ("customer_id", "product_id", "name", "quantity", "price")
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+DEFAULT_BATCH_SIZE = 1000
+
+# the temporary table a COPY import is staged in
+IMPORTED = table("shop_cart_import", column("customer_id"), column("product_id"))
+
+# the checks of validation.shopcart for the text columns of IMPORTED
+INTEGER = r"^\s*[+-]?\d+\s*$"
+NUMBER = r"^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$"
+CHECKS = (
+    "customer_id ~ '{}'".format(INTEGER),
+    "product_id ~ '{}'".format(INTEGER),
+    "name IS NOT NULL",
+    "quantity ~ '{}'".format(INTEGER),
+    "price ~ '{}'".format(NUMBER),
+)
+
+
+def format_for(mimetype):
+    """ Returns the bulk format for a mimetype or None """
+    for name, media_type in FORMATS.items():
+        if mimetype == media_type:
+            return name
+    return None
+
+
+######################################################################
+#  E X P O R T
+######################################################################
+def _encode(rows, fmt):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in rows)
+
+
+def export_rows(fmt="csv", batch_size=DEFAULT_BATCH_SIZE):
+    """Streams every ShopCart row, one encoded batch at a time
+
+    Args:
+        fmt (string): csv or ndjson
+        batch_size (int): the number of rows fetched and encoded at once
+
+    Returns:
+        a generator of strings
+    """
+    if fmt not in FORMATS:
+        raise DataValidationError("Unsupported format: {}".format(fmt))
+    table = ShopCart.__table__
+    statement = select(*[table.c[column] for column in ROW_COLUMNS]).where(
+        table.c.checked_out_at.is_(None)
+    ).order_by(table.c.customer_id, table.c.product_id)
+    if fmt == "csv":
+        yield ",".join(COLUMNS) + "\n"
+    for index in sharding.shard_indexes(db.get_app()):
+        with sharding.shard_index(index):
+            result = db.session.execute(
+                statement, execution_options={"stream_results": True}
+            )
+            for rows in result.partitions(batch_size):
+                yield _encode(cart_rows(db.session, rows), fmt)
+
+
+def copy_to(output, fmt="csv"):
+    """Writes every ShopCart row to a file, using COPY on PostgreSQL
+
+    Returns:
+        the number of rows written
+    """
+    engine = db.get_engine()
+    if fmt == "csv" and engine.dialect.name == "postgresql" and sharding.shard_count(db.get_app()) == 1:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert(
+                "COPY (SELECT c.customer_id, c.product_id, COALESCE(c.name_override, p.name), c.quantity, "
+                "COALESCE(c.price_override, p.price) "
+                "FROM {table} c LEFT JOIN {products} p ON p.product_id = c.product_id "
+                "WHERE c.checked_out_at IS NULL ORDER BY c.customer_id, c.product_id) "
+                "TO STDOUT WITH CSV HEADER".format(table=ShopCart.__tablename__, products=Product.__tablename__),
+                output,
+            )
+            return cursor.rowcount
+        finally:
+            connection.close()
+    count = 0
+    for chunk in export_rows(fmt):
+        output.write(chunk)
+        count += chunk.count("\n")
+    return count - 1 if fmt == "csv" else count
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+def parse_row(record, line):
+    """Converts a CSV or JSON record into a row of column values
+
+    Raises:
+        DataValidationError: when a column is missing or has a bad value
+    """
+    values, errors = validation.shopcart.validate(record)
+    if errors:
+        raise DataValidationError("Invalid ShopCart on line {}: {}".format(line, validation.describe(errors)))
+    return values
+
+
+def read_records(stream, fmt):
+    """Reads records from a text stream
+
+    Returns:
+        a generator of (line number, record) tuples
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line, text in enumerate(stream, start=1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except ValueError as error:
+                    raise DataValidationError("Invalid JSON on line {}: {}".format(line, error))
+    else:
+        raise DataValidationError("Unsupported format: {}".format(fmt))
+
+
+def insert_rows(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Validates records and inserts them with multi-row INSERTs
+
+    The caller is responsible for the commit.
+
+    Returns:
+        the number of rows inserted
+    """
+    return ShopCart.insert_rows((parse_row(record, line) for line, record in records), batch_size)
+
+
+def _copy_from(stream):
+    # the rows are copied as text to a temporary table, checked like
+    # parse_row() checks them, then split between the product table, where
+    # the last row of a missing product adds it, and shop_cart, where the
+    # values that differ from the product are kept as overrides
+    connection = db.session.connection(bind_arguments={"mapper": ShopCart.__mapper__})
+    cursor = connection.connection.cursor()
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {imported} (customer_id text, product_id text, name text, "
+        "quantity text, price text, line serial) ON COMMIT DROP".format(imported=IMPORTED.name)
+    )
+    try:
+        cursor.copy_expert(
+            "COPY {imported} ({columns}) FROM STDIN WITH CSV HEADER FORCE NOT NULL {columns}".format(
+                imported=IMPORTED.name, columns=", ".join(COLUMNS)
+            ),
+            stream,
+        )
+    except connection.dialect.dbapi.DataError as error:
+        raise DataValidationError("Invalid ShopCart import: {}".format(error))
+    count = cursor.rowcount
+    cursor.execute(
+        "SELECT line, {columns} FROM {imported} WHERE ({checks}) IS NOT TRUE ORDER BY line LIMIT 1".format(
+            imported=IMPORTED.name, columns=", ".join(COLUMNS), checks=" AND ".join(CHECKS)
+        )
+    )
+    invalid = cursor.fetchone()
+    if invalid is not None:
+        # the header is the first line
+        parse_row(dict(zip(COLUMNS, invalid[1:])), invalid[0] + 1)
+    cursor.execute(
+        "ALTER TABLE {imported} ALTER customer_id TYPE integer USING customer_id::integer, "
+        "ALTER product_id TYPE integer USING product_id::integer, "
+        "ALTER quantity TYPE integer USING quantity::integer, "
+        "ALTER price TYPE double precision USING price::double precision".format(imported=IMPORTED.name)
+    )
+    cursor.execute(
+        "INSERT INTO {products} (product_id, name, price, last_modified) "
+        "SELECT DISTINCT ON (product_id) product_id, name, price, now() FROM {imported} "
+        "ORDER BY product_id, line DESC "
+        "ON CONFLICT (product_id) DO NOTHING".format(products=Product.__tablename__, imported=IMPORTED.name)
+    )
+    _release_checked_out(db.session, connection, select(IMPORTED.c.customer_id, IMPORTED.c.product_id))
+    cursor.execute(
+        "INSERT INTO {table} ({columns}, name_override, price_override) "
+        "SELECT {selected}, CASE WHEN i.name IS DISTINCT FROM p.name THEN i.name END, "
+        "CASE WHEN i.price IS DISTINCT FROM p.price THEN i.price END "
+        "FROM {imported} i JOIN {products} p ON p.product_id = i.product_id".format(
+            table=ShopCart.__tablename__, columns=", ".join(ITEM_COLUMNS), imported=IMPORTED.name,
+            selected=", ".join("i." + column for column in ITEM_COLUMNS), products=Product.__tablename__,
+        )
+    )
+    # the outbox gets the same "create" events as ShopCart.insert_rows() writes
+    cursor.execute(
+        "INSERT INTO {events} (xid, customer_id, product_id, op, before, after, created_at) "
+        "SELECT txid_current(), customer_id, product_id, 'create', NULL, json_build_object({values}), "
+        "timezone('utc', now()) FROM {imported} ORDER BY line".format(
+            events=CartEvent.__tablename__, imported=IMPORTED.name,
+            values=", ".join("'{0}', {0}".format(column) for column in COLUMNS),
+        )
+    )
+    Cart.rebuild(select(IMPORTED.c.customer_id).distinct())
+    ProductCounter.rebuild(select(IMPORTED.c.product_id).distinct())
+    return count
+
+
+def import_rows(stream, fmt="csv", batch_size=DEFAULT_BATCH_SIZE):
+    """Loads ShopCart rows from a text stream in a single transaction
+
+    Args:
+        stream (file): a text stream of CSV with a header line or of NDJSON
+        fmt (string): csv or ndjson
+        batch_size (int): the number of rows per INSERT
+
+    Returns:
+        the number of rows imported
+    """
+    logger.info("Importing shopcarts as %s ...", fmt)
+    try:
+        engine = db.get_engine()
+        if fmt == "csv" and engine.dialect.name == "postgresql" and sharding.shard_count(db.get_app()) == 1:
+            count = _copy_from(stream)
+            db.session.commit()
+        else:
+            count = insert_rows(read_records(stream, fmt), batch_size)
+            db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        raise DataValidationError("Invalid ShopCart import: {}".format(error.orig))
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info("Imported %d shopcart rows", count)
+    return count
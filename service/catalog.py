@@ -0,0 +1,88 @@
+"""
+Product Catalog Cache
+
+The name and price of a product are stored once, in the product table,
+instead of in every cart item that holds the product. Reads go through
+two levels:
+
+* a ProductCache in each worker process, a bounded LRU of the products
+  read recently, whose entries live for PRODUCT_CACHE_TTL seconds
+* the product table on the primary, or on a replica during read-only
+  requests, read with one query for all of the products a cache lookup
+  misses
+
+Writes go through: the product row is written in the transaction of the
+change and the local cache is updated once that transaction commits.
+Other workers see the change when their entry expires. Carts and the
+bulk import only add the products that are missing, an item keeps the
+name and price that differ from its product in its own overrides. The
+products themselves change through PUT /products/<product_id>.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class ProductCache:
+    """A thread safe LRU of product values with a time to live"""
+
+    def __init__(self, size=10000, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, size, ttl):
+        """ Changes the size and time to live and drops every entry """
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get_many(self, keys, load):
+        """Returns the values of keys, loading the ones that are not cached
+
+        Args:
+            keys (iterable): the keys to look up
+            load (callable): called with a list of the missing keys, returns
+                a dict of the values that exist
+
+        Returns:
+            a dict of the keys that have a value
+        """
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[0]
+                elif key not in found:
+                    missing.append(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            loaded = load(list(dict.fromkeys(missing)))
+            self.put(loaded)
+            found.update(loaded)
+        return found
+
+    def put(self, values):
+        """ Stores a dict of values """
+        if not values or self.size <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, expires)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Drops every entry """
+        with self._lock:
+            self._entries.clear()
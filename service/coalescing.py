@@ -0,0 +1,125 @@
+"""
+Request Coalescing
+
+Lets concurrent identical reads share one database query. The first
+request for a key runs the view and the requests that arrive while it is
+still running wait for its result instead of querying again. Only reads
+that are in flight are shared, nothing is cached after they finish, and a
+write to a cart makes the next read of that cart start a new query.
+
+The locks come from the threading module, so the waiting also works with
+gevent and eventlet workers once they have monkey patched it.
+"""
+import functools
+import threading
+from flask import current_app, request
+from service import replicas
+
+class _Flight:
+    """ One call in progress and the requests waiting for it """
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its outcome"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """Calls function, or waits for the call already running for key
+
+        Returns:
+            the result of the call, or raises its exception
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args, **kwargs)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            self.forget(key, flight)
+            flight.done.set()
+
+    def forget(self, key, flight=None):
+        """ Makes the next call for key start a new flight """
+        with self._lock:
+            if flight is None or self._flights.get(key) is flight:
+                self._flights.pop(key, None)
+
+    def forget_matching(self, predicate):
+        """ Makes the next call for every key that matches start a new flight """
+        with self._lock:
+            for key in [key for key in self._flights if predicate(key)]:
+                del self._flights[key]
+
+
+# The flights of this process
+flights = SingleFlight()
+
+
+def coalesce(name):
+    """Shares the result of a view between concurrent identical requests
+
+    The key is the view name, the URL arguments and whether the request
+    reads from a replica. Apply it above the marshalling decorators so the
+    serialized response is shared too.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get("COALESCE_READS", True) or request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+            key = (name, tuple(sorted(kwargs.items())), replicas.is_read_only())
+            return flights.do(key, view, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _forget_writes(response):
+    if request.method in ("GET", "HEAD") or response.status_code >= 400:
+        return response
+    customer_id = (request.view_args or {}).get("customer_id")
+    if customer_id is None:
+        flights.forget_matching(lambda key: True)
+    else:
+        flights.forget_matching(lambda key: ("customer_id", customer_id) in key[1])
+    return response
+
+
+def init_coalescing(app):
+    """Installs the hook that stops sharing reads of changed carts
+
+    Args:
+        app (Flask): the application whose reads are coalesced
+    """
+    if not app.extensions.get("coalescing"):
+        app.after_request(_forget_writes)
+        app.extensions["coalescing"] = flights
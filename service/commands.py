@@ -0,0 +1,124 @@
+"""
+Flask CLI Commands
+
+Administrative commands for the ShopCart service. Run them with:
+  flask <command> --help
+"""
+import click
+from service import assets, bulk, executor, jobs, sharding
+from service.models import Cart, ProductCounter, db
+
+# Import Flask application
+from service.application import app
+
+
+@app.cli.command("purge-carts")
+@click.option("--ttl", type=int, default=None, help="Seconds a cart is kept after its last change")
+@click.option("--batch-size", type=int, default=None, help="Maximum rows deleted per transaction")
+def purge_carts(ttl, batch_size):
+    """Deletes the abandoned carts that have expired"""
+    if ttl is not None:
+        app.config["CART_TTL_SECONDS"] = ttl
+    if batch_size is not None:
+        app.config["PURGE_BATCH_SIZE"] = batch_size
+    reclaimed = jobs.purge_expired_carts(app)
+    click.echo("Reclaimed {} shopcart rows".format(reclaimed))
+
+
+@app.cli.command("archive-carts")
+@click.option("--batch-size", type=int, default=None, help="Maximum rows moved per transaction")
+def archive_carts(batch_size):
+    """Moves the checked out items to the archive table"""
+    if batch_size is not None:
+        app.config["ARCHIVE_BATCH_SIZE"] = batch_size
+    archived = jobs.archive_checked_out(app)
+    click.echo("Archived {} checked out rows".format(archived))
+
+
+@app.cli.command("clear-carts")
+@click.argument("customer_ids", type=int, nargs=-1, required=True)
+@click.option("--workers", type=int, default=None, help="Chunks run in parallel")
+@click.option("--chunk-size", type=int, default=None, help="Customers per transaction")
+def clear_carts(customer_ids, workers, chunk_size):
+    """Deletes the items of the carts of CUSTOMER_IDS"""
+    _run_operation("clear", customer_ids, workers, chunk_size)
+
+
+@app.cli.command("rebuild-carts")
+@click.argument("customer_ids", type=int, nargs=-1)
+@click.option("--workers", type=int, default=None, help="Chunks run in parallel")
+@click.option("--chunk-size", type=int, default=None, help="Customers per transaction")
+def rebuild_carts(customer_ids, workers, chunk_size):
+    """Recomputes the summaries of the carts of CUSTOMER_IDS, or of every cart"""
+    _run_operation("rebuild", customer_ids or executor.all_customer_ids(app), workers, chunk_size)
+
+
+def _run_operation(name, customer_ids, workers, chunk_size):
+    fanout = executor.FanOutExecutor(
+        app, workers or app.config["FANOUT_WORKERS"], chunk_size or app.config["FANOUT_CHUNK_SIZE"]
+    )
+    done = []
+
+    def progress(result):
+        done.append(result.customers)
+        click.echo("{}/{} customers, chunk {}: {} rows in {:.3f}s{}".format(
+            sum(done), len(customer_ids), result.chunk, result.rows, result.seconds,
+            ", failed: " + result.error if result.error else ""
+        ), err=True)
+
+    report = fanout.run(name, executor.OPERATIONS[name], customer_ids, progress)
+    click.echo("{} {} carts, {} rows, {} failed chunks in {}s ({} customers/s)".format(
+        name.capitalize(), report["customers"], report["rows"], report["errors"], report["seconds"],
+        report["customers_per_second"]
+    ))
+
+
+@app.cli.command("export-carts")
+@click.argument("output", type=click.File("w"), default="-")
+@click.option("--format", "fmt", type=click.Choice(sorted(bulk.FORMATS)), default="csv")
+def export_carts(output, fmt):
+    """Writes every ShopCart row to OUTPUT as CSV or NDJSON"""
+    count = bulk.copy_to(output, fmt)
+    click.echo("Exported {} shopcart rows".format(count), err=True)
+
+
+@app.cli.command("import-carts")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--format", "fmt", type=click.Choice(sorted(bulk.FORMATS)), default="csv")
+@click.option("--batch-size", type=int, default=bulk.DEFAULT_BATCH_SIZE, help="Rows per INSERT")
+def import_carts(source, fmt, batch_size):
+    """Loads ShopCart rows from SOURCE in one transaction"""
+    count = bulk.import_rows(source, fmt, batch_size)
+    click.echo("Imported {} shopcart rows".format(count), err=True)
+
+
+@app.cli.command("build-assets")
+def build_assets():
+    """Fingerprints and precompresses the static files into static/dist"""
+    manifest = assets.build(app.static_folder, app.config.get("COMPRESS_MIN_SIZE", 1024))
+    click.echo("Built {} static assets".format(len(manifest)), err=True)
+
+
+@app.cli.command("check-carts")
+@click.option("--repair", is_flag=True, help="Correct the cart headers and product counters from the items")
+def check_carts(repair):
+    """Compares the cart headers and product counters with their items"""
+    def check():
+        mismatches = Cart.check()
+        counters = ProductCounter.check()
+        if repair and (mismatches or counters):
+            Cart.repair(mismatches)
+            ProductCounter.repair(counters)
+            db.session.commit()
+        return mismatches, counters
+
+    results = sharding.fan_out(app, check)
+    mismatches = [mismatch for shard in results for mismatch in shard[0]]
+    counters = [mismatch for shard in results for mismatch in shard[1]]
+    for customer_id, found, expected in mismatches:
+        click.echo("Cart {}: header {} items {}".format(customer_id, found, expected))
+    for product_id, found, expected in counters:
+        click.echo("Product {}: counters {} items {}".format(product_id, found, expected))
+    repaired = ", repaired" if repair and (mismatches or counters) else ""
+    click.echo("{} inconsistent cart headers{}".format(len(mismatches), repaired))
+    click.echo("{} inconsistent product counters{}".format(len(counters), repaired))
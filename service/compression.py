@@ -0,0 +1,104 @@
+"""
+Response Compression and Caching Headers
+
+Compresses JSON and text responses that are larger than COMPRESS_MIN_SIZE
+bytes with the best encoding the client accepts: brotli when the optional
+brotli package is installed, otherwise gzip. Streamed responses, such as
+the bulk export, and files that are already compressed are sent as they
+are.
+
+API responses hold private cart data, so they are sent with
+"Cache-Control: private, no-cache" unless the view set its own header.
+"""
+import gzip
+import logging
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger("flask.app")
+
+COMPRESSIBLE_MIMETYPES = (
+    "application/json",
+    "application/javascript",
+    "text/javascript",
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+)
+API_CACHE_CONTROL = "private, no-cache"
+STATIC_ENDPOINTS = ("static", "index", "asset", "restx_doc.static")
+
+
+def encodings():
+    """ Returns the supported encodings in order of preference """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encodings, available=None):
+    """Picks the preferred encoding the client accepts
+
+    Args:
+        accept_encodings (Accept): the parsed Accept-Encoding header
+        available (tuple): the encodings to choose from
+
+    Returns:
+        the name of the encoding or None
+    """
+    best, best_quality = None, 0
+    for encoding in available or encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level):
+    """ Compresses bytes with gzip or brotli """
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    if request.endpoint not in STATIC_ENDPOINTS and "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = API_CACHE_CONTROL
+    config = current_app.config
+    if not config.get("COMPRESS_ENABLED", True):
+        return response
+    response.vary.add("Accept-Encoding")
+    min_size = int(config.get("COMPRESS_MIN_SIZE", 1024))
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or not 200 <= response.status_code < 300
+        or (response.content_length or 0) < min_size
+    ):
+        return response
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding, int(config.get("COMPRESS_LEVEL", 6))))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """Installs the response compression and cache header hook
+
+    Args:
+        app (Flask): the application whose responses are compressed
+    """
+    if not app.extensions.get("compression"):
+        app.after_request(_compress_response)
+        app.extensions["compression"] = True
+    if app.config.get("COMPRESS_ENABLED", True):
+        logger.info("Compressing responses larger than %s bytes with %s",
+                    app.config.get("COMPRESS_MIN_SIZE", 1024), ", ".join(encodings()))
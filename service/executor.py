@@ -0,0 +1,159 @@
+"""
+Fan-out Executor
+
+Runs an admin operation over many customers in parallel instead of one
+customer after the other:
+
+* the customer ids are split into chunks of FANOUT_CHUNK_SIZE that never
+  span two shards
+* every chunk runs in a thread of a pool of FANOUT_WORKERS threads, in its
+  own application context, so it has its own session and pooled
+  connection, and in its own transaction, committed when the chunk is done
+  and rolled back when it fails without stopping the other chunks
+* at most twice as many chunks as workers are in flight, the next chunks
+  are only built once a slot is free
+* a report gives the rows, duration and error of every chunk and the
+  throughput of the whole run
+
+Keep FANOUT_WORKERS below the pool size of the engine, every worker holds
+one connection while its chunk runs.
+"""
+import time
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, union
+from service import sharding
+from service.models import Cart, ShopCart, clear_carts, db
+
+logger = logging.getLogger("flask.app")
+
+ChunkResult = namedtuple("ChunkResult", ["chunk", "shard", "customers", "rows", "seconds", "error"])
+
+
+def chunk_customers(app, customer_ids, chunk_size):
+    """Splits customer ids into chunks of one shard
+
+    Returns:
+        a generator of (shard index, list of customer ids), the index is
+        None when sharding is disabled
+    """
+    shard_map = app.extensions.get("sharding")
+    buffers = {}
+    for customer_id in dict.fromkeys(customer_ids):
+        shard = shard_map.index_for(customer_id) if shard_map else None
+        buffer = buffers.setdefault(shard, [])
+        buffer.append(customer_id)
+        if len(buffer) >= chunk_size:
+            yield shard, buffer
+            buffers[shard] = []
+    for shard, buffer in buffers.items():
+        if buffer:
+            yield shard, buffer
+
+
+class FanOutExecutor:
+    """Runs a function over chunks of customers in a bounded thread pool"""
+
+    def __init__(self, app, workers=4, chunk_size=100):
+        self.app = app
+        self.workers = max(1, workers)
+        self.chunk_size = max(1, chunk_size)
+
+    @classmethod
+    def from_config(cls, app):
+        """ Returns an executor sized by FANOUT_WORKERS and FANOUT_CHUNK_SIZE """
+        return cls(app, app.config.get("FANOUT_WORKERS", 4), app.config.get("FANOUT_CHUNK_SIZE", 100))
+
+    def _run_chunk(self, chunk, shard, customer_ids, function):
+        began = time.perf_counter()
+        with self.app.app_context(), sharding.shard_index(shard):
+            try:
+                rows = function(db.session, customer_ids)
+                db.session.commit()
+                error = None
+            except Exception as exc:  # pylint: disable=broad-except
+                db.session.rollback()
+                rows, error = 0, str(exc)
+                logger.error("Chunk %d of %d customers failed: %s", chunk, len(customer_ids), error)
+        return ChunkResult(chunk, shard, len(customer_ids), rows, time.perf_counter() - began, error)
+
+    def run(self, name, function, customer_ids, progress=None):
+        """Calls function(session, customer_ids) once per chunk and commits it
+
+        Args:
+            name (str): the name of the operation in the logs and the report
+            function (callable): does the work of one chunk and returns the
+                number of rows it changed, the executor commits
+            customer_ids (iterable): the customers to work on
+            progress (callable): called with every ChunkResult as it finishes
+
+        Returns:
+            a dict with the totals and the result of every chunk
+        """
+        logger.info("Starting %s with %d workers", name, self.workers)
+        began = time.perf_counter()
+        results = []
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def finished(future):
+            slots.release()
+            result = future.result()
+            with lock:
+                results.append(result)
+            logger.info("%s chunk %d: %d customers, %d rows in %.3fs%s", name, result.chunk, result.customers,
+                        result.rows, result.seconds, " failed" if result.error else "")
+            if progress:
+                progress(result)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fanout") as pool:
+            for chunk, (shard, ids) in enumerate(chunk_customers(self.app, customer_ids, self.chunk_size)):
+                slots.acquire()
+                pool.submit(self._run_chunk, chunk, shard, ids, function).add_done_callback(finished)
+
+        seconds = time.perf_counter() - began
+        results.sort(key=lambda result: result.chunk)
+        customers = sum(result.customers for result in results)
+        report = {
+            "operation": name,
+            "customers": customers,
+            "rows": sum(result.rows for result in results),
+            "errors": sum(1 for result in results if result.error),
+            "seconds": round(seconds, 3),
+            "customers_per_second": round(customers / seconds, 1) if seconds else None,
+            "chunks": [
+                dict(result._asdict(), seconds=round(result.seconds, 3),
+                     customers_per_second=round(result.customers / result.seconds, 1) if result.seconds else None)
+                for result in results
+            ],
+        }
+        logger.info("Finished %s: %d customers, %d rows, %d failed chunks in %.3fs",
+                    name, customers, report["rows"], report["errors"], seconds)
+        return report
+
+
+######################################################################
+#  O P E R A T I O N S
+######################################################################
+def rebuild_carts(session, customer_ids):
+    """ Recomputes the headers of the carts of customer_ids """
+    # pylint: disable=unused-argument
+    # Cart.rebuild() runs on db.session, the session of the chunk
+    Cart.rebuild(customer_ids)
+    return len(customer_ids)
+
+
+# the functions of the operations that run per chunk of customers
+OPERATIONS = {"clear": clear_carts, "rebuild": rebuild_carts}
+
+
+def all_customer_ids(app):
+    """ Returns the customers that have items or a cart header, on every shard """
+    items, headers = ShopCart.__table__, Cart.__table__
+    statement = union(select(items.c.customer_id), select(headers.c.customer_id))
+    shards = sharding.fan_out(app, lambda: db.session.execute(
+        statement, bind_arguments={"mapper": ShopCart.__mapper__}
+    ).scalars().all())
+    return sorted(customer_id for customer_ids in shards for customer_id in customer_ids)
@@ -0,0 +1,118 @@
+"""
+Cart Change Feed
+
+Reads the cart_event outbox for downstream consumers such as inventory
+reservation and analytics, so they receive every change once without
+scanning the shop_cart table.
+
+A consumer starts without a cursor, reads a page of events and passes the
+cursor it got back to the next read. The cursor holds the transaction id
+and event id of the last event seen on every shard, so it stays valid as
+long as the shard layout does. Events are merged across shards in
+creation order.
+
+On PostgreSQL ids are handed out before commit, so a slow transaction can
+commit an id below a cursor that was already given out. The events of a
+transaction are only read once every older transaction has ended, see
+CartEvent.read_after(). Elsewhere events younger than FEED_SETTLE_SECONDS
+are held back.
+"""
+import time
+import json
+import heapq
+import logging
+import itertools
+from service import sharding
+from service.models import CartEvent, DataValidationError, db
+
+logger = logging.getLogger("flask.app")
+
+
+def decode_cursor(cursor, count):
+    """Returns the (xid, id) of the last event of every shard from a cursor
+
+    Raises:
+        DataValidationError: when the cursor is not a cursor of this service
+    """
+    if not cursor:
+        return [(0, 0)] * count
+    parts = [part.split("-") for part in cursor.split(".")]
+    if len(parts) != count or not all(
+        len(part) == 2 and part[0].isdigit() and part[1].isdigit() for part in parts
+    ):
+        raise DataValidationError("Invalid cursor: {}".format(cursor))
+    return [(int(xid), int(event_id)) for xid, event_id in parts]
+
+
+def encode_cursor(positions):
+    """ Returns the cursor for the (xid, id) of the last event of every shard """
+    return ".".join("{}-{}".format(xid, event_id) for xid, event_id in positions)
+
+
+def read_events(app, cursor=None, limit=100, settle=0):
+    """Reads the next page of events after a cursor
+
+    Args:
+        app (Flask): the application whose shards are read
+        cursor (string): the cursor of the last read, None for the start
+        limit (int): the maximum number of events returned
+        settle (float): the age in seconds an event must have to be
+            returned, outside of PostgreSQL
+
+    Returns:
+        a list of (event, cursor after the event) tuples and the new cursor
+    """
+    indexes = sharding.shard_indexes(app)
+    positions = decode_cursor(cursor, len(indexes))
+    pages = []
+    for slot, index in enumerate(indexes):
+        with sharding.shard_index(index):
+            pages.append([(slot, event) for event in CartEvent.read_after(positions[slot], limit, settle)])
+    # each page is in id order, merging keeps that order within every shard
+    merged = heapq.merge(*pages, key=lambda item: item[1]["created_at"])
+    events = []
+    for slot, event in itertools.islice(merged, limit):
+        positions[slot] = (event.pop("xid"), event["id"])
+        events.append((event, encode_cursor(positions)))
+    return events, encode_cursor(positions)
+
+
+def wait_for_events(app, cursor, limit, settle, wait, poll_interval):
+    """Long polls for events, waiting up to wait seconds for the first one
+
+    Returns:
+        the same as read_events()
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        events, next_cursor = read_events(app, cursor, limit, settle)
+        # end the read transaction so the next poll sees new commits
+        db.session.rollback()
+        if events or time.monotonic() >= deadline:
+            return events, next_cursor
+        time.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+def stream_events(app, cursor, settle, poll_interval, heartbeat, duration):
+    """Yields the events after a cursor as server-sent events
+
+    The id of every event is the cursor to resume from with the
+    Last-Event-ID header. A comment is sent every heartbeat seconds while
+    there is nothing to send, and the stream ends after duration seconds
+    so clients reconnect and workers are not held forever.
+    """
+    deadline = time.monotonic() + duration
+    quiet_since = time.monotonic()
+    yield "retry: {}\n\n".format(int(poll_interval * 1000))
+    while time.monotonic() < deadline:
+        events, cursor = read_events(app, cursor, 100, settle)
+        db.session.rollback()
+        for event, event_cursor in events:
+            yield "id: {}\nevent: cart\ndata: {}\n\n".format(event_cursor, json.dumps(event))
+        if events:
+            quiet_since = time.monotonic()
+            continue
+        if time.monotonic() - quiet_since >= heartbeat:
+            quiet_since = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(poll_interval)
@@ -0,0 +1,143 @@
+"""
+Query Guards
+
+Bounds the cost of the statements a single request can run, so one call
+cannot pin the database:
+
+* check_plan() asks the database for the plan of a statement and rejects
+  it when the full table scans in it would read more than a number of
+  rows. PostgreSQL reports its estimates with EXPLAIN (FORMAT JSON),
+  SQLite only names the tables it scans, so their rows are counted up to
+  the limit.
+* statement_timeout() cancels the statements of a block that run longer
+  than a number of milliseconds, with SET LOCAL statement_timeout on
+  PostgreSQL and a progress handler on SQLite.
+
+Both raise QueryTooExpensive, which the routes turn into a 400 that tells
+the client to add a filter or page through the results.
+"""
+import re
+import time
+import logging
+import contextlib
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger("flask.app")
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+SQLITE_SCAN = re.compile(r"SCAN (?:TABLE )?(\w+)")
+# VM instructions between two checks of the deadline on SQLite
+SQLITE_PROGRESS_STEPS = 10000
+
+
+class QueryTooExpensive(Exception):
+    """ Used when a statement would read or did read too many rows """
+
+
+def _compile(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    if compiled.positional:
+        return compiled.string, tuple(compiled.params[name] for name in compiled.positiontup)
+    return compiled.string, compiled.params
+
+
+def _postgresql_scans(connection, sql, params):
+    plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql, params).scalar()
+    nodes, scans = [plan[0]["Plan"]], {}
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", ()))
+        if node["Node Type"].endswith("Seq Scan"):
+            scans[node["Relation Name"]] = scans.get(node["Relation Name"], 0) + node.get("Plan Rows", 0)
+    if not scans:
+        return {}
+    # the rows a scan reads are the rows of its table, not the rows it returns
+    for name, rows in connection.exec_driver_sql(
+        "SELECT relname, reltuples FROM pg_class WHERE relname = ANY(%(names)s)", {"names": list(scans)}
+    ):
+        scans[name] = max(scans[name], int(rows))
+    return scans
+
+
+def _sqlite_scans(connection, sql, params, max_rows):
+    scans = {}
+    for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params):
+        match = SQLITE_SCAN.match(row[-1])
+        if match and not row[-1].startswith("SCAN CONSTANT ROW"):
+            name = match.group(1)
+            scans[name] = connection.exec_driver_sql(
+                'SELECT count(*) FROM (SELECT 1 FROM "{}" LIMIT {:d})'.format(name, max_rows + 1)
+            ).scalar()
+    return scans
+
+
+def full_scans(connection, statement, max_rows):
+    """Returns the rows every full table scan of a statement would read
+
+    Returns:
+        a dict of table names and row estimates, on SQLite the rows are
+        counted up to max_rows + 1, other databases are not checked
+    """
+    sql, params = _compile(connection, statement)
+    if connection.dialect.name == "postgresql":
+        return _postgresql_scans(connection, sql, params)
+    if connection.dialect.name == "sqlite":
+        return _sqlite_scans(connection, sql, params, max_rows)
+    return {}
+
+
+def check_plan(connection, statement, max_rows):
+    """Rejects a statement whose full table scans would read more than max_rows
+
+    Raises:
+        QueryTooExpensive: when the scans are too large
+    """
+    scans = full_scans(connection, statement, max_rows)
+    rows = sum(scans.values())
+    if rows > max_rows:
+        logger.warning("Rejected a full scan of %s over about %d rows", ", ".join(sorted(scans)), rows)
+        raise QueryTooExpensive(
+            "The query would scan more than {} rows of {}".format(max_rows, ", ".join(sorted(scans)))
+        )
+
+
+@contextlib.contextmanager
+def statement_timeout(connection, milliseconds):
+    """Cancels the statements run on connection in the block after milliseconds
+
+    The connection must be in a transaction. Zero or None disables the
+    timeout.
+
+    Raises:
+        QueryTooExpensive: when a statement is cancelled
+    """
+    if not milliseconds:
+        yield
+        return
+    message = "The query ran longer than {:d} ms".format(int(milliseconds))
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET LOCAL statement_timeout = {:d}".format(int(milliseconds)))
+        try:
+            yield
+        except OperationalError as error:
+            if getattr(error.orig, "pgcode", None) == QUERY_CANCELED:
+                raise QueryTooExpensive(message) from error
+            raise
+        connection.exec_driver_sql("SET LOCAL statement_timeout = DEFAULT")
+        return
+    set_progress_handler = getattr(connection.connection, "set_progress_handler", None)
+    if set_progress_handler is None:
+        yield
+        return
+    deadline = time.monotonic() + milliseconds / 1000.0
+    # a true result interrupts the running statement
+    set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS)
+    try:
+        yield
+    except OperationalError as error:
+        if time.monotonic() > deadline:
+            raise QueryTooExpensive(message) from error
+        raise
+    finally:
+        set_progress_handler(None, 0)
@@ -0,0 +1,153 @@
+"""
+Warmup and Health Checks
+
+A new worker pays for the Swagger specification, the SQLAlchemy mapper
+configuration and the first database connections on its first requests.
+warmup() does that work before the worker accepts traffic: it configures
+the mappers, builds the specification, opens WARMUP_CONNECTIONS pooled
+connections to every database and sends one cart read through the whole
+request stack.
+
+Two probes are served outside of the API:
+
+* GET /health/live answers as long as the worker can handle a request and
+  never touches the database, so a slow database does not get workers
+  restarted.
+* GET /health/ready answers 200 only once the worker is warmed up and the
+  primary and every shard answer SELECT 1 within HEALTH_CHECK_TIMEOUT.
+  Results are cached for HEALTH_CHECK_INTERVAL seconds so frequent probes
+  cost at most one query per interval.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from sqlalchemy import orm, text
+from service import sharding
+
+logger = logging.getLogger("flask.app")
+
+
+class HealthCheck:
+    """The warmup state of a worker and its cached database checks"""
+
+    def __init__(self, timeout, interval):
+        self.timeout = timeout
+        self.interval = interval
+        self.warmed = False
+        self._checked_at = None
+        self._checks = {}
+        self._pending = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="health")
+
+    def check(self, app, db):
+        """Returns the status of every database, checking them when stale
+
+        A check that does not finish within the timeout is reported as
+        "timeout" and is not started again until it has finished, so a hung
+        database never piles up probe threads.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.interval:
+                return self._checks
+            if self._pending is None or self._pending.done():
+                self._pending = self._executor.submit(ping, app, db)
+            try:
+                self._checks = self._pending.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                self._checks = {name: "timeout" for name in database_names(app)}
+            self._checked_at = time.monotonic()
+            return self._checks
+
+
+def database_names(app):
+    """ Returns the names of the databases a worker needs, the primary first """
+    return ["primary"] + ["shard_{}".format(index) for index in sharding.shard_indexes(app) if index is not None]
+
+
+def _engines(app, db):
+    engines = {"primary": db.get_engine(app)}
+    for index in sharding.shard_indexes(app):
+        if index is not None:
+            engines["shard_{}".format(index)] = db.get_engine(app, bind="shard_{}".format(index))
+    return engines
+
+
+def ping(app, db):
+    """ Sends SELECT 1 to every database and returns "ok" or the error of each """
+    checks = {}
+    for name, engine in _engines(app, db).items():
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            checks[name] = "ok"
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Database %s is unavailable: %s", name, error)
+            checks[name] = type(error).__name__
+    return checks
+
+
+def warmup(app):
+    """Prepares a worker for traffic
+
+    Returns:
+        True when the worker is warmed up, False when a step failed
+    """
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+    from service.routes import api
+
+    started = time.perf_counter()
+    try:
+        orm.configure_mappers()
+        with app.test_request_context():
+            api.__schema__  # pylint: disable=pointless-statement
+        count = max(1, app.config.get("WARMUP_CONNECTIONS", 4))
+        for engine in _engines(app, db).values():
+            connections = [engine.connect() for _ in range(count)]
+            for connection in connections:
+                connection.execute(text("SELECT 1"))
+                connection.close()
+        with app.test_client() as client:
+            client.get("/shopcarts/0")
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning("Warmup failed: %s", error)
+        return False
+    app.extensions["health"].warmed = True
+    logger.info("Warmed up in %.0f ms", (time.perf_counter() - started) * 1000)
+    return True
+
+
+def readiness(app):
+    """Returns the readiness of the worker and the status of each database
+
+    A worker whose warmup failed is warmed up again once the databases
+    answer.
+    """
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    health = app.extensions["health"]
+    checks = health.check(app, db)
+    reachable = all(result == "ok" for result in checks.values())
+    if reachable and not health.warmed:
+        warmup(app)
+    return reachable and health.warmed, checks
+
+
+def init_health(app):
+    """Sets up the health state and warms the worker up when enabled
+
+    Args:
+        app (Flask): the application to warm up
+    """
+    if not app.extensions.get("health"):
+        app.extensions["health"] = HealthCheck(
+            app.config.get("HEALTH_CHECK_TIMEOUT", 2.0), app.config.get("HEALTH_CHECK_INTERVAL", 1.0)
+        )
+    if app.config.get("WARMUP_ENABLED", True):
+        warmup(app)
+    else:
+        app.extensions["health"].warmed = True
@@ -0,0 +1,107 @@
+"""
+Background Jobs
+
+Periodic maintenance jobs that run in a daemon thread inside each worker.
+Every run gets its own application context so it uses its own database
+session and never shares one with a request. Only the gunicorn workers
+start them, in the post_worker_init hook of gunicorn.conf.py, so tests,
+the flask CLI and scripts that import the service run no jobs.
+"""
+import logging
+import threading
+from service import sharding
+from service.models import CartEvent, ShopCart
+
+logger = logging.getLogger("flask.app")
+
+
+class PeriodicJob(threading.Thread):
+    """Runs a function every interval seconds until it is stopped"""
+
+    def __init__(self, app, name, interval, function):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.interval = interval
+        self.function = function
+        self._stopped = threading.Event()
+
+    def run(self):
+        logger.info("Starting job %s every %s seconds", self.name, self.interval)
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """ Runs the job one time inside of an application context """
+        with self.app.app_context():
+            try:
+                return self.function(self.app)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Job %s failed: %s", self.name, error)
+                return None
+
+    def stop(self):
+        """ Asks the job to stop after the current run """
+        self._stopped.set()
+
+
+######################################################################
+#  J O B S
+######################################################################
+def purge_expired_carts(app):
+    """Deletes the carts that have outlived CART_TTL_SECONDS
+
+    Returns:
+        the number of rows that were reclaimed
+    """
+    reclaimed = sum(sharding.fan_out(app, lambda: ShopCart.purge_expired(
+        app.config["CART_TTL_SECONDS"], app.config["PURGE_BATCH_SIZE"]
+    )))
+    logger.info("Cart purge reclaimed %d rows", reclaimed)
+    return reclaimed
+
+
+def purge_old_events(app):
+    """Deletes the outbox events older than EVENT_RETENTION_SECONDS
+
+    Returns:
+        the number of events that were deleted
+    """
+    retention = app.config["EVENT_RETENTION_SECONDS"]
+    deleted = sum(sharding.fan_out(app, lambda: CartEvent.purge(retention)))
+    logger.info("Purged %d cart events", deleted)
+    return deleted
+
+
+def archive_checked_out(app):
+    """Moves the checked out items to the archive table
+
+    Returns:
+        the number of rows that were archived
+    """
+    archived = sum(sharding.fan_out(app, lambda: ShopCart.archive_checked_out(app.config["ARCHIVE_BATCH_SIZE"])))
+    logger.info("Archived %d checked out rows", archived)
+    return archived
+
+
+def start_jobs(app):
+    """Starts the background jobs that are enabled in the app config
+
+    Returns:
+        a list of the jobs that were started
+    """
+    jobs = []
+    if app.config.get("CART_PURGE_INTERVAL", 0) > 0 and app.config.get("CART_TTL_SECONDS", 0) > 0:
+        jobs.append(
+            PeriodicJob(app, "purge-expired-carts", app.config["CART_PURGE_INTERVAL"], purge_expired_carts)
+        )
+    if app.config.get("CART_PURGE_INTERVAL", 0) > 0 and app.config.get("EVENT_RETENTION_SECONDS", 0) > 0:
+        jobs.append(
+            PeriodicJob(app, "purge-old-events", app.config["CART_PURGE_INTERVAL"], purge_old_events)
+        )
+    if app.config.get("ARCHIVE_INTERVAL", 0) > 0:
+        jobs.append(
+            PeriodicJob(app, "archive-checked-out", app.config["ARCHIVE_INTERVAL"], archive_checked_out)
+        )
+    for job in jobs:
+        job.start()
+    return jobs
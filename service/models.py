@@ -3,13 +3,44 @@ Models for ShopCart
 
 All of the models are stored in this module
 """
+import random
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, event, func, literal, or_, orm, select, text, tuple_
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from service import catalog, guards, replicas, sharding, sqlite_profile, validation
+from service.tracing import traced
 
 logger = logging.getLogger("flask.app")
 
+
+class RoutingSession(SignallingSession):
+    """Session that routes statements to a shard, a replica or the primary
+
+    Sharded tables go to the shard that owns the customer. Reads of the other
+    tables go to a replica during read-only requests, everything else goes
+    to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = sharding.engine_for(self.app, mapper, clause)
+        if engine is None and not self._flushing:
+            engine = replicas.engine_for(self.app, self)
+        if engine is not None:
+            return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions are RoutingSessions"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DatabaseConnectionError(Exception):
@@ -21,6 +52,19 @@ class DataValidationError(Exception):
     pass
 
 
+def _commit():
+    """Commits the session, or rolls it back when the commit fails
+
+    The session outlives the request when the app context is kept, so a
+    failed flush must not leave its changes behind for the next one.
+    """
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
 class ShopCart(db.Model):
     """
     Class that represents a shop cart
@@ -28,47 +72,182 @@ class ShopCart(db.Model):
 
     app = None
 
+    # Rows are partitioned and sharded by customer_id. Only the checked out
+    # items are indexed by checked_out_at: an index over every row would be
+    # picked by the planner for "checked_out_at IS NULL", the condition of
+    # every read, instead of the primary key or product_id
+    __table_args__ = (
+        db.Index(
+            "ix_shop_cart_checked_out_at", "checked_out_at",
+            postgresql_where=text("checked_out_at IS NOT NULL"), sqlite_where=text("checked_out_at IS NOT NULL"),
+        ),
+        {"info": {"sharded": True}},
+    )
+
     # Table Schema
     customer_id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128))
-    quantity = db.Column(db.Integer)
-    price = db.Column(db.Float)
+    # indexed on its own for the per-product lookups and counter rebuilds
+    product_id = db.Column(db.Integer, primary_key=True, index=True)
+    # the old value is loaded before a change, even on an expired
+    # instance, so the cart headers and the outbox see what was replaced
+    quantity = orm.column_property(db.Column(db.Integer), active_history=True)
+    last_modified = db.Column(
+        db.DateTime, nullable=False, index=True, default=datetime.utcnow, onupdate=datetime.utcnow,
+        server_default=func.current_timestamp()
+    )
+    # set by checkout, the item is hidden from every read until it is archived
+    checked_out_at = db.Column(db.DateTime)
+    # the name and price of the product at checkout, kept for the archive
+    checked_out_name = db.Column(db.String(128))
+    checked_out_price = db.Column(db.Float)
+    # the name and price of this item when they differ from its product,
+    # NULL for the items that show the ones of the catalog
+    name_override = db.Column(db.String(128))
+    price_override = db.Column(db.Float)
 
     def __repr__(self):
-        return "<ShopCart %r customer_id=[%s] product_id=[%s]>" % (self.name, 
-            self.customer_id, self.product_id)
+        return "<ShopCart customer_id=[%s] product_id=[%s]>" % (self.customer_id, self.product_id)
+
+    # The name and price belong to the product and are read through the
+    # product cache. Setting them adds the product to the catalog when the
+    # item is flushed and the product is missing. Values that differ from
+    # an existing product are kept in the overrides of this item only, so
+    # a cart never changes what the other carts holding the product show.
+    @property
+    def name(self):
+        """ The name of the product """
+        return self._product_value("name")
+
+    @name.setter
+    def name(self, value):
+        self._set_product_value("name", value)
+
+    @property
+    def price(self):
+        """ The price of the product """
+        return self._product_value("price")
+
+    @price.setter
+    def price(self, value):
+        self._set_product_value("price", value)
 
+    def _product_value(self, field):
+        changes = self.__dict__.get("_product_changes")
+        if changes and field in changes:
+            return changes[field]
+        override = getattr(self, field + "_override")
+        if override is not None:
+            return override
+        if "_product" not in self.__dict__:
+            fill_products(orm.object_session(self) or db.session, [self])
+        return self.__dict__["_product"][field]
+
+    def _set_product_value(self, field, value):
+        self.__dict__.setdefault("_product_changes", {})[field] = value
+        orm.attributes.flag_dirty(self)
+
+    @traced("ShopCart.create")
     def create(self):
         """
         Creates a ShopCart to the database
         """
         logger.info("Creating %s", self.name)
         db.session.add(self)
-        db.session.commit()
+        _commit()
 
+    @traced("ShopCart.update")
     def update(self):
         """
         Updates a ShopCart to the database
         """
         logger.info("Saving %s", self.name)
         if self.customer_id is None or self.product_id is None:
+            db.session.rollback()
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        _commit()
 
+    @traced("ShopCart.save")
     def save(self):
         """
         Updates a ShopCart to the database
         """
         logger.info("Saving %s", self.name)
-        db.session.commit()
+        _commit()
 
+    @traced("ShopCart.delete")
     def delete(self):
         """ Removes a ShopCart from the data store """
         logger.info("Deleting %s", self.name)
         db.session.delete(self)
+        _commit()
+
+    @traced("ShopCart.checkout")
+    def checkout(self):
+        """ Marks a purchased ShopCart item as checked out """
+        logger.info("Checking out %s", self.name)
+        check_out(db.session, self.customer_id, self.product_id)
         db.session.commit()
 
+    @classmethod
+    @traced("ShopCart.checkout_cart")
+    def checkout_cart(cls, customer_id):
+        """Marks every item of a purchased cart as checked out in one transaction
+
+        Returns:
+            the number of items checked out
+        """
+        logger.info("Checking out cart %s", customer_id)
+        count = check_out(db.session, customer_id)
+        db.session.commit()
+        return count
+
+    @classmethod
+    @traced("ShopCart.clear_cart")
+    def clear_cart(cls, customer_id):
+        """Deletes every item of a cart in one transaction
+
+        Returns:
+            the number of items deleted
+        """
+        logger.info("Clearing cart %s", customer_id)
+        count = clear_carts(db.session, (customer_id,))
+        db.session.commit()
+        return count
+
+    @classmethod
+    @traced("ShopCart.merge")
+    def merge(cls, source_id, customer_id, policy="sum"):
+        """Moves every item of the cart source_id into the cart of customer_id
+
+        Used when a guest signs in. The merge is one transaction on the
+        database that owns both carts, see merge_carts().
+
+        Args:
+            source_id (int): the customer id of the cart that is emptied
+            customer_id (int): the customer id of the cart that receives the items
+            policy (str): how the quantities of an item in both carts are combined
+
+        Returns:
+            the ShopCarts of customer_id after the merge
+        """
+        logger.info("Merging cart %s into cart %s with policy %s", source_id, customer_id, policy)
+        shard_map = db.get_app().extensions.get("sharding")
+        if shard_map and shard_map.index_for(source_id) != shard_map.index_for(customer_id):
+            raise DataValidationError(
+                "ShopCarts {} and {} are stored on different shards and cannot be merged".format(
+                    source_id, customer_id
+                )
+            )
+        with sharding.shard_for(customer_id):
+            try:
+                merge_carts(db.session, source_id, customer_id, policy)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return cls.list_by_customer_id(customer_id)
+
+    @traced("ShopCart.serialize")
     def serialize(self):
         """ Serializes a ShopCart into a dictionary """
         return {
@@ -79,6 +258,7 @@ class ShopCart(db.Model):
             "price": self.price
             }
 
+    @traced("ShopCart.deserialize")
     def deserialize(self, data):
         """
         Deserializes a ShopCart from a dictionary
@@ -86,51 +266,127 @@ class ShopCart(db.Model):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            self.customer_id = int(data["customer_id"])
-            self.product_id = int(data["product_id"])
-            self.name = data["name"]
-            self.quantity = int(data["quantity"])
-            self.price = float(data["price"])
-        except KeyError as error:
-            raise DataValidationError(
-                "Invalid ShopCart: missing " + error.args[0]
-            )
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid ShopCart: body of request contained bad or no data"
-            )
+        values, errors = validation.shopcart.validate(data)
+        if errors:
+            raise DataValidationError("Invalid ShopCart: " + validation.describe(errors))
+        for name, value in values.items():
+            setattr(self, name, value)
         return self
 
+    @classmethod
+    @traced("ShopCart.insert_rows")
+    def insert_rows(cls, rows, batch_size=1000):
+        """Inserts rows of column values with multi-row INSERTs
+
+        Rows are buffered per shard so every INSERT goes to a single shard.
+        The caller is responsible for the commit.
+
+        Args:
+            rows (iterable): dictionaries of column values
+            batch_size (int): the maximum number of rows per INSERT
+
+        Returns:
+            the number of rows inserted
+        """
+        shard_map = db.get_app().extensions.get("sharding")
+        buffers = {}
+        count = 0
+        for row in rows:
+            shard = shard_map.index_for(row["customer_id"]) if shard_map else None
+            buffer = buffers.setdefault(shard, [])
+            buffer.append(row)
+            count += 1
+            if len(buffer) >= batch_size:
+                cls._insert_batch(shard, buffer)
+                buffers[shard] = []
+        for shard, buffer in buffers.items():
+            if buffer:
+                cls._insert_batch(shard, buffer)
+        return count
+
+    @classmethod
+    def _insert_batch(cls, shard, rows):
+        write_products(db.session, rows, replace=False)
+        products = Product.load(db.session, list({row["product_id"] for row in rows}))
+        with sharding.shard_index(shard):
+            connection = db.session.connection(bind_arguments={"mapper": cls.__mapper__})
+            _release_checked_out(db.session, connection, [(row["customer_id"], row["product_id"]) for row in rows])
+            connection.execute(cls.__table__.insert(), [
+                dict(
+                    {name: value for name, value in row.items() if name not in PRODUCT_FIELDS},
+                    **_overrides(products.get(row["product_id"], NO_PRODUCT), row)
+                )
+                for row in rows
+            ])
+            apply_changes(db.session, [CartChange("create", None, row) for row in rows])
+
+    @classmethod
+    def bulk_create(cls, shopcarts, batch_size=1000):
+        """Creates many ShopCarts with multi-row INSERTs in one transaction
+
+        Args:
+            shopcarts (list): the ShopCarts to create
+
+        Returns:
+            the number of ShopCarts created
+        """
+        logger.info("Creating ShopCarts in bulk")
+        try:
+            count = cls.insert_rows((shopcart.serialize() for shopcart in shopcarts), batch_size)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return count
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
+        sqlite_profile.configure(app)
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.setdefault("query_cache_size", app.config.get("STATEMENT_CACHE_SIZE", 500))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+        product_cache.configure(app.config.get("PRODUCT_CACHE_SIZE", 10000), app.config.get("PRODUCT_CACHE_TTL", 60))
         db.init_app(app)
+        sharding.init_sharding(app, db)
+        replicas.init_replicas(app, db)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        db.create_all(bind=None)  # make our sqlalchemy tables on the primary
+        sharding.create_all(app, db)
 
     @classmethod
+    @traced("ShopCart.all")
     def all(cls):
         """ Returns all of the ShopCarts in the database """
         logger.info("Processing all ShopCarts")
-        return cls.query.all()
+        return cls.query.filter(cls.checked_out_at.is_(None)).all()
 
     @classmethod
+    @traced("ShopCart.find")
     def find(cls, by_id):
         """ Finds a ShopCart by it's ID """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        customer_id, product_id = by_id
+        shopcart = _lookup(cls, by_id, FIND_SHOPCART, customer_id=customer_id, product_id=product_id)
+        if shopcart is not None and shopcart.checked_out_at is None:
+            return shopcart
+        return None
 
     @classmethod
+    @traced("ShopCart.find_or_404")
     def find_or_404(cls, by_id):
         """ Find a ShopCart by it's id """
         logger.info("Processing lookup or 404 for id %s ...", by_id)
-        return cls.query.get_or_404(by_id)
+        customer_id, product_id = by_id
+        return cls.query.filter(
+            cls.customer_id == customer_id, cls.product_id == product_id, cls.checked_out_at.is_(None)
+        ).first_or_404()
 
     @classmethod
+    @traced("ShopCart.find_by_customer_id")
     def find_by_customer_id(cls, customer_id):
         """Returns all ShopCarts with the given name
 
@@ -138,9 +394,60 @@ class ShopCart(db.Model):
             name (string): the name of the ShopCarts you want to match
         """
         logger.info("Processing name query for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
-    
+        return cls.query.filter(cls.customer_id == customer_id, cls.checked_out_at.is_(None))
+
+    @classmethod
+    @traced("ShopCart.list_by_customer_id")
+    def list_by_customer_id(cls, customer_id):
+        """Returns a list of the ShopCarts of a customer
+
+        Unlike find_by_customer_id() the statement is built once, use it
+        on hot paths that only need the rows.
+        """
+        logger.info("Processing customer query for %s ...", customer_id)
+        shopcarts = db.session.execute(LIST_SHOPCARTS, {"customer_id": customer_id}).scalars().all()
+        return fill_products(db.session, shopcarts)
+
+    @classmethod
+    def priced(cls, session, price):
+        """Returns the condition of the items with a price
+
+        An item that overrides the price of its product matches its own
+        price, the others match when their product has the price.
+        """
+        table = cls.__table__
+        return or_(
+            and_(table.c.price_override.is_(None), table.c.product_id.in_(Product.ids_with_price(session, price))),
+            table.c.price_override == price,
+        )
+
+    @classmethod
+    def select_rows(cls, price_condition=None, quantity=None, product_id=None):
+        """Returns the statement behind rows(), price_condition comes from priced()"""
+        table = cls.__table__
+        statement = select(*[table.c[name] for name in ROW_COLUMNS]).where(table.c.checked_out_at.is_(None))
+        if price_condition is not None:
+            statement = statement.where(price_condition)
+        elif quantity:
+            statement = statement.where(table.c.quantity == quantity)
+        elif product_id:
+            statement = statement.where(table.c.product_id == product_id)
+        return statement
+
+    @classmethod
+    @traced("ShopCart.rows")
+    def rows(cls, price=None, quantity=None, product_id=None, **options):
+        """Returns the items as CartRows, optionally filtered like the find_by methods
+
+        Use it for large read-only lists: the columns go from the cursor
+        into one CartRow per item, without an instance in the session.
+        The options of list_rows() page and guard the query.
+        """
+        logger.info("Processing row query ...")
+        return list_rows(db.session, price, quantity, product_id, **options)
+
     @classmethod
+    @traced("ShopCart.find_by_price")
     def find_by_price(cls, price: str) -> list:
         """Returns all Shopcarts with the given price
 
@@ -149,9 +456,10 @@ class ShopCart(db.Model):
         :rtype: list
         """
         logger.info("Processing price query for %s ...", price)
-        return cls.query.filter(cls.price == price)
+        return cls.query.filter(cls.priced(db.session, price), cls.checked_out_at.is_(None))
     
     @classmethod
+    @traced("ShopCart.find_by_quantity")
     def find_by_quantity(cls, quantity: str) -> list:
         """Returns all Shopcarts with the given quantity
 
@@ -160,9 +468,10 @@ class ShopCart(db.Model):
         :rtype: list
         """
         logger.info("Processing quantity query for %s ...", quantity)
-        return cls.query.filter(cls.quantity == quantity)
+        return cls.query.filter(cls.quantity == quantity, cls.checked_out_at.is_(None))
 
     @classmethod
+    @traced("ShopCart.find_by_product_id")
     def find_by_product_id(cls, product_id: str) -> list:
         """Returns all Shopcarts with the given product_id
 
@@ -171,4 +480,1253 @@ class ShopCart(db.Model):
         :rtype: list
         """
         logger.info("Processing product_id query for %s ...", product_id)
-        return cls.query.filter(cls.product_id == product_id)
\ No newline at end of file
+        return cls.query.filter(cls.product_id == product_id, cls.checked_out_at.is_(None))
+
+    @classmethod
+    @traced("ShopCart.purge_expired")
+    def purge_expired(cls, ttl, batch_size=500):
+        """Deletes the carts that have not been modified within ttl seconds
+
+        A cart expires when the newest of its items is older than the ttl.
+        Rows are deleted in batches of at most batch_size, each one in its own
+        short transaction, so the purge never holds locks for long.
+
+        Args:
+            ttl (int): the number of seconds a cart is kept after its last change
+            batch_size (int): the maximum number of rows deleted per transaction
+
+        Returns:
+            the number of rows that were deleted
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+        logger.info("Purging carts not modified since %s ...", cutoff)
+        expired = (
+            select(cls.customer_id)
+            .where(cls.checked_out_at.is_(None))
+            .group_by(cls.customer_id)
+            .having(func.max(cls.last_modified) < cutoff)
+        )
+        table = cls.__table__
+        columns = [table.c[name] for name in ROW_COLUMNS]
+        reclaimed = 0
+        while True:
+            keys = (
+                db.session.query(cls.customer_id, cls.product_id)
+                .filter(cls.customer_id.in_(expired), cls.checked_out_at.is_(None))
+                .limit(batch_size)
+                .all()
+            )
+            if not keys:
+                break
+            conditions = [
+                tuple_(table.c.customer_id, table.c.product_id).in_([tuple(key) for key in keys]),
+                table.c.customer_id.in_(expired),
+                table.c.checked_out_at.is_(None),
+            ]
+            delete = table.delete().where(*conditions)
+            connection = db.session.connection(bind_arguments={"mapper": cls.__mapper__})
+            if connection.dialect.name == "postgresql":
+                rows = connection.execute(delete.returning(*columns)).all()
+            else:
+                rows = connection.execute(select(*columns).where(*conditions).with_for_update()).all()
+                if rows:
+                    connection.execute(delete)
+            # the headers and counters lose what the purged rows added, so
+            # concurrent writes to the same counters are kept
+            apply_changes(db.session, [CartChange("expire", values, None) for values in item_values(db.session, rows)])
+            db.session.commit()
+            reclaimed += len(rows)
+            if not rows:
+                break
+        logger.info("Purged %d expired shopcart rows", reclaimed)
+        return reclaimed
+
+    @classmethod
+    @traced("ShopCart.archive_checked_out")
+    def archive_checked_out(cls, batch_size=500):
+        """Moves the checked out items to the archive table
+
+        Rows are moved in batches of at most batch_size, each one in its own
+        short transaction. The batch is locked and rows locked by another
+        archiver are skipped, so several workers can archive at once.
+
+        Args:
+            batch_size (int): the maximum number of rows moved per transaction
+
+        Returns:
+            the number of rows that were archived
+        """
+        logger.info("Archiving checked out shopcart rows ...")
+        archived = 0
+        while True:
+            keys = (
+                db.session.query(cls.customer_id, cls.product_id)
+                .filter(cls.checked_out_at.isnot(None))
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not keys:
+                break
+            connection = db.session.connection(bind_arguments={"mapper": cls.__mapper__})
+            moved = _archive_rows(db.session, connection, tuple_(cls.customer_id, cls.product_id).in_([tuple(key) for key in keys]))
+            db.session.commit()
+            archived += moved
+            if moved == 0:
+                break
+        logger.info("Archived %d checked out shopcart rows", archived)
+        return archived
+
+
+class Cart(db.Model):
+    """
+    Class that represents the header of a customer's cart
+
+    The counts are kept up to date in the same transaction as every change
+    to the ShopCart items, so an existence check is a single primary key
+    lookup. The subtotal depends on the product prices, which change
+    independently of the cart, so it is computed when it is read.
+    """
+
+    # Headers live on the same shard as the items of the cart
+    __table_args__ = {"info": {"sharded": True}}
+
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity_total = db.Column(db.Integer, nullable=False, default=0)
+    last_modified = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+        server_default=func.current_timestamp()
+    )
+
+    def __repr__(self):
+        return "<Cart customer_id=[%s] items=[%s]>" % (self.customer_id, self.item_count)
+
+    def serialize(self, subtotal=None):
+        """Serializes a Cart header into a dictionary
+
+        Args:
+            subtotal (float): the subtotal when the caller has it, it is
+                computed with cart_subtotal() otherwise
+        """
+        if subtotal is None:
+            subtotal = cart_subtotal(db.session, self.customer_id)
+        return {
+            "customer_id": self.customer_id,
+            "item_count": self.item_count,
+            "quantity_total": self.quantity_total,
+            "subtotal": subtotal,
+        }
+
+    @classmethod
+    @traced("Cart.find")
+    def find(cls, customer_id):
+        """ Returns the header of a customer's cart, None when the cart is empty """
+        logger.info("Processing cart header lookup for %s ...", customer_id)
+        return _lookup(cls, customer_id, FIND_CART, customer_id=customer_id)
+
+    @classmethod
+    @traced("Cart.rebuild")
+    def rebuild(cls, customer_ids=None):
+        """Recomputes the headers from the ShopCart items
+
+        The caller is responsible for the commit.
+
+        Args:
+            customer_ids (list): the carts to rebuild, a list or a SELECT of
+                their ids, all of them when None
+        """
+        header, items = cls.__table__, ShopCart.__table__
+        delete = header.delete()
+        totals = select(
+            items.c.customer_id,
+            func.count(),
+            func.coalesce(func.sum(items.c.quantity), 0),
+        ).where(items.c.checked_out_at.is_(None)).group_by(items.c.customer_id)
+        if customer_ids is not None:
+            delete = delete.where(header.c.customer_id.in_(customer_ids))
+            totals = totals.where(items.c.customer_id.in_(customer_ids))
+        db.session.execute(delete, bind_arguments={"mapper": cls.__mapper__})
+        db.session.execute(
+            header.insert().from_select(["customer_id", "item_count", "quantity_total"], totals),
+            bind_arguments={"mapper": cls.__mapper__},
+        )
+
+    @classmethod
+    @traced("Cart.check")
+    def check(cls):
+        """Compares every header with the counts of its items
+
+        Returns:
+            a list of (customer_id, stored counts, actual counts) for every
+            header that is wrong or missing, the counts are None when absent
+        """
+        items = ShopCart.__table__
+        actual = {
+            row[0]: tuple(row[1:])
+            for row in db.session.execute(select(
+                items.c.customer_id,
+                func.count(),
+                func.coalesce(func.sum(items.c.quantity), 0),
+            ).where(items.c.checked_out_at.is_(None)).group_by(items.c.customer_id))
+        }
+        stored = {
+            header.customer_id: (header.item_count, header.quantity_total)
+            for header in cls.query.all()
+        }
+        mismatches = []
+        for customer_id in sorted(set(actual) | set(stored)):
+            expected, found = actual.get(customer_id), stored.get(customer_id)
+            if expected != found:
+                mismatches.append((customer_id, found, expected))
+        return mismatches
+
+    @classmethod
+    @traced("Cart.repair")
+    def repair(cls, mismatches):
+        """Adds the difference between the actual and stored counts to the headers
+
+        Unlike rebuild() the headers are only added to, so the changes other
+        transactions make to the same carts meanwhile are kept. The caller is
+        responsible for the commit.
+
+        Args:
+            mismatches (list): the result of check()
+        """
+        deltas = _mismatch_deltas(mismatches)
+        if deltas:
+            _upsert_headers(db.session.connection(bind_arguments={"mapper": cls.__mapper__}), deltas)
+
+
+class Product(db.Model):
+    """
+    Class that represents the name and price of a product
+
+    Every cart item that holds the product refers to this row, so a price
+    change is one write. The rows live on the primary and are read through
+    the product cache, see service/catalog.py.
+    """
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(128))
+    price = db.Column(db.Float)
+    last_modified = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+        server_default=func.current_timestamp()
+    )
+
+    def __repr__(self):
+        return "<Product %r product_id=[%s]>" % (self.name, self.product_id)
+
+    @classmethod
+    @traced("Product.load")
+    def load(cls, session, product_ids):
+        """ Returns a dict of the name and price of every product that exists """
+        logger.info("Loading %d products ...", len(product_ids))
+        table = cls.__table__
+        rows = session.execute(
+            select(table.c.product_id, table.c.name, table.c.price).where(table.c.product_id.in_(product_ids)),
+            bind_arguments={"mapper": cls.__mapper__},
+        )
+        return {row.product_id: {"name": row.name, "price": row.price} for row in rows}
+
+    @classmethod
+    def find_values(cls, product_id):
+        """ Returns the name and price of a product through the cache, None when it does not exist """
+        return product_values(db.session, [product_id]).get(product_id)
+
+    @classmethod
+    def write(cls, product_id, name, price):
+        """Changes the name and price of a product, adding it when it is missing
+
+        Every item that does not override them shows the new ones.
+        """
+        logger.info("Writing product %s", product_id)
+        write_products(db.session, [{"product_id": product_id, "name": name, "price": price}])
+        _commit()
+
+    @classmethod
+    @traced("Product.ids_with_price")
+    def ids_with_price(cls, session, price):
+        """ Returns the ids of the products with the given price """
+        return session.execute(
+            select(cls.product_id).where(cls.price == price), bind_arguments={"mapper": cls.__mapper__}
+        ).scalars().all()
+
+
+class ProductCounter(db.Model):
+    """
+    Class that represents one slot of the demand counter of a product
+
+    During a flash sale thousands of carts add the same product at once.
+    A single counter row per product would make every one of those
+    transactions wait for the row lock of the one before it, so each
+    product has up to PRODUCT_COUNTER_SLOTS rows and a write adds to a
+    random one. Reads sum the slots.
+    """
+
+    # Counters live on the shard of the carts they count, fan out to read
+    __table_args__ = {"info": {"sharded": True}}
+
+    product_id = db.Column(db.Integer, primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    cart_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity_total = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ProductCounter product_id=[%s] slot=[%s]>" % (self.product_id, self.slot)
+
+    @classmethod
+    @traced("ProductCounter.totals")
+    def totals(cls, product_id):
+        """ Returns the number of carts holding a product and their quantity """
+        row = db.session.query(
+            func.coalesce(func.sum(cls.cart_count), 0),
+            func.coalesce(func.sum(cls.quantity_total), 0),
+        ).filter(cls.product_id == product_id).one()
+        return int(row[0]), int(row[1])
+
+    @classmethod
+    @traced("ProductCounter.rebuild")
+    def rebuild(cls, product_ids=None):
+        """Recomputes the counters from the ShopCart items into slot 0
+
+        The caller is responsible for the commit.
+
+        Args:
+            product_ids (list): the products to rebuild, a list or a SELECT of
+                their ids, all of them when None
+        """
+        counter, items = cls.__table__, ShopCart.__table__
+        delete = counter.delete()
+        totals = select(
+            items.c.product_id,
+            literal(0),
+            func.count(),
+            func.coalesce(func.sum(items.c.quantity), 0),
+        ).where(items.c.checked_out_at.is_(None)).group_by(items.c.product_id)
+        if product_ids is not None:
+            delete = delete.where(counter.c.product_id.in_(product_ids))
+            totals = totals.where(items.c.product_id.in_(product_ids))
+        db.session.execute(delete, bind_arguments={"mapper": cls.__mapper__})
+        db.session.execute(
+            counter.insert().from_select(["product_id", "slot", "cart_count", "quantity_total"], totals),
+            bind_arguments={"mapper": cls.__mapper__},
+        )
+
+    @classmethod
+    @traced("ProductCounter.check")
+    def check(cls):
+        """Compares the sum of the slots of every product with its items
+
+        Returns:
+            a list of (product_id, stored totals, actual totals) for every
+            product whose counters are wrong, the totals are None when absent
+        """
+        items = ShopCart.__table__
+        actual = {
+            row[0]: tuple(row[1:])
+            for row in db.session.execute(select(
+                items.c.product_id,
+                func.count(),
+                func.coalesce(func.sum(items.c.quantity), 0),
+            ).where(items.c.checked_out_at.is_(None)).group_by(items.c.product_id))
+        }
+        stored = {
+            row[0]: tuple(row[1:])
+            for row in db.session.query(
+                cls.product_id, func.sum(cls.cart_count), func.sum(cls.quantity_total)
+            ).group_by(cls.product_id)
+            if any(row[1:])
+        }
+        mismatches = []
+        for product_id in sorted(set(actual) | set(stored)):
+            expected, found = actual.get(product_id), stored.get(product_id)
+            if expected != found:
+                mismatches.append((product_id, found, expected))
+        return mismatches
+
+    @classmethod
+    @traced("ProductCounter.repair")
+    def repair(cls, mismatches):
+        """Adds the difference between the actual and stored totals to the counters
+
+        The caller is responsible for the commit.
+
+        Args:
+            mismatches (list): the result of check()
+        """
+        deltas = _mismatch_deltas(mismatches)
+        if deltas:
+            connection = db.session.connection(bind_arguments={"mapper": cls.__mapper__})
+            _upsert_counters(connection, deltas, 1)
+
+
+class ShopCartArchive(db.Model):
+    """
+    Class that represents a checked out ShopCart item
+
+    Checkout only marks the items, the archiver moves them here in
+    batches, off the request path. Rows are never changed afterwards.
+    """
+
+    # Archived items stay on the shard of the cart they came from
+    __table_args__ = {"info": {"sharded": True}}
+
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(128))
+    quantity = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    checked_out_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<ShopCartArchive customer_id=[%s] product_id=[%s]>" % (self.customer_id, self.product_id)
+
+
+class CartEvent(db.Model):
+    """
+    Class that represents one entry of the cart change outbox
+
+    An event is written in the same transaction as the change it describes,
+    so the outbox never misses a committed change and never holds one that
+    was rolled back. Consumers read it with a cursor, see read_after().
+    """
+
+    # Events live on the same shard as the items they describe
+    __table_args__ = (
+        db.Index("ix_cart_event_xid_id", "xid", "id"),
+        {"info": {"sharded": True}},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # the id of the transaction that wrote the event, on PostgreSQL only
+    xid = db.Column(db.BigInteger)
+    customer_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer)
+    op = db.Column(db.String(16), nullable=False)
+    before = db.Column(db.JSON)
+    after = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<CartEvent %r id=[%s] customer_id=[%s]>" % (self.op, self.id, self.customer_id)
+
+    @classmethod
+    @traced("CartEvent.read_after")
+    def read_after(cls, position, limit, settle=0):
+        """Returns the serialized events that follow position
+
+        PostgreSQL hands out ids before commit, so a transaction can commit
+        an id below one that was already read. There the events are read in
+        (xid, id) order and only the ones written by transactions older than
+        the oldest one still running, which can no longer change. Other
+        databases commit their writes one at a time and are read in id
+        order.
+
+        Rows are read without the identity map, because every shard numbers
+        its events from 1.
+
+        Args:
+            position (tuple): the (xid, id) of the last event the consumer
+                has seen, the xid is 0 outside of PostgreSQL
+            limit (int): the maximum number of events returned
+            settle (float): outside of PostgreSQL, skip the events younger
+                than this many seconds
+
+        Returns:
+            a list of dictionaries, with the xid of every event
+        """
+        table = cls.__table__
+        last_xid, last_id = position
+        connection = db.session.connection(bind_arguments={"mapper": cls.__mapper__})
+        if connection.dialect.name == "postgresql":
+            watermark = select(func.txid_snapshot_xmin(func.txid_current_snapshot())).scalar_subquery()
+            statement = select(table).where(
+                tuple_(table.c.xid, table.c.id) > tuple_(literal(last_xid), literal(last_id)),
+                table.c.xid < watermark,
+            ).order_by(table.c.xid, table.c.id)
+        else:
+            statement = select(table).where(table.c.id > last_id).order_by(table.c.id)
+            if settle:
+                statement = statement.where(table.c.created_at <= datetime.utcnow() - timedelta(seconds=settle))
+        return [
+            dict(row._mapping, xid=row.xid or 0, created_at=row.created_at.isoformat())  # pylint: disable=protected-access
+            for row in db.session.execute(statement.limit(limit), bind_arguments={"mapper": cls.__mapper__})
+        ]
+
+    @classmethod
+    @traced("CartEvent.purge")
+    def purge(cls, retention):
+        """Deletes the events older than retention seconds
+
+        Returns:
+            the number of events that were deleted
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=retention)
+        deleted = cls.query.filter(cls.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class ReplicaHeartbeat(db.Model):
+    """
+    Class that represents the heartbeat the primary writes for its replicas
+
+    The health check of the replicas updates the single row on the primary
+    and compares the time of that commit with the last one a replica has
+    replayed, see service/replicas.py. The row makes sure there is always a
+    recent commit to compare with, even when no cart changes.
+    """
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    beat_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return "<ReplicaHeartbeat id=[%s] beat_at=[%s]>" % (self.id, self.beat_at)
+
+
+######################################################################
+#  H O T   L O O K U P S
+######################################################################
+# The statements behind almost every request are built once. A statement
+# object memoizes its cache key, so each call only binds the parameters
+# and reuses the SQL compiled in the engine's cache, where building a
+# Query every time costs a new cache key and ORM setup.
+FIND_SHOPCART = select(ShopCart).where(
+    ShopCart.customer_id == bindparam("customer_id"), ShopCart.product_id == bindparam("product_id"),
+    ShopCart.checked_out_at.is_(None),
+)
+LIST_SHOPCARTS = select(ShopCart).where(
+    ShopCart.customer_id == bindparam("customer_id"), ShopCart.checked_out_at.is_(None)
+)
+FIND_CART = select(Cart).where(Cart.customer_id == bindparam("customer_id"))
+
+
+def _lookup(model, ident, statement, **params):
+    """Returns the instance with primary key ident or None
+
+    An instance the session already holds is returned by Session.get(),
+    which also handles the ones that are expired or deleted.
+    """
+    if orm.util.identity_key(model, ident) in db.session.identity_map:
+        return db.session.get(model, ident)
+    return db.session.execute(statement, params).scalars().first()
+
+
+######################################################################
+#  R E A D   M O D E L
+######################################################################
+# An item of a large list. A namedtuple is as compact as a plain tuple,
+# so a row costs one object instead of an instance, its state and a dict.
+CartRow = namedtuple("CartRow", ["customer_id", "product_id", "name", "quantity", "price"])
+
+# the columns of an item in the shop_cart table and the ones of its product
+ITEM_COLUMNS = ("customer_id", "product_id", "quantity")
+PRODUCT_FIELDS = ("name", "price")
+# the columns of an item that hold the product values it overrides, and
+# the ones a CartRow is read from
+OVERRIDE_COLUMNS = ("name_override", "price_override")
+ROW_COLUMNS = ITEM_COLUMNS + OVERRIDE_COLUMNS
+
+
+######################################################################
+#  P R O D U C T   C A T A L O G
+######################################################################
+NO_PRODUCT = {"name": None, "price": None}
+
+product_cache = catalog.ProductCache()
+
+
+def product_values(session, product_ids):
+    """ Returns a dict of the name and price of products, through the cache """
+    return product_cache.get_many(product_ids, lambda missing: Product.load(session, missing))
+
+
+def fill_products(session, shopcarts):
+    """Loads the products of ShopCarts with one query for all cache misses
+
+    Returns:
+        the ShopCarts
+    """
+    pending = [shopcart for shopcart in shopcarts if "_product" not in shopcart.__dict__]
+    if pending:
+        values = product_values(session, {shopcart.product_id for shopcart in pending})
+        for shopcart in pending:
+            shopcart.__dict__["_product"] = values.get(shopcart.product_id, NO_PRODUCT)
+    return shopcarts
+
+
+def item_product(product, values):
+    """ Returns the name and price of an item, its overrides taking the place of its product's """
+    return {
+        name: product[name] if values.get(column) is None else values[column]
+        for name, column in zip(PRODUCT_FIELDS, OVERRIDE_COLUMNS)
+    }
+
+
+def _overrides(product, values):
+    # the overrides of an item with the name and price in values
+    return {
+        column: None if values.get(name) == product[name] else values.get(name)
+        for name, column in zip(PRODUCT_FIELDS, OVERRIDE_COLUMNS)
+    }
+
+
+def item_values(session, rows):
+    """ Returns the values of every ITEM_FIELDS for rows of the ROW_COLUMNS """
+    products = product_values(session, {row.product_id for row in rows})
+    values = []
+    for row in rows:
+        item = dict(row._mapping)
+        item.update(item_product(products.get(row.product_id, NO_PRODUCT), item))
+        for column in OVERRIDE_COLUMNS:
+            item.pop(column, None)
+        values.append(item)
+    return values
+
+
+def cart_rows(session, rows):
+    """ Returns a CartRow for every row of the ROW_COLUMNS """
+    products = product_values(session, {row[1] for row in rows})
+    cart_rows = []
+    for customer_id, product_id, quantity, name, price in rows:
+        product = products.get(product_id, NO_PRODUCT)
+        cart_rows.append(CartRow(
+            customer_id, product_id, product["name"] if name is None else name, quantity,
+            product["price"] if price is None else price,
+        ))
+    return cart_rows
+
+
+def list_rows(session, price=None, quantity=None, product_id=None, limit=None, after=None,
+              max_scan_rows=None, timeout=None):
+    """Returns the items as CartRows, filtered like the find_by methods
+
+    Args:
+        session (Session): the session whose transaction is used
+        limit (int): the maximum number of rows, ordered by customer_id
+            and product_id, all of them in no order when None
+        after (tuple): the (customer_id, product_id) the rows come after
+        max_scan_rows (int): rejects the filter when its plan scans more
+            rows, see guards.check_plan()
+        timeout (int): cancels the query after as many milliseconds
+
+    Raises:
+        QueryTooExpensive: when a guard rejects or cancels the query
+    """
+    table = ShopCart.__table__
+    price_condition = ShopCart.priced(session, price) if price else None
+    statement = ShopCart.select_rows(price_condition, quantity, product_id)
+    connection = session.connection(bind_arguments={"mapper": ShopCart.__mapper__})
+    rows = []
+    with guards.statement_timeout(connection, timeout):
+        if max_scan_rows:
+            guards.check_plan(connection, statement, max_scan_rows)
+        if after is not None:
+            statement = statement.where(tuple_(table.c.customer_id, table.c.product_id) > tuple_(*after))
+        if limit is not None:
+            statement = statement.order_by(table.c.customer_id, table.c.product_id).limit(limit)
+        result = session.execute(
+            statement, execution_options={"stream_results": True}, bind_arguments={"mapper": ShopCart.__mapper__}
+        )
+        for batch in result.partitions(1000):
+            rows.extend(cart_rows(session, batch))
+    return rows
+
+
+def cart_subtotal(session, customer_id):
+    """ Returns the sum of quantity times price of the items of a cart """
+    table = ShopCart.__table__
+    rows = session.execute(
+        select(table.c.product_id, table.c.quantity, table.c.price_override).where(
+            table.c.customer_id == customer_id, table.c.checked_out_at.is_(None)
+        ),
+        bind_arguments={"mapper": ShopCart.__mapper__},
+    ).all()
+    products = product_values(session, {row.product_id for row in rows})
+    return sum(
+        (row.quantity or 0) * (item_product(products.get(row.product_id, NO_PRODUCT), row._mapping)["price"] or 0.0)
+        for row in rows
+    )
+
+
+def write_products(session, rows, replace=True):
+    """Writes the name and price of the products in rows in the current transaction
+
+    Every item that does not override the name or price of a product shows
+    the new ones. The cache of this process is updated when the transaction
+    commits.
+
+    Args:
+        session (Session): the session whose transaction is used
+        rows (list): dictionaries with a product_id, a name and a price
+        replace (bool): whether the products that exist are changed, only
+            the missing ones are added otherwise
+    """
+    products = {row["product_id"]: {name: row.get(name) for name in PRODUCT_FIELDS} for row in rows}
+    if not products:
+        return
+    now = datetime.utcnow()
+    connection = session.connection(bind_arguments={"mapper": Product.__mapper__})
+    rows = [dict(values, product_id=product_id, last_modified=now) for product_id, values in products.items()]
+    if not replace:
+        # the products that exist keep their values, which are not known here
+        _insert_missing(connection, Product.__table__, ["product_id"], rows)
+        return
+    _upsert_add(connection, Product.__table__, ["product_id"], rows, (), ["name", "price", "last_modified"])
+    session.info.setdefault("product_writes", {}).update(products)
+
+
+######################################################################
+#  C H A N G E   T R A C K I N G
+######################################################################
+ITEM_FIELDS = CartRow._fields
+
+
+class CartChange:
+    """A change to one ShopCart item, with its values before and after"""
+
+    __slots__ = ("op", "before", "after")
+
+    def __init__(self, op, before, after):
+        self.op = op
+        self.before = before
+        self.after = after
+
+
+def _committed_values(shopcart):
+    values = {}
+    for name in ROW_COLUMNS:
+        history = orm.attributes.get_history(shopcart, name)
+        if history.deleted:
+            values[name] = history.deleted[0]
+        elif history.unchanged:
+            values[name] = history.unchanged[0]
+        else:
+            values[name] = getattr(shopcart, name)
+    values.update(item_product(shopcart.__dict__["_product"], values))
+    for column in OVERRIDE_COLUMNS:
+        del values[column]
+    return values
+
+
+def _current_values(shopcart):
+    return {name: getattr(shopcart, name) for name in ITEM_FIELDS}
+
+
+def capture_changes(session):
+    """Returns a CartChange for every ShopCart the session is about to flush"""
+    changes = []
+    fill_products(session, [
+        shopcart for shopcart in list(session.dirty) + list(session.deleted) if isinstance(shopcart, ShopCart)
+    ])
+    for shopcart in session.new:
+        if isinstance(shopcart, ShopCart):
+            changes.append(CartChange("create", None, _current_values(shopcart)))
+    for shopcart in session.dirty:
+        if isinstance(shopcart, ShopCart) and (
+            session.is_modified(shopcart, include_collections=False) or shopcart.__dict__.get("_product_changes")
+        ):
+            changes.append(CartChange("update", _committed_values(shopcart), _current_values(shopcart)))
+    for shopcart in session.deleted:
+        if isinstance(shopcart, ShopCart):
+            changes.append(CartChange("delete", _committed_values(shopcart), None))
+    return changes
+
+
+def _header_deltas(changes):
+    deltas = {}
+    for change in changes:
+        for values, sign in ((change.before, -1), (change.after, 1)):
+            if values is None:
+                continue
+            items, quantity_total = deltas.get(values["customer_id"], (0, 0))
+            deltas[values["customer_id"]] = (items + sign, quantity_total + sign * (values["quantity"] or 0))
+    return {customer_id: delta for customer_id, delta in deltas.items() if any(delta)}
+
+
+def _product_deltas(changes):
+    deltas = {}
+    for change in changes:
+        for values, sign in ((change.before, -1), (change.after, 1)):
+            if values is None or values.get("product_id") is None:
+                continue
+            carts, quantity_total = deltas.get(values["product_id"], (0, 0))
+            deltas[values["product_id"]] = (carts + sign, quantity_total + sign * (values.get("quantity") or 0))
+    return {product_id: delta for product_id, delta in deltas.items() if any(delta)}
+
+
+def _mismatch_deltas(mismatches):
+    deltas = {}
+    for key, found, expected in mismatches:
+        found, expected = found or (0, 0), expected or (0, 0)
+        deltas[key] = (expected[0] - found[0], expected[1] - found[1])
+    return deltas
+
+
+def _upsert_add(connection, table, keys, rows, added, replaced=()):
+    """Adds the values of the added columns to the rows with the same keys
+
+    Rows that do not exist yet are inserted. The rows are written in key
+    order, so concurrent transactions lock them in the same order and
+    cannot deadlock each other.
+    """
+    rows = sorted(rows, key=lambda row: tuple(row[key] for key in keys))
+    if connection.dialect.name in ("postgresql", "sqlite"):
+        if connection.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert  # pylint: disable=import-outside-toplevel
+        else:
+            from sqlalchemy.dialects.sqlite import insert  # pylint: disable=import-outside-toplevel
+        statement = insert(table)
+        values = {name: table.c[name] + statement.excluded[name] for name in added}
+        values.update({name: statement.excluded[name] for name in replaced})
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys], set_=values,
+        ), rows)
+    else:
+        for row in rows:
+            values = {name: table.c[name] + row[name] for name in added}
+            values.update({name: row[name] for name in replaced})
+            updated = connection.execute(table.update().where(
+                *[table.c[key] == row[key] for key in keys]
+            ).values(**values))
+            if updated.rowcount == 0:
+                connection.execute(table.insert(), row)
+
+
+def _insert_missing(connection, table, keys, rows):
+    """ Inserts the rows whose keys do not exist yet, in key order """
+    rows = sorted(rows, key=lambda row: tuple(row[key] for key in keys))
+    if connection.dialect.name in ("postgresql", "sqlite"):
+        if connection.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert  # pylint: disable=import-outside-toplevel
+        else:
+            from sqlalchemy.dialects.sqlite import insert  # pylint: disable=import-outside-toplevel
+        connection.execute(insert(table).on_conflict_do_nothing(index_elements=[table.c[key] for key in keys]), rows)
+    else:
+        for row in rows:
+            if connection.execute(
+                select(*[table.c[key] for key in keys]).where(*[table.c[key] == row[key] for key in keys])
+            ).first() is None:
+                connection.execute(table.insert(), row)
+
+
+def _upsert_headers(connection, deltas):
+    header = Cart.__table__
+    now = datetime.utcnow()
+    _upsert_add(connection, header, ["customer_id"], [
+        {"customer_id": customer_id, "item_count": items, "quantity_total": quantity_total, "last_modified": now}
+        for customer_id, (items, quantity_total) in deltas.items()
+    ], ["item_count", "quantity_total"], ["last_modified"])
+    # a cart without items has no header
+    connection.execute(header.delete().where(
+        header.c.customer_id.in_(list(deltas)), header.c.item_count <= 0
+    ))
+
+
+def _upsert_counters(connection, deltas, slots):
+    _upsert_add(connection, ProductCounter.__table__, ["product_id", "slot"], [
+        {"product_id": product_id, "slot": random.randrange(slots),
+         "cart_count": carts, "quantity_total": quantity_total}
+        for product_id, (carts, quantity_total) in deltas.items()
+    ], ["cart_count", "quantity_total"])
+
+
+######################################################################
+#  C H E C K O U T   A N D   A R C H I V E
+######################################################################
+def _forget_items(session, customer_ids, product_id=None, expunge=False):
+    """Expires or expunges the ShopCarts of customer_ids a session holds"""
+    for state in list(session.identity_map.all_states()):
+        customer_id, item_id = state.identity
+        if state.class_ is not ShopCart or customer_id not in customer_ids or state.obj() is None:
+            continue
+        if product_id is None or item_id == product_id:
+            if expunge:
+                session.expunge(state.obj())
+            else:
+                session.expire(state.obj())
+
+
+def check_out(session, customer_id, product_id=None):
+    """Marks the items of a cart, or one of them, as checked out
+
+    The items are locked and marked with one executemany UPDATE, which
+    also keeps the name and price the product has at checkout. They are
+    hidden from every read and moved to the archive later by
+    ShopCart.archive_checked_out(). The headers, product counters and
+    outbox are updated in the same transaction with the op "checkout". The
+    caller is responsible for the commit.
+
+    Returns:
+        the number of items checked out
+    """
+    table = ShopCart.__table__
+    columns = [table.c[name] for name in ROW_COLUMNS]
+    conditions = [table.c.customer_id == customer_id, table.c.checked_out_at.is_(None)]
+    if product_id is not None:
+        conditions.append(table.c.product_id == product_id)
+    connection = session.connection(bind_arguments={"mapper": ShopCart.__mapper__})
+    rows = connection.execute(
+        select(*columns).where(*conditions).order_by(table.c.product_id).with_for_update()
+    ).all()
+    values = item_values(session, rows)
+    if rows:
+        now = datetime.utcnow()
+        connection.execute(
+            table.update().where(
+                table.c.customer_id == bindparam("key_customer_id"), table.c.product_id == bindparam("key_product_id")
+            ).values(checked_out_at=now, checked_out_name=bindparam("name"), checked_out_price=bindparam("price")),
+            [
+                {"key_customer_id": item["customer_id"], "key_product_id": item["product_id"],
+                 "name": item["name"], "price": item["price"]}
+                for item in values
+            ],
+        )
+    apply_changes(session, [CartChange("checkout", item, None) for item in values])
+    _forget_items(session, (customer_id,), product_id, expunge=True)
+    return len(rows)
+
+
+def clear_carts(session, customer_ids):
+    """Deletes every item of the carts of customer_ids
+
+    The items of all of the carts are removed with one DELETE and the
+    headers, product counters and outbox are updated in the same
+    transaction with the op "delete". The caller is responsible for the
+    commit and, when sharding, for routing to the shard of the carts.
+
+    Returns:
+        the number of items deleted
+    """
+    table = ShopCart.__table__
+    columns = [table.c[name] for name in ROW_COLUMNS]
+    conditions = [table.c.customer_id.in_(list(customer_ids)), table.c.checked_out_at.is_(None)]
+    delete = table.delete().where(*conditions)
+    connection = session.connection(bind_arguments={"mapper": ShopCart.__mapper__})
+    if connection.dialect.name == "postgresql":
+        rows = connection.execute(delete.returning(*columns)).all()
+    else:
+        rows = connection.execute(select(*columns).where(*conditions).with_for_update()).all()
+        if rows:
+            connection.execute(delete)
+    apply_changes(session, [CartChange("delete", values, None) for values in item_values(session, rows)])
+    _forget_items(session, set(customer_ids), expunge=True)
+    return len(rows)
+
+
+def _archive_rows(session, connection, condition):
+    """Moves the checked out items that match condition to the archive
+
+    The archive keeps the name and price the product had at checkout.
+    Items checked out before those were kept get the ones the catalog
+    holds when they are archived.
+
+    Returns:
+        the number of rows moved
+    """
+    table, archive = ShopCart.__table__, ShopCartArchive.__table__
+    condition = and_(condition, table.c.checked_out_at.isnot(None))
+    rows = connection.execute(select(
+        *[table.c[name] for name in ROW_COLUMNS], table.c.checked_out_at,
+        table.c.checked_out_name, table.c.checked_out_price,
+    ).where(condition)).all()
+    if not rows:
+        return 0
+    now = datetime.utcnow()
+    items = []
+    for values in item_values(session, rows):
+        name, price = values.pop("checked_out_name"), values.pop("checked_out_price")
+        if name is not None or price is not None:
+            values.update(name=name, price=price)
+        items.append(dict(values, archived_at=now))
+    connection.execute(archive.insert(), items)
+    return connection.execute(table.delete().where(condition)).rowcount
+
+
+def _release_checked_out(session, connection, keys):
+    """Archives the checked out items that hold keys, before new items take them
+
+    A customer can add a product again right after checking it out, while
+    the old item still waits for the archiver under the same primary key.
+
+    Args:
+        keys (list): (customer_id, product_id) tuples, or a SELECT of them
+    """
+    if isinstance(keys, (list, tuple)) and not keys:
+        return
+    table = ShopCart.__table__
+    taken = tuple_(table.c.customer_id, table.c.product_id).in_(keys)
+    if connection.execute(
+        select(table.c.customer_id).where(taken, table.c.checked_out_at.isnot(None)).limit(1)
+    ).first() is not None:
+        _archive_rows(session, connection, taken)
+
+
+######################################################################
+#  C A R T   M E R G E
+######################################################################
+MERGE_POLICIES = ("sum", "newest", "max")
+
+
+def _item_columns(values):
+    return {name: values[name] for name in ITEM_COLUMNS}
+
+
+def _merged_item(policy, source, target):
+    """Returns the quantity of an item held by both carts after a merge"""
+    if policy == "sum":
+        return (source["quantity"] or 0) + (target["quantity"] or 0)
+    if policy == "max":
+        return max(source["quantity"] or 0, target["quantity"] or 0)
+    newest = source if source["last_modified"] > target["last_modified"] else target
+    return newest["quantity"]
+
+
+def merge_carts(session, source_id, customer_id, policy="sum"):
+    """Merges the cart source_id into the cart of customer_id
+
+    Both carts are read with one locking SELECT, then the merged items are
+    written with one multi-row upsert and the source items are removed with
+    one DELETE, so the number of statements does not grow with the size of
+    the carts. The headers, product counters and outbox are updated in the
+    same transaction with the op "merge". The caller is responsible for the
+    commit and, when sharding, for routing to the shard of both carts.
+
+    Args:
+        session (Session): the session whose transaction is used
+        source_id (int): the customer id of the cart that is emptied
+        customer_id (int): the customer id of the cart that receives the items
+        policy (str): "sum" adds the quantities of an item in both carts,
+            "max" keeps the larger one and "newest" keeps the item that was
+            changed last
+
+    Returns:
+        the number of items moved or combined into the cart of customer_id
+    """
+    if policy not in MERGE_POLICIES:
+        raise DataValidationError("Merge policy must be one of {}".format(", ".join(MERGE_POLICIES)))
+    if source_id == customer_id:
+        raise DataValidationError("A ShopCart cannot be merged into itself")
+    table = ShopCart.__table__
+    connection = session.connection(bind_arguments={"mapper": ShopCart.__mapper__})
+    items = {source_id: {}, customer_id: {}}
+    for row in connection.execute(
+        select(table).where(table.c.customer_id.in_([source_id, customer_id]), table.c.checked_out_at.is_(None))
+        .order_by(table.c.customer_id, table.c.product_id).with_for_update()
+    ).mappings():
+        items[row["customer_id"]][row["product_id"]] = dict(row)
+    if not items[source_id]:
+        return 0
+
+    now = datetime.utcnow()
+    products = product_values(session, items[source_id])
+    rows, changes = [], []
+    for product_id, source in items[source_id].items():
+        target = items[customer_id].get(product_id)
+        quantity = source["quantity"] if target is None else _merged_item(policy, source, target)
+        # the item changed last keeps its name and price
+        kept = source if target is None or source["last_modified"] > target["last_modified"] else target
+        row = {"customer_id": customer_id, "product_id": product_id, "quantity": quantity, "last_modified": now}
+        row.update({column: kept[column] for column in OVERRIDE_COLUMNS})
+        rows.append(row)
+        product = products.get(product_id, NO_PRODUCT)
+        changes.append(CartChange("merge", dict(_item_columns(source), **item_product(product, source)), None))
+        changes.append(CartChange(
+            "merge", None if target is None else dict(_item_columns(target), **item_product(product, target)),
+            dict(_item_columns(row), **item_product(product, row))
+        ))
+    _release_checked_out(session, connection, [
+        (customer_id, product_id) for product_id in items[source_id] if product_id not in items[customer_id]
+    ])
+    _upsert_add(
+        connection, table, ["customer_id", "product_id"], rows, (), ("quantity", "last_modified") + OVERRIDE_COLUMNS
+    )
+    connection.execute(table.delete().where(table.c.customer_id == source_id, table.c.checked_out_at.is_(None)))
+    apply_changes(session, changes)
+    # ShopCarts loaded before the merge are refreshed on their next access
+    _forget_items(session, (source_id,), expunge=True)
+    _forget_items(session, (customer_id,))
+    return len(rows)
+
+
+def record_events(session, changes):
+    """Writes CartChanges to the outbox in the current transaction"""
+    if not changes:
+        return
+    now = datetime.utcnow()
+    connection = session.connection(bind_arguments={"mapper": CartEvent.__mapper__})
+    insert = CartEvent.__table__.insert()
+    if connection.dialect.name == "postgresql":
+        insert = insert.values(xid=func.txid_current())
+    connection.execute(insert, [
+        {
+            "customer_id": (change.after or change.before)["customer_id"],
+            "product_id": (change.after or change.before).get("product_id"),
+            "op": change.op,
+            "before": change.before,
+            "after": change.after,
+            "created_at": now,
+        }
+        for change in changes
+    ])
+
+
+def apply_changes(session, changes):
+    """Applies CartChanges to the cart headers, the product counters and the outbox
+
+    All of them are written in the current transaction of session. The
+    number of counter slots comes from session.info["product_counter_slots"]
+    when it is set, from PRODUCT_COUNTER_SLOTS otherwise.
+
+    Args:
+        session (Session): the session whose transaction is used
+        changes (list): the CartChanges, usually from capture_changes()
+    """
+    deltas = _header_deltas(changes)
+    if deltas:
+        connection = session.connection(bind_arguments={"mapper": Cart.__mapper__})
+        _upsert_headers(connection, deltas)
+    deltas = _product_deltas(changes)
+    if deltas:
+        connection = session.connection(bind_arguments={"mapper": ProductCounter.__mapper__})
+        slots = session.info.get("product_counter_slots") or db.get_app().config.get("PRODUCT_COUNTER_SLOTS", 16)
+        _upsert_counters(connection, deltas, max(1, slots))
+    record_events(session, changes)
+
+
+def _capture_changes(session, flush_context, instances):
+    # pylint: disable=unused-argument
+    # replaces the changes of an earlier flush that failed
+    session.info["cart_changes"] = capture_changes(session)
+
+
+def _apply_changes(session, flush_context):
+    # pylint: disable=unused-argument
+    changes = session.info.pop("cart_changes", None)
+    if changes:
+        apply_changes(session, changes)
+
+
+def _release_new_items(session, flush_context, instances):
+    # pylint: disable=unused-argument
+    keys = [(shopcart.customer_id, shopcart.product_id) for shopcart in session.new if isinstance(shopcart, ShopCart)]
+    if keys:
+        _release_checked_out(session, session.connection(bind_arguments={"mapper": ShopCart.__mapper__}), keys)
+
+
+def _write_products(session, flush_context, instances):
+    # pylint: disable=unused-argument
+    shopcarts = [
+        shopcart for shopcart in list(session.new) + list(session.dirty)
+        if isinstance(shopcart, ShopCart) and shopcart.__dict__.get("_product_changes")
+    ]
+    fill_products(session, shopcarts)
+    missing = {
+        shopcart.product_id: dict(NO_PRODUCT, product_id=shopcart.product_id, **shopcart.__dict__["_product_changes"])
+        for shopcart in shopcarts if shopcart.__dict__["_product"] is NO_PRODUCT
+    }
+    if missing:
+        write_products(session, list(missing.values()), replace=False)
+        # read them back, another transaction may have added one first
+        products = Product.load(session, list(missing))
+        session.info.setdefault("product_writes", {}).update(products)
+        for shopcart in shopcarts:
+            if shopcart.product_id in products:
+                shopcart.__dict__["_product"] = products[shopcart.product_id]
+    for shopcart in shopcarts:
+        product, changes = shopcart.__dict__["_product"], shopcart.__dict__["_product_changes"]
+        for name, column in zip(PRODUCT_FIELDS, OVERRIDE_COLUMNS):
+            if name in changes:
+                setattr(shopcart, column, None if changes[name] == product[name] else changes[name])
+    session.info.setdefault("product_flushed", []).extend(shopcarts)
+
+
+def _keep_products(session, flush_context):
+    # pylint: disable=unused-argument
+    for shopcart in session.info.pop("product_flushed", ()):
+        shopcart.__dict__.pop("_product_changes", None)
+
+
+def _cache_products(session):
+    writes = session.info.pop("product_writes", None)
+    if writes:
+        product_cache.put(writes)
+
+
+def _discard_products(session):
+    session.info.pop("product_writes", None)
+    session.info.pop("product_flushed", None)
+
+
+def track_changes(session_class):
+    """Keeps the cart headers, product counters and outbox of a session class
+
+    New items also take the keys of checked out items that were not
+    archived yet. The products of the names and prices set on ShopCarts
+    are added to the product table when they are missing and, once
+    committed, to the cache, the values that differ from an existing
+    product go to the overrides of the item.
+
+    Args:
+        session_class (type): a Session subclass whose flushes are tracked
+    """
+    event.listen(session_class, "before_flush", _capture_changes)
+    event.listen(session_class, "before_flush", _release_new_items)
+    event.listen(session_class, "before_flush", _write_products)
+    event.listen(session_class, "after_flush", _apply_changes)
+    event.listen(session_class, "after_flush", _keep_products)
+    event.listen(session_class, "after_commit", _cache_products)
+    event.listen(session_class, "after_rollback", _discard_products)
+
+
+track_changes(RoutingSession)
+
+
+@event.listens_for(ShopCart, "expire")
+def _expire_product(shopcart, attrs):
+    # expired ShopCarts drop their pending product changes, like their
+    # columns, and read their product through the cache again
+    if attrs is None:
+        shopcart.__dict__.pop("_product", None)
+        shopcart.__dict__.pop("_product_changes", None)
+
+
+@event.listens_for(Product.__table__, "after_drop")
+def _drop_products(target, connection, **kw):
+    # pylint: disable=unused-argument
+    product_cache.clear()
+
+
+def reset_db():
+    """Deletes every row of every table in one transaction per database
+
+    PostgreSQL uses a single TRUNCATE, other databases delete the rows of
+    each table, which SQLite turns into a truncate as well.
+    """
+    logger.info("Resetting the database")
+    tables = db.Model.metadata.sorted_tables
+    if db.get_app().extensions.get("sharding"):
+        for index in sharding.shard_indexes(db.get_app()):
+            with sharding.shard_index(index):
+                _truncate(sharding.sharded_tables(db))
+        tables = [table for table in tables if not table.info.get("sharded")]
+    _truncate(tables)
+    db.session.commit()
+    product_cache.clear()
+
+
+def _truncate(tables):
+    if not tables:
+        return
+    connection = db.session.connection(bind_arguments={"clause": tables[0].select()})
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("TRUNCATE TABLE {} RESTART IDENTITY".format(
+            ", ".join(connection.dialect.identifier_preparer.format_table(table) for table in tables)
+        )))
+    else:
+        for table in reversed(tables):
+            connection.execute(table.delete())
@@ -0,0 +1,198 @@
+"""
+Sampling Profiler
+
+Shows what a live worker spends its time on without restarting it or
+installing anything in it:
+
+* a sampler thread reads the stack of every other thread of the worker
+  with sys._current_frames() every PROFILER_INTERVAL seconds, so the
+  request threads run unchanged between two samples
+* the samples are counted in the collapsed stack format, one line per
+  distinct stack with its frames from the root separated by ";" and the
+  number of samples, which flamegraph.pl, inferno and speedscope read
+* with memory=true, tracemalloc records allocations during the
+  run and the snapshot taken at its end lists the lines that hold the
+  most of the memory allocated since it started
+
+The profile runs in the background, POST /admin/profile starts it and
+GET /admin/profile returns it once it is done, so a worker with a single
+thread keeps serving the requests that are profiled. Every worker
+profiles itself and keeps only its last profile.
+
+Sampling every 10 ms costs the sampler under a percent of a CPU, the
+profile reports it as sampler_cpu_seconds. tracemalloc can make code that
+allocates a lot several times slower while it runs, so memory profiles
+are only taken when asked for and should be kept short.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+from collections import Counter
+
+logger = logging.getLogger("flask.app")
+
+# the lines holding the most memory listed in the allocation snapshot
+TOP_ALLOCATIONS = 25
+
+
+class ProfilerBusy(Exception):
+    """ Used when a profile is started while another one runs """
+
+
+class Profiler:
+    """Samples the stacks of the threads of this process in the background"""
+
+    def __init__(self, interval=0.01, max_seconds=60.0):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.result = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._labels = {}
+
+    @property
+    def running(self):
+        """ True while a profile is being taken """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=None, memory=False):
+        """Starts a profile of seconds in a background thread
+
+        Args:
+            seconds (float): how long to sample, at most max_seconds
+            interval (float): seconds between two samples
+            memory (bool): whether to snapshot the allocations as well
+
+        Raises:
+            ProfilerBusy: when a profile is already running
+        """
+        seconds = min(seconds, self.max_seconds)
+        interval = interval or self.interval
+        with self._lock:
+            if self.running:
+                raise ProfilerBusy("A profile is already running")
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(seconds, interval, memory), name="profiler", daemon=True
+            )
+            self._thread.start()
+        logger.info("Profiling for %.1fs every %.3fs%s", seconds, interval, " with memory" if memory else "")
+        return {"status": "running", "seconds": seconds, "interval": interval, "memory": memory}
+
+    def stop(self):
+        """ Ends a running profile early and waits for its result """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = "{} ({}:{})".format(code.co_name, short_path(code.co_filename), code.co_firstlineno)
+            self._labels[code] = label
+        return label
+
+    def _run(self, seconds, interval, memory):
+        began_at = datetime.now(timezone.utc)
+        traced = memory and not tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.start()
+        try:
+            stacks, samples, cpu, wall = self._sample(seconds, interval)
+            result = {
+                "pid": os.getpid(),
+                "started_at": began_at.isoformat(timespec="seconds"),
+                "seconds": round(wall, 3),
+                "interval": interval,
+                "samples": samples,
+                "sampler_cpu_seconds": round(cpu, 4),
+                "collapsed": self._collapse(stacks),
+                "memory": allocation_snapshot() if memory else None,
+            }
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("The profile failed")
+            result = {"pid": os.getpid(), "started_at": began_at.isoformat(timespec="seconds"), "error": str(error)}
+        finally:
+            if traced:
+                tracemalloc.stop()
+        self.result = result
+        logger.info("Profile done: %d samples", result.get("samples", 0))
+
+    def _sample(self, seconds, interval):
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        began, cpu_began = time.monotonic(), time.thread_time()
+        deadline = began + seconds
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == me:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                stacks[(names.get(ident, str(ident)), tuple(codes))] += 1
+            samples += 1
+        return stacks, samples, time.thread_time() - cpu_began, time.monotonic() - began
+
+    def _collapse(self, stacks):
+        lines = []
+        for (name, codes), count in stacks.most_common():
+            frames = [name.replace(";", ":").replace(" ", "_")]
+            frames.extend(self._label(code) for code in reversed(codes))
+            lines.append("{} {}".format(";".join(frames), count))
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def short_path(filename):
+    """ Returns a file name relative to the longest sys.path entry holding it """
+    best = ""
+    for entry in sys.path:
+        if entry and filename.startswith(entry + os.sep) and len(entry) > len(best):
+            best = entry
+    return filename[len(best) + 1:] if best else filename
+
+
+def allocation_snapshot():
+    """ Returns the memory traced by tracemalloc and the lines holding the most of it """
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+    return {
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {"file": short_path(statistic.traceback[0].filename), "line": statistic.traceback[0].lineno,
+             "size_bytes": statistic.size, "count": statistic.count}
+            for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+        ],
+    }
+
+
+def init_profiler(app):
+    """Creates the profiler of the worker when PROFILER_ENABLED is set
+
+    Args:
+        app (Flask): the application to profile
+    """
+    if not app.config.get("PROFILER_ENABLED"):
+        app.extensions["profiler"] = None
+        return
+    if not app.config.get("ADMIN_API_KEY"):
+        logger.warning("PROFILER_ENABLED is set without an ADMIN_API_KEY, the profiler stays off")
+        app.extensions["profiler"] = None
+        return
+    if not app.extensions.get("profiler"):
+        app.extensions["profiler"] = Profiler(
+            app.config.get("PROFILER_INTERVAL", 0.01), app.config.get("PROFILER_MAX_SECONDS", 60.0)
+        )
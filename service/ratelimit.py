@@ -0,0 +1,300 @@
+"""
+Rate Limiting and Admission Control
+
+Protects a worker from a few misbehaving clients before any database work
+is done for their requests.
+
+* Admission control: at most MAX_CONCURRENT_REQUESTS requests are served at
+  once. A request that cannot get a slot within ADMISSION_TIMEOUT seconds
+  is shed with 503 Service Unavailable.
+* Rate limiting: every request takes tokens from a token bucket for its
+  client address and, on the /shopcarts/{customer_id} paths, from a bucket
+  for the customer. An empty bucket answers 429 Too Many Requests with a
+  Retry-After header. Listing every cart costs RATE_LIMIT_LIST_COST tokens.
+  A request is only charged when both buckets have the tokens.
+* Behind a load balancer or a router, set TRUSTED_PROXY_HOPS to the number
+  of proxies in front of the service so the client address is read from
+  X-Forwarded-For. Without it every client shares the bucket of the proxy.
+
+Buckets live in memory by default, so each worker enforces its own limits.
+Set RATE_LIMIT_BACKEND to "redis" to share them between workers through
+RATE_LIMIT_REDIS_URL.
+"""
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from flask import current_app, request, g
+from werkzeug.middleware.proxy_fix import ProxyFix
+from service import status
+
+logger = logging.getLogger("flask.app")
+
+# Refills the buckets stored in Redis hashes and takes tokens from every one
+# of them in one step, or from none when one of them is short
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local allowed = 1
+local wait = 0
+local buckets = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if tokens < cost then
+        allowed = 0
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+    buckets[i] = {tokens, rate, capacity, cost}
+end
+for i, key in ipairs(KEYS) do
+    local tokens, rate, capacity, cost = unpack(buckets[i])
+    if allowed == 1 then
+        tokens = tokens - cost
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'updated', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+end
+return {allowed, tostring(wait)}
+"""
+
+
+def take(tokens, updated, now, rate, capacity, cost):
+    """Refills a token bucket and tries to take cost tokens from it
+
+    Returns:
+        an (allowed, seconds to wait, tokens left) tuple
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return True, 0.0, tokens - cost
+    return False, (cost - tokens) / rate, tokens
+
+
+######################################################################
+#  B A C K E N D S
+######################################################################
+class MemoryBackend:
+    """Token buckets held in this process
+
+    At most max_keys buckets are kept. When a new key arrives at the limit
+    the buckets that have refilled are dropped first, then the ones used
+    least recently, so a flood of new keys never resets the busy buckets.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity, cost=1):
+        """ Takes cost tokens from the bucket for key, returns (allowed, retry after) """
+        return self.consume_all([(key, rate, capacity, cost)])
+
+    def consume_all(self, buckets):
+        """Takes tokens from every bucket, or from none when one is short
+
+        Args:
+            buckets (list): (key, rate, capacity, cost) tuples
+
+        Returns:
+            an (allowed, retry after) tuple
+        """
+        now = time.monotonic()
+        with self._lock:
+            taken = []
+            for key, rate, capacity, cost in buckets:
+                tokens, updated, _, _ = self._buckets.get(key, (capacity, now, rate, capacity))
+                taken.append(take(tokens, updated, now, rate, capacity, cost))
+            allowed = all(ok for ok, _, _ in taken)
+            for (key, rate, capacity, cost), (ok, _, tokens) in zip(buckets, taken):
+                if ok and not allowed:
+                    tokens += cost  # give back what the short bucket did not let through
+                if len(self._buckets) >= self.max_keys and key not in self._buckets:
+                    self._evict(now)
+                self._buckets[key] = (tokens, now, rate, capacity)
+                self._buckets.move_to_end(key)
+        return allowed, max(wait for _, wait, _ in taken)
+
+    def _evict(self, now):
+        # forget the buckets that have refilled, they behave like new ones
+        for key, (tokens, updated, rate, capacity) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= capacity:
+                del self._buckets[key]
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.popitem(last=False)
+
+
+class RedisBackend:
+    """Token buckets shared by every worker through Redis
+
+    Args:
+        client: a redis.Redis client, or anything with the same eval() method
+        prefix (string): the prefix of the bucket keys
+    """
+
+    def __init__(self, client, prefix="shopcart:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        """ Connects to the Redis server at url """
+        import redis  # pylint: disable=import-outside-toplevel
+        return cls(redis.Redis.from_url(url))
+
+    def consume(self, key, rate, capacity, cost=1):
+        """ Takes cost tokens from the bucket for key, returns (allowed, retry after) """
+        return self.consume_all([(key, rate, capacity, cost)])
+
+    def consume_all(self, buckets):
+        """Takes tokens from every bucket, or from none when one is short
+
+        Args:
+            buckets (list): (key, rate, capacity, cost) tuples
+
+        Returns:
+            an (allowed, retry after) tuple
+        """
+        keys = [self.prefix + key for key, _, _, _ in buckets]
+        args = [time.time()]
+        for _, rate, capacity, cost in buckets:
+            args.extend((rate, capacity, cost))
+        allowed, wait = self.client.eval(TOKEN_BUCKET_SCRIPT, len(keys), *keys, *args)
+        return bool(int(allowed)), float(wait)
+
+
+######################################################################
+#  L I M I T E R
+######################################################################
+class Limiter:
+    """The rate limits and the concurrency limit of one application"""
+
+    def __init__(self, config, backend=None):
+        self.enabled = config.get("RATE_LIMIT_ENABLED", False)
+        self.customer_rate = float(config.get("CUSTOMER_RATE_LIMIT", 10))
+        self.customer_burst = float(config.get("CUSTOMER_RATE_BURST", 20))
+        self.client_rate = float(config.get("CLIENT_RATE_LIMIT", 50))
+        self.client_burst = float(config.get("CLIENT_RATE_BURST", 100))
+        self.list_cost = float(config.get("RATE_LIMIT_LIST_COST", 10))
+        self.backend = backend or MemoryBackend()
+        self.max_concurrent = int(config.get("MAX_CONCURRENT_REQUESTS", 0))
+        self.admission_timeout = float(config.get("ADMISSION_TIMEOUT", 0))
+        self._slots = threading.BoundedSemaphore(self.max_concurrent) if self.max_concurrent else None
+
+    def admit(self):
+        """ Takes a request slot, returns False when the worker is saturated """
+        if self._slots is None:
+            return True
+        if self.admission_timeout > 0:
+            return self._slots.acquire(timeout=self.admission_timeout)
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        """ Gives back a request slot """
+        if self._slots is not None:
+            self._slots.release()
+
+    def check(self, client, customer_id=None, cost=1):
+        """Takes tokens for a request
+
+        The tokens are taken from the client and the customer bucket at once,
+        a request that one of them rejects costs the other one nothing.
+
+        Returns:
+            0 when the request is allowed, otherwise the seconds to wait
+        """
+        buckets = [("client:{}".format(client), self.client_rate, self.client_burst, min(cost, self.client_burst))]
+        if customer_id is not None:
+            buckets.append((
+                "customer:{}".format(customer_id), self.customer_rate, self.customer_burst,
+                min(cost, self.customer_burst)
+            ))
+        try:
+            allowed, wait = self.backend.consume_all(buckets)
+        except Exception as error:  # pylint: disable=broad-except
+            # never reject requests because the shared backend is down
+            logger.warning("Rate limit backend failed: %s", error)
+            return 0
+        return 0 if allowed else wait
+
+
+def create_backend(config):
+    """ Returns the token bucket backend selected by RATE_LIMIT_BACKEND """
+    if config.get("RATE_LIMIT_BACKEND", "memory") == "redis":
+        return RedisBackend.from_url(config.get("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0"))
+    return MemoryBackend()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _error(code, error, message, retry_after):
+    return {
+        'status_code': code,
+        'error': error,
+        'message': message
+    }, code, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def _admit_request():
+    limiter = current_app.extensions.get("ratelimit")
+    if limiter is None or request.endpoint in (None, "static", "index", "asset", "liveness", "readiness"):
+        return None
+    if not limiter.admit():
+        logger.warning("Shedding %s %s, the worker is saturated", request.method, request.path)
+        return _error(status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable",
+                      "The server is overloaded, try again later", 1)
+    g.admitted_by = limiter
+    if not limiter.enabled:
+        return None
+    customer_id = (request.view_args or {}).get("customer_id")
+    cost = limiter.list_cost if request.method == "GET" and request.endpoint == "shop_cart_collection" else 1
+    wait = limiter.check(request.remote_addr or "unknown", customer_id, cost)
+    if wait:
+        logger.warning("Rate limited %s %s from %s", request.method, request.path, request.remote_addr)
+        return _error(status.HTTP_429_TOO_MANY_REQUESTS, "Too Many Requests",
+                      "Rate limit exceeded, try again later", wait)
+    return None
+
+
+def _release_request(error=None):
+    # pylint: disable=unused-argument
+    limiter = g.pop("admitted_by", None)
+    if limiter is not None:
+        limiter.release()
+
+
+def init_ratelimit(app, backend=None):
+    """Configures rate limiting and admission control from the app config
+
+    Args:
+        app (Flask): the application to protect
+        backend: the token bucket backend, chosen from the config when None
+    """
+    enabled = app.config.get("RATE_LIMIT_ENABLED", False)
+    if enabled or app.config.get("MAX_CONCURRENT_REQUESTS", 0):
+        app.extensions["ratelimit"] = Limiter(
+            app.config, backend or (create_backend(app.config) if enabled else None)
+        )
+        logger.info("Rate limiting %s, at most %s concurrent requests",
+                    "enabled" if enabled else "disabled",
+                    app.config.get("MAX_CONCURRENT_REQUESTS", 0) or "unlimited")
+    else:
+        app.extensions["ratelimit"] = None
+
+    # the client address of a request that came through trusted proxies is
+    # the one the last of them saw in X-Forwarded-For
+    hops = int(app.config.get("TRUSTED_PROXY_HOPS", 0))
+    wsgi_app = app.wsgi_app.app if isinstance(app.wsgi_app, ProxyFix) else app.wsgi_app
+    app.wsgi_app = ProxyFix(wsgi_app, x_for=hops) if hops else wsgi_app
+
+    if not app.extensions.get("ratelimit_hooks"):
+        app.before_request(_admit_request)
+        app.teardown_request(_release_request)
+        app.extensions["ratelimit_hooks"] = True
@@ -0,0 +1,256 @@
+"""
+Read Replica Routing
+
+Sends the queries of read-only requests (GET and HEAD) to the databases
+listed in REPLICA_DATABASE_URIS, while every write and every flush goes to
+the primary. A customer that has just changed their cart is pinned to the
+primary for REPLICA_STICKY_SECONDS so they always read their own writes.
+At most REPLICA_STICKY_MAX customers are remembered, the sticky cookie
+still covers the browser of the ones that are dropped early. A request
+reads every query from the same replica, so it never sees two states.
+
+Replicas are health checked at most every REPLICA_HEALTH_INTERVAL seconds.
+On PostgreSQL the check writes a heartbeat row on the primary, and a
+replica that has not replayed the heartbeat of the check before lags by
+the age of the last transaction it replayed. An idle primary therefore
+does not make its replicas look late. A replica that cannot be reached or
+that lags the primary by more than REPLICA_MAX_LAG_SECONDS is skipped,
+and when no replica is usable the reads fall back to the primary.
+"""
+import time
+import logging
+import threading
+import itertools
+import contextvars
+from collections import OrderedDict, deque
+from flask import current_app, request, g
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+STICKY_COOKIE = "shopcart_primary_until"
+READ_ONLY_METHODS = ("GET", "HEAD")
+
+# True while the current request may read from a replica
+_read_only = contextvars.ContextVar("read_only", default=False)
+
+HEARTBEAT_QUERY = text(
+    "INSERT INTO replica_heartbeat (id, beat_at) VALUES (1, now()) "
+    "ON CONFLICT (id) DO UPDATE SET beat_at = excluded.beat_at RETURNING beat_at"
+)
+REPLAY_QUERY = text("SELECT pg_is_in_recovery(), pg_last_xact_replay_timestamp(), now()")
+
+
+class ReplicaSet:
+    """The replica binds with their health and the sticky customers"""
+
+    def __init__(self, db, uris, max_lag, sticky_seconds, health_interval, sticky_max=100000):
+        # pylint: disable=too-many-arguments
+        self.db = db
+        self.binds = ["replica_{}".format(index) for index in range(len(uris))]
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.sticky_max = sticky_max
+        self.health_interval = health_interval
+        self._health = {}
+        # customers by the time they stop being sticky, the soonest first
+        self._sticky = OrderedDict()
+        self._sticky_lock = threading.Lock()
+        self._beats = deque(maxlen=2)
+        self._lock = threading.Lock()
+        self._next = itertools.cycle(range(len(uris)))
+
+    ######################################################################
+    #  H E A L T H   C H E C K S
+    ######################################################################
+    def heartbeat(self, app):
+        """Writes a heartbeat on the primary at most every health interval
+
+        Returns:
+            the time of the heartbeat before the last one, which every
+            replica has had at least a health interval to replay, or None
+        """
+        now = time.monotonic()
+        if not self._beats or now - self._beats[-1][0] >= self.health_interval:
+            engine = self.db.get_engine(app)
+            if engine.dialect.name != "postgresql":
+                return None
+            try:
+                with engine.begin() as conn:
+                    self._beats.append((now, conn.execute(HEARTBEAT_QUERY).scalar()))
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Cannot write the replica heartbeat: %s", error)
+        return self._beats[0][1] if len(self._beats) > 1 else None
+
+    def lag(self, app, index, beat_at=None):
+        """Measures how many seconds the replica at index lags the primary
+
+        A replica that has replayed the heartbeat written at beat_at does not
+        lag, otherwise it lags by the age of the last transaction it replayed.
+        A replica that has never replayed one lags forever.
+
+        Raises an exception when the replica cannot be reached.
+        """
+        engine = self.db.get_engine(app, bind=self.binds[index])
+        with engine.connect() as conn:
+            if engine.dialect.name != "postgresql":
+                conn.execute(text("SELECT 1"))
+                return 0.0
+            in_recovery, replayed_at, now = conn.execute(REPLAY_QUERY).one()
+        if not in_recovery:
+            return 0.0
+        if replayed_at is None:
+            return float("inf")
+        if beat_at is not None and replayed_at >= beat_at:
+            return 0.0
+        return max((now - replayed_at).total_seconds(), 0.0)
+
+    def is_healthy(self, app, index):
+        """ Returns the cached health of a replica, checking it when it is stale """
+        now = time.monotonic()
+        checked_at, healthy = self._health.get(index, (None, False))
+        if checked_at is not None and now - checked_at < self.health_interval:
+            return healthy
+        with self._lock:
+            checked_at, healthy = self._health.get(index, (None, False))
+            if checked_at is not None and now - checked_at < self.health_interval:
+                return healthy
+            try:
+                lag = self.lag(app, index, self.heartbeat(app))
+                healthy = lag <= self.max_lag
+                if not healthy:
+                    logger.warning("Replica %s lags by %.1f seconds", self.binds[index], lag)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Replica %s is unavailable: %s", self.binds[index], error)
+                healthy = False
+            self._health[index] = (time.monotonic(), healthy)
+            return healthy
+
+    def engine(self, app):
+        """ Returns the engine of the next healthy replica or None """
+        for _ in self.binds:
+            index = next(self._next)
+            if self.is_healthy(app, index):
+                return self.db.get_engine(app, bind=self.binds[index])
+        return None
+
+    ######################################################################
+    #  R E A D   Y O U R   W R I T E S
+    ######################################################################
+    def stick(self, customer_id):
+        """ Pins a customer to the primary after a write """
+        now = time.monotonic()
+        with self._sticky_lock:
+            self._sticky[customer_id] = now + self.sticky_seconds
+            self._sticky.move_to_end(customer_id)
+            # every customer sticks as long, so the ones that expire first
+            # are at the front
+            while self._sticky:
+                customer, until = next(iter(self._sticky.items()))
+                if until >= now and len(self._sticky) <= self.sticky_max:
+                    break
+                self._sticky.pop(customer)
+
+    def is_sticky(self, customer_id):
+        """ True if the customer wrote recently and must read from the primary """
+        until = self._sticky.get(customer_id)
+        return until is not None and until >= time.monotonic()
+
+
+def is_read_only():
+    """ True if the current request may read from a replica """
+    return _read_only.get()
+
+
+def engine_for(app, session):
+    """Returns a replica engine when the session may read from one
+
+    Args:
+        app (Flask): the application that owns the session
+        session (Session): the session that needs a bind
+    """
+    if not _read_only.get():
+        return None
+    replica_set = app.extensions.get("replicas")
+    if replica_set is None or session.new or session.dirty or session.deleted:
+        return None
+    # every query of the request reads the same replica
+    if "replica_engine" not in g:
+        g.replica_engine = replica_set.engine(app)
+    return g.replica_engine
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _is_read_only(replica_set):
+    if request.method not in READ_ONLY_METHODS:
+        return False
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+            return False
+    except ValueError:
+        pass
+    customer_id = (request.view_args or {}).get("customer_id")
+    return customer_id is None or not replica_set.is_sticky(customer_id)
+
+
+def _route_reads():
+    replica_set = current_app.extensions.get("replicas")
+    if replica_set is not None and _is_read_only(replica_set):
+        g.read_only_token = _read_only.set(True)
+
+
+def _stick_writes(response):
+    replica_set = current_app.extensions.get("replicas")
+    if replica_set is None or request.method in READ_ONLY_METHODS or response.status_code >= 400:
+        return response
+    customer_id = (request.view_args or {}).get("customer_id")
+    if customer_id is not None:
+        replica_set.stick(customer_id)
+    response.set_cookie(
+        STICKY_COOKIE, str(time.time() + replica_set.sticky_seconds),
+        max_age=int(replica_set.sticky_seconds) or 1, httponly=True
+    )
+    return response
+
+
+def _reset_reads(error=None):
+    # pylint: disable=unused-argument
+    g.pop("replica_engine", None)
+    token = g.pop("read_only_token", None)
+    if token is not None:
+        _read_only.reset(token)
+
+
+def init_replicas(app, db):
+    """Configures the replica binds and the request hooks from the app config
+
+    Must be called after db.init_app() and before the tables are created.
+    """
+    uris = app.config.get("REPLICA_DATABASE_URIS") or []
+    if isinstance(uris, str):
+        uris = [uri.strip() for uri in uris.split(",") if uri.strip()]
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    previous = app.extensions.pop("replicas", None)
+    if previous is not None:
+        for bind in previous.binds:
+            binds.pop(bind, None)
+    if uris:
+        replica_set = ReplicaSet(
+            db, uris,
+            max_lag=float(app.config.get("REPLICA_MAX_LAG_SECONDS", 5)),
+            sticky_seconds=float(app.config.get("REPLICA_STICKY_SECONDS", 10)),
+            health_interval=float(app.config.get("REPLICA_HEALTH_INTERVAL", 5)),
+            sticky_max=int(app.config.get("REPLICA_STICKY_MAX", 100000)),
+        )
+        binds.update(zip(replica_set.binds, uris))
+        app.extensions["replicas"] = replica_set
+        logger.info("Routing reads across %d replicas", len(uris))
+    app.config["SQLALCHEMY_BINDS"] = binds or None
+
+    if not app.extensions.get("replica_routing"):
+        app.before_request(_route_reads)
+        app.after_request(_stick_writes)
+        app.teardown_request(_reset_reads)
+        app.extensions["replica_routing"] = True
@@ -3,24 +3,46 @@ ShopCart Service
 Paths:
 ------
 GET /shopcarts - Returns a list all of the ShopCarts
+DELETE /admin/shopcarts - deletes every ShopCart, used to reset test environments
+GET /admin/shopcarts/export - streams every ShopCart row as CSV or NDJSON
+POST /admin/shopcarts/import - loads ShopCart rows from a CSV or NDJSON body
+GET /admin/shopcarts/events - returns the cart changes after a cursor
+GET /admin/shopcarts/events/stream - streams the cart changes as server-sent events
+POST /admin/profile - starts a sampling CPU and memory profile of the worker
+GET /admin/profile - returns the last profile of the worker
 POST /shopcarts - creates a new ShopCart record in the database
 POST /shopcarts/{customer_id}/items - add an item to the shopcart for customer_id
 GET /shopcarts/{customer_id} - Returns the ShopCart with a given id number
 GET /shopcarts/{customer_id}/items - Returns the ShopCart with a given id number
+GET /shopcarts/{customer_id}/summary - Returns the item count, quantity and subtotal of a ShopCart
 GET /shopcarts/{customer_id}/items/{product_id} - Returns an item in the ShopCart with a given id number
 PUT /shopcarts/{customer_id}/items/{product_id} - updates a ShopCart record in the database
 PUT /shopcarts/{customer_id}/checkout - checkout all items in the shopcart
+PUT /shopcarts/{customer_id}/merge - moves the items of another ShopCart into the shopcart
 PUT /shopcarts/{customer_id}/items/{product_id}/checkout - checkout one item in the shopcart
 DELETE /shopcarts/{customer_id} - deletes a ShopCart record in the database
+GET /products/{product_id} - Returns the name and price of a product
+PUT /products/{product_id} - changes the name and price of a product, needs the admin key
+GET /products/{product_id}/demand - Returns the number of ShopCarts holding a product and their quantity
+GET /health/live - answers while the worker is running
+GET /health/ready - answers 200 once the worker is warmed up and its databases respond
 """
 
 import os
+import json
+import heapq
+import itertools
+from operator import attrgetter
+import codecs
+import mimetypes
 import sys
+import hmac
 import logging
-from flask import Flask, request, url_for, make_response, abort
-from flask_restx import Api, Resource, fields, reqparse, inputs
-from service.models import ShopCart, DataValidationError, DatabaseConnectionError
+from flask import Flask, Response, request, url_for, make_response, abort, stream_with_context, send_from_directory
+from flask_restx import Api, Resource, fields, inputs, reqparse
+from service.models import Cart, Product, ProductCounter, ShopCart, DataValidationError, DatabaseConnectionError, reset_db, MERGE_POLICIES
 from . import status  # HTTP Status Codes
+from . import assets, bulk, coalescing, executor, feed, guards, health, profiler, sharding, tracing, validation
 from werkzeug.exceptions import NotFound
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
@@ -29,7 +51,23 @@ from flask_sqlalchemy import SQLAlchemy
 from service.models import ShopCart, DataValidationError
 
 # Import Flask application
-from . import app
+from service.application import app
+
+######################################################################
+# HEALTH PROBES
+######################################################################
+@app.route("/health/live")
+def liveness():
+    """Answers as long as the worker can serve requests"""
+    return {"status": "ok"}, status.HTTP_200_OK
+
+@app.route("/health/ready")
+def readiness():
+    """Answers 200 once the worker is warmed up and its databases respond"""
+    ready, checks = health.readiness(app)
+    if not ready:
+        return {"status": "unavailable", "checks": checks}, status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ok", "checks": checks}, status.HTTP_200_OK
 
 ######################################################################
 # GET INDEX
@@ -37,7 +75,26 @@ from . import app
 @app.route("/")
 def index():
     """Base URL for our service"""
-    return app.send_static_file("index.html")
+    html = assets.index_html(app)
+    if html is None:
+        return app.send_static_file("index.html")
+    response = make_response(html)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    """Serves a fingerprinted static asset, precompressed when possible"""
+    path, encoding = assets.precompressed(app.static_folder, filename, request.accept_encodings)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(os.path.join(app.static_folder, assets.DIST), path,
+                                   mimetype=mimetype, max_age=assets.MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -48,7 +105,8 @@ api = Api(app,
           description='This is a sample server ShopCart store server.',
           default='shopcarts',
           default_label='ShopCart shop operations',
-          doc='/apidocs' # default also could use doc='/apidocs/'
+          doc='/apidocs', # default also could use doc='/apidocs/'
+          decorators=[tracing.trace_handler]
          )
 
 # Define the model so that the docs reflect what can be sent
@@ -65,11 +123,52 @@ create_model = api.model('ShopCart', {
                         description='The price of an item in the ShopCart')
     })
 
+summary_model = api.model('ShopCartSummary', {
+    'customer_id': fields.Integer(description='The customer id of the ShopCart'),
+    'item_count': fields.Integer(description='The number of items in the ShopCart'),
+    'quantity_total': fields.Integer(description='The sum of the item quantities'),
+    'subtotal': fields.Float(description='The sum of price times quantity of the items')
+    })
+
+product_model = api.model('Product', {
+    'product_id': fields.Integer(readonly=True, description='The product id'),
+    'name': fields.String(required=True, description='The name of the product'),
+    'price': fields.Float(required=True, description='The price of the product')
+    })
+
+demand_model = api.model('ProductDemand', {
+    'product_id': fields.Integer(description='The product id'),
+    'cart_count': fields.Integer(description='The number of ShopCarts holding the product'),
+    'quantity_total': fields.Integer(description='The sum of the quantities in those ShopCarts')
+    })
+
+fanout_model = api.model('FanOutRequest', {
+    'customer_ids': fields.List(fields.Integer, description='The customers whose ShopCarts the operation runs on')
+    })
+
 # query string arguments
 shopcart_args = reqparse.RequestParser()
-shopcart_args.add_argument('product_id', type=str, required=False, help='List ShopCarts by product id')
-shopcart_args.add_argument('quantity', type=str, required=False, help='List ShopCarts by quantity')
-shopcart_args.add_argument('price', type=inputs.boolean, required=False, help='List ShopCarts by price')
+shopcart_args.add_argument('product_id', type=int, location='args', help='List ShopCarts by product id')
+shopcart_args.add_argument('quantity', type=int, location='args', help='List ShopCarts by quantity')
+shopcart_args.add_argument('price', type=float, location='args', help='List ShopCarts by price')
+shopcart_args.add_argument('limit', type=int, location='args',
+                           help='Returns one page of at most limit ShopCarts, ordered by customer and product id')
+shopcart_args.add_argument('after', type=str, location='args',
+                           help='The customer_id,product_id of the last ShopCart of the previous page')
+
+merge_args = reqparse.RequestParser()
+merge_args.add_argument('source', type=int, required=True, location='args',
+                        help='The customer id of the ShopCart to merge, usually a guest')
+merge_args.add_argument('policy', type=str, default='sum', choices=MERGE_POLICIES, location='args',
+                        help='How the quantities of an item in both ShopCarts are combined')
+
+profile_args = reqparse.RequestParser()
+profile_args.add_argument('seconds', type=float, default=10.0, location='args',
+                          help='How long to sample, at most PROFILER_MAX_SECONDS')
+profile_args.add_argument('interval', type=float, location='args',
+                          help='Seconds between two samples, PROFILER_INTERVAL by default')
+profile_args.add_argument('memory', type=inputs.boolean, default=False, location='args',
+                          help='Whether to snapshot the memory allocated during the profile, slows the worker down')
 
 ######################################################################
 # Special Error Handlers
@@ -85,6 +184,17 @@ def request_validation_error(error):
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(guards.QueryTooExpensive)
+def query_too_expensive(error):
+    """ Handles list queries that would cost too much """
+    message = "{}. Add a product_id or price filter, or page through the ShopCarts with limit and after".format(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_400_BAD_REQUEST,
+        'error': 'Bad Request',
+        'message': message
+    }, status.HTTP_400_BAD_REQUEST
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -107,26 +217,45 @@ class ShopCartCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_shopcarts')
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(create_model)
+    @api.response(200, 'Success', [create_model])
+    @api.response(400, 'The query was not valid or would cost too much')
     def get(self):
-        """Returns all of the products in ShopCarts"""
+        """
+        Returns all of the products in ShopCarts
+        A list without limit is refused when it holds more than LIST_MAX_ROWS items or its filter
+        scans too much of the table, pages with limit carry a Link header to the next page
+        """
         app.logger.info("Request for product list")
-        shopcarts = []
-        price = request.args.get("price")
-        quantity = request.args.get("quantity")
-        product_id = request.args.get("product_id")
-        if price:
-            shopcarts = ShopCart.find_by_price(price)
-        elif quantity:
-            shopcarts = ShopCart.find_by_quantity(quantity)
-        elif product_id:
-            shopcarts = ShopCart.find_by_product_id(product_id)    
-        else:
-            shopcarts = ShopCart.all()
-
-        results = [shopcart.serialize() for shopcart in shopcarts]
-        app.logger.info("Returning %d shopcarts", len(results))
-        return results, status.HTTP_200_OK
+        args = shopcart_args.parse_args()
+        max_rows = app.config["LIST_MAX_ROWS"]
+        limit = args["limit"]
+        if limit is not None and (limit < 1 or (max_rows and limit > max_rows)):
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and {}".format(max_rows))
+        after = parse_after(args["after"])
+        options = {
+            "limit": limit or (max_rows + 1 if max_rows else None),
+            "after": after,
+            # a page is bounded by its limit, only whole lists are planned
+            "max_scan_rows": None if limit else app.config["LIST_MAX_SCAN_ROWS"],
+            "timeout": app.config["LIST_STATEMENT_TIMEOUT"],
+        }
+
+        # query every shard in parallel, the rows go to the encoder as CartRows
+        shards = sharding.fan_out(
+            app, lambda: ShopCart.rows(args["price"], args["quantity"], args["product_id"], **options)
+        )
+        headers = {}
+        if limit:
+            key = attrgetter("customer_id", "product_id")
+            shards = [list(itertools.islice(heapq.merge(*shards, key=key), limit))]
+            if len(shards[0]) == limit:
+                params = dict(request.args, after="{},{}".format(*key(shards[0][-1])))
+                headers["Link"] = '<{}>; rel="next"'.format(url_for(request.endpoint, _external=True, **params))
+        elif max_rows and sum(len(rows) for rows in shards) > max_rows:
+            raise guards.QueryTooExpensive("The query matches more than {} ShopCarts".format(max_rows))
+        app.logger.info("Returning %d shopcarts", sum(len(rows) for rows in shards))
+        return Response(encode_rows(shards), status=status.HTTP_200_OK, mimetype="application/json",
+                        headers=headers)
     
     ######################################################################
     # ADD A NEW SHOPCART
@@ -141,8 +270,10 @@ class ShopCartCollection(Resource):
         """
         app.logger.info("Request to create a ShopCart")
         check_content_type("application/json")
-        shopcart = ShopCart()
-        shopcart.deserialize(request.get_json())
+        values, errors = validation.shopcart.validate(request.get_json(silent=True))
+        if errors:
+            return invalid_payload(errors)
+        shopcart = ShopCart(**values)
         # shopcart.create()
         message = {"customer_id": shopcart.customer_id}
         location_url = api.url_for(ShopCartResource, customer_id=shopcart.customer_id, _external=True)
@@ -175,6 +306,7 @@ class ShopCartResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_shopcarts')
     @api.response(404, 'ShopCart not found')
+    @coalescing.coalesce('get_shopcarts')
     @api.marshal_with(create_model)
     def get(self, customer_id):
         """
@@ -182,10 +314,10 @@ class ShopCartResource(Resource):
         This endpoint will return a ShopCart based on it's id
         """
         app.logger.info("Request for shopcart with id: %s", customer_id)
-        shopcart = ShopCart.find_by_customer_id(customer_id)
-        if shopcart.count() == 0:
+        if Cart.find(customer_id) is None:
             raise NotFound("ShopCart with id '{}' was not found.".format(customer_id))
 
+        shopcart = ShopCart.list_by_customer_id(customer_id)
         results = [product.serialize() for product in shopcart]
         app.logger.info("Returning %d shopcarts", len(results))
         return results, status.HTTP_200_OK
@@ -201,13 +333,32 @@ class ShopCartResource(Resource):
         This endpoint will delete a Shopcart based the id specified in the path
         """
         app.logger.info("Request to delete shopcart with id: %s", customer_id)
-        shopcarts = ShopCart.find_by_customer_id(customer_id)
-        for shopcart in shopcarts:
-            shopcart.delete()
+        ShopCart.clear_cart(customer_id)
 
         app.logger.info("Shopcart with ID [%s] delete complete.", customer_id)
         return '', status.HTTP_204_NO_CONTENT
 
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/summary
+######################################################################
+@api.route('/shopcarts/<int:customer_id>/summary')
+@api.param('customer_id', 'The ShopCart identifier')
+class SummaryResource(Resource):
+    """ The totals of a ShopCart """
+    @api.doc('get_shopcart_summary')
+    @api.response(404, 'ShopCart not found')
+    @api.marshal_with(summary_model)
+    def get(self, customer_id):
+        """
+        Retrieve the totals of a ShopCart
+        This endpoint will return the item count, quantity and subtotal of a ShopCart
+        """
+        app.logger.info("Request for summary of shopcart with id: %s", customer_id)
+        cart = Cart.find(customer_id)
+        if cart is None:
+            raise NotFound("ShopCart with id '{}' was not found.".format(customer_id))
+        return cart.serialize(), status.HTTP_200_OK
+
 ######################################################################
 #  PATH: /shopcarts/{int:customer_id}/checkout
 ######################################################################
@@ -227,13 +378,35 @@ class CheckoutResource(Resource):
         app.logger.info("Request to checkout shopcart with id: %s", customer_id)
 
         # Placeholder to call the orders api
-        shopcarts = ShopCart.find_by_customer_id(customer_id)
-        for shopcart in shopcarts:
-            shopcart.delete()
+        ShopCart.checkout_cart(customer_id)
 
         app.logger.info("Shopcart with ID [%s] checkout complete.", customer_id)
         return make_response("", status.HTTP_200_OK)
 
+######################################################################
+#  PATH: /shopcarts/{int:customer_id}/merge
+######################################################################
+@api.route('/shopcarts/<int:customer_id>/merge')
+@api.param('customer_id', 'The ShopCart identifier')
+class MergeResource(Resource):
+    """ Moves the items of another ShopCart into a ShopCart """
+    @api.doc('merge_shopcarts')
+    @api.expect(merge_args)
+    @api.response(400, 'The ShopCarts cannot be merged')
+    @api.marshal_list_with(create_model)
+    def put(self, customer_id):
+        """
+        Merge a ShopCart into another
+        This endpoint will move every item of the source ShopCart into the ShopCart
+        in the path in one transaction and empty the source ShopCart.
+        Items held by both are combined with the policy: sum, newest or max.
+        """
+        args = merge_args.parse_args()
+        app.logger.info("Request to merge shopcart %s into shopcart %s", args['source'], customer_id)
+        shopcarts = ShopCart.merge(args['source'], customer_id, args['policy'])
+        app.logger.info("Shopcart with ID [%s] now holds %d items.", customer_id, len(shopcarts))
+        return [shopcart.serialize() for shopcart in shopcarts], status.HTTP_200_OK
+
 ######################################################################
 #  PATH: /shopcarts/<int:customer_id>/items
 ######################################################################
@@ -254,8 +427,10 @@ class ItemCollection(Resource):
         """
         app.logger.info("Request to create a ShopCart")
         check_content_type("application/json")
-        shopcart = ShopCart()
-        shopcart.deserialize(request.get_json())
+        values, errors = validation.shopcart.validate(request.get_json(silent=True))
+        if errors:
+            return invalid_payload(errors)
+        shopcart = ShopCart(**values)
         if shopcart.customer_id != customer_id:
             abort(status.HTTP_400_BAD_REQUEST, "Customer ID in data must be {} as requested in URI. ".format(customer_id)) 
         if ShopCart.find((shopcart.customer_id, shopcart.product_id)):
@@ -320,7 +495,11 @@ class ItemResource(Resource):
         shopcart = ShopCart.find((customer_id, product_id))
         if not shopcart:
             raise NotFound("Shopcart with id '{}' for product '{}' was not found.".format((customer_id, product_id)))
-        shopcart.deserialize(request.get_json())
+        values, errors = validation.shopcart.validate(request.get_json(silent=True))
+        if errors:
+            return invalid_payload(errors)
+        for name, value in values.items():
+            setattr(shopcart, name, value)
         shopcart.customer_id = customer_id
         shopcart.product_id= product_id
         shopcart.update()
@@ -367,11 +546,283 @@ class CheckoutItemResource(Resource):
         if not shopcart:
             raise NotFound("Shopcart with id '{}' for product '{}' was not found.".format(customer_id, product_id))
         # Placeholder to call the orders api
-        shopcart.delete()
+        shopcart.checkout()
 
         app.logger.info("shopcart with ID [%s] for product [%s] checked out.", shopcart.customer_id, shopcart.product_id)
         return make_response("", status.HTTP_200_OK)
 
+######################################################################
+#  PATH: /products/{int:product_id}
+######################################################################
+@api.route('/products/<int:product_id>')
+@api.param('product_id', 'The product identifier')
+class ProductResource(Resource):
+    """
+    ProductResource class
+
+    Allows the manipulation of the name and price of a product
+    GET /products/{id} - Returns the product with the id
+    PUT /products/{id} - Changes the product with the id, in every ShopCart that does not override it
+    """
+    @api.doc('get_product')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(product_model)
+    def get(self, product_id):
+        """
+        Retrieve a single product
+        This endpoint will return the name and price of a product from the catalog
+        """
+        app.logger.info("Request for product with id: %s", product_id)
+        values = Product.find_values(product_id)
+        if values is None:
+            raise NotFound("Product with id '{}' was not found.".format(product_id))
+        return dict(values, product_id=product_id), status.HTTP_200_OK
+
+    @api.doc('update_product')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    @api.response(404, 'No admin key is configured')
+    @api.expect(product_model)
+    def put(self, product_id):
+        """
+        Update a product
+        This endpoint will change the name and price of a product, adding it when it is missing
+        """
+        check_admin_key()
+        app.logger.info("Request to update product with id: %s", product_id)
+        check_content_type("application/json")
+        values, errors = validation.product.validate(request.get_json(silent=True))
+        if errors:
+            return invalid_payload(errors, "Product")
+        Product.write(product_id, values["name"], values["price"])
+        app.logger.info("Product with ID [%s] updated.", product_id)
+        return dict(values, product_id=product_id), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/{int:product_id}/demand
+######################################################################
+@api.route('/products/<int:product_id>/demand')
+@api.param('product_id', 'The product identifier')
+class DemandResource(Resource):
+    """ The demand for a product across all ShopCarts """
+    @api.doc('get_product_demand')
+    @api.marshal_with(demand_model)
+    def get(self, product_id):
+        """
+        Retrieve the demand for a product
+        This endpoint will return the number of ShopCarts holding a product and their total quantity
+        """
+        app.logger.info("Request for demand of product with id: %s", product_id)
+        totals = sharding.fan_out(app, lambda: ProductCounter.totals(product_id))
+        return {
+            "product_id": product_id,
+            "cart_count": sum(carts for carts, _ in totals),
+            "quantity_total": sum(quantity for _, quantity in totals),
+        }, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /admin/shopcarts
+######################################################################
+@api.route('/admin/shopcarts')
+class AdminShopCartCollection(Resource):
+    """ Administrative actions on all of the ShopCarts """
+    @api.doc('reset_shopcarts')
+    @api.response(204, 'All ShopCarts deleted')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    @api.response(404, 'No admin key is configured or TESTING is not set')
+    def delete(self):
+        """
+        Delete all ShopCarts
+        This endpoint will empty every table in one call, for resetting test environments
+        """
+        check_admin_key()
+        if not app.config.get("TESTING"):
+            raise NotFound("Resetting the database is only allowed when TESTING is set.")
+        app.logger.info("Request to reset all shopcarts")
+        reset_db()
+        app.logger.info("All shopcarts deleted.")
+        return '', status.HTTP_204_NO_CONTENT
+
+######################################################################
+#  PATH: /admin/shopcarts/clear
+#  PATH: /admin/shopcarts/rebuild
+######################################################################
+@api.route('/admin/shopcarts/<any(clear, rebuild):operation>')
+@api.param('operation', 'clear deletes the items of the carts, rebuild recomputes their summaries')
+class FanOutResource(Resource):
+    """ Operations on the ShopCarts of many customers at once """
+    @api.doc('run_shopcart_operation')
+    @api.expect(fanout_model)
+    @api.response(400, 'The customer ids were not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    def post(self, operation):
+        """
+        Run an operation on many ShopCarts
+        This endpoint will split the customers into chunks run in parallel, each in its own transaction,
+        and return the rows, duration and error of every chunk. rebuild covers every cart without customer_ids
+        """
+        check_admin_key()
+        data = request.get_json(silent=True) or {}
+        customer_ids = data.get("customer_ids")
+        if customer_ids is None and operation == "rebuild":
+            customer_ids = executor.all_customer_ids(app)
+        if not isinstance(customer_ids, list) or not all(
+            isinstance(customer_id, int) and not isinstance(customer_id, bool) for customer_id in customer_ids
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, "customer_ids must be a list of customer ids")
+        app.logger.info("Request to %s %d shopcarts", operation, len(customer_ids))
+        report = executor.FanOutExecutor.from_config(app).run(
+            operation, executor.OPERATIONS[operation], customer_ids
+        )
+        return report, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /admin/shopcarts/export
+######################################################################
+@api.route('/admin/shopcarts/export')
+class ExportResource(Resource):
+    """ Bulk export of the ShopCart table """
+    @api.doc('export_shopcarts', params={'format': 'csv or ndjson'})
+    @api.response(401, 'A valid X-Api-Key header is required')
+    def get(self):
+        """
+        Export all ShopCarts
+        This endpoint will stream every ShopCart row as CSV or NDJSON
+        """
+        check_admin_key()
+        fmt = request.args.get("format", "csv")
+        if fmt not in bulk.FORMATS:
+            abort(status.HTTP_400_BAD_REQUEST, "format must be one of {}".format(", ".join(bulk.FORMATS)))
+        app.logger.info("Request to export shopcarts as %s", fmt)
+        return Response(stream_with_context(bulk.export_rows(fmt)), mimetype=bulk.FORMATS[fmt])
+
+######################################################################
+#  PATH: /admin/shopcarts/import
+######################################################################
+@api.route('/admin/shopcarts/import')
+class ImportResource(Resource):
+    """ Bulk import into the ShopCart table """
+    @api.doc('import_shopcarts')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    def post(self):
+        """
+        Import ShopCarts
+        This endpoint will load every row of a text/csv or application/x-ndjson body
+        """
+        check_admin_key()
+        fmt = bulk.format_for(request.mimetype)
+        if fmt is None:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  "Content-Type must be one of {}".format(", ".join(bulk.FORMATS.values())))
+        app.logger.info("Request to import shopcarts as %s", fmt)
+        # the WSGI input of some servers is not an io object, so decode it with codecs
+        stream = codecs.getreader(request.mimetype_params.get("charset", "utf-8"))(request.stream)
+        count = bulk.import_rows(stream, fmt)
+        app.logger.info("Imported %d shopcarts", count)
+        return {"imported": count}, status.HTTP_201_CREATED
+
+######################################################################
+#  PATH: /admin/shopcarts/events
+######################################################################
+@api.route('/admin/shopcarts/events')
+class EventCollection(Resource):
+    """ The feed of changes to the ShopCarts """
+    @api.doc('list_shopcart_events', params={
+        'cursor': 'The cursor returned by the last read, omit it to start at the beginning',
+        'limit': 'The maximum number of events to return',
+        'wait': 'Seconds to wait for an event when there is none yet'})
+    @api.response(400, 'The cursor was not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    def get(self):
+        """
+        Read the change feed
+        This endpoint will return the cart changes after a cursor in the order they were made
+        """
+        check_admin_key()
+        limit = min(request.args.get("limit", app.config["FEED_PAGE_SIZE"], type=int), 1000)
+        wait = min(request.args.get("wait", 0, type=float), app.config["FEED_MAX_WAIT"])
+        if limit < 1 or wait < 0:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be positive and wait must not be negative")
+        events, cursor = feed.wait_for_events(
+            app, request.args.get("cursor"), limit, app.config["FEED_SETTLE_SECONDS"],
+            wait, app.config["FEED_POLL_INTERVAL"]
+        )
+        app.logger.info("Returning %d events", len(events))
+        return {"events": [event for event, _ in events], "cursor": cursor}, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /admin/shopcarts/events/stream
+######################################################################
+@api.route('/admin/shopcarts/events/stream')
+class EventStream(Resource):
+    """ The feed of changes to the ShopCarts as server-sent events """
+    @api.doc('stream_shopcart_events', params={'cursor': 'The cursor to start after'})
+    @api.response(400, 'The cursor was not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    def get(self):
+        """
+        Stream the change feed
+        This endpoint will stream the cart changes as text/event-stream, resuming after Last-Event-ID
+        """
+        check_admin_key()
+        cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor")
+        feed.decode_cursor(cursor, len(sharding.shard_indexes(app)))
+        app.logger.info("Streaming events after %s", cursor)
+        stream = feed.stream_events(
+            app, cursor, app.config["FEED_SETTLE_SECONDS"], app.config["FEED_POLL_INTERVAL"],
+            app.config["STREAM_HEARTBEAT_SECONDS"], app.config["STREAM_MAX_SECONDS"]
+        )
+        return Response(stream_with_context(stream), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+######################################################################
+#  PATH: /admin/profile
+######################################################################
+@api.route('/admin/profile')
+class ProfileResource(Resource):
+    """ Sampling profiles of the worker that answers """
+    @api.doc('start_profile')
+    @api.expect(profile_args)
+    @api.response(400, 'The duration or interval was not valid')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    @api.response(404, 'Profiling is not enabled')
+    @api.response(409, 'A profile is already running')
+    def post(self):
+        """
+        Start a profile
+        This endpoint will sample the stacks of every thread of the worker in the background for seconds
+        """
+        profile = check_profiler()
+        args = profile_args.parse_args()
+        if args['seconds'] <= 0 or (args['interval'] is not None and args['interval'] < 0.001):
+            abort(status.HTTP_400_BAD_REQUEST, "seconds must be positive and interval at least 0.001")
+        try:
+            started = profile.start(args['seconds'], args['interval'], args['memory'])
+        except profiler.ProfilerBusy as error:
+            abort(status.HTTP_409_CONFLICT, str(error))
+        app.logger.info("Started a profile of worker %d", os.getpid())
+        return dict(started, pid=os.getpid()), status.HTTP_202_ACCEPTED
+
+    @api.doc('get_profile', params={'format': 'json, or collapsed for the stacks alone'})
+    @api.response(202, 'The profile is still running')
+    @api.response(401, 'A valid X-Api-Key header is required')
+    @api.response(404, 'Profiling is not enabled or no profile was taken')
+    def get(self):
+        """
+        Retrieve the last profile
+        This endpoint will return the collapsed stacks and allocation snapshot of the last profile of the worker
+        """
+        profile = check_profiler()
+        if profile.running:
+            return {"status": "running", "pid": os.getpid()}, status.HTTP_202_ACCEPTED
+        result = profile.result
+        if result is None:
+            raise NotFound("No profile was taken by worker {}.".format(os.getpid()))
+        if request.args.get("format") == "collapsed":
+            return Response(result.get("collapsed", ""), mimetype="text/plain")
+        return result, status.HTTP_200_OK
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -392,3 +843,65 @@ def check_content_type(media_type):
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         "Content-Type must be {}".format(media_type),
     )
+
+def encode_rows(shards, batch_size=1000):
+    """Encodes lists of CartRows as one JSON array of objects
+
+    Only one batch of rows is turned into dicts at a time, so the list
+    never exists as instances, dicts and marshalled copies at once.
+    """
+    parts = []
+    for rows in shards:
+        for start in range(0, len(rows), batch_size):
+            parts.append(json.dumps([row._asdict() for row in rows[start:start + batch_size]])[1:-1])
+    return "[" + ", ".join(parts) + "]\n"
+
+def parse_after(after):
+    """Returns the (customer_id, product_id) of an after argument or None"""
+    if after is None:
+        return None
+    try:
+        customer_id, product_id = (int(value) for value in after.split(","))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "after must be the customer_id,product_id of the last ShopCart of a page")
+    return customer_id, product_id
+
+def invalid_payload(errors, kind="ShopCart"):
+    """Returns a 400 response that lists every invalid field"""
+    message = "Invalid {}: {}".format(kind, validation.describe(errors))
+    app.logger.error(message)
+    return {
+        'status_code': status.HTTP_400_BAD_REQUEST,
+        'error': 'Bad Request',
+        'message': message,
+        'errors': errors
+    }, status.HTTP_400_BAD_REQUEST
+
+def check_profiler():
+    """Returns the profiler of the worker once the caller may use it
+
+    Profiling needs PROFILER_ENABLED and an ADMIN_API_KEY, without them the
+    endpoints do not exist.
+    """
+    profile = app.extensions.get("profiler")
+    if profile is None:
+        raise NotFound("Profiling is not enabled.")
+    check_admin_key()
+    return profile
+
+def check_admin_key():
+    """Checks the X-Api-Key header against ADMIN_API_KEY
+
+    The administrative endpoints do not exist until ADMIN_API_KEY is
+    configured.
+    """
+    api_key = app.config.get("ADMIN_API_KEY")
+    if not api_key:
+        raise NotFound("The administrative endpoints are disabled, set ADMIN_API_KEY to enable them.")
+    if hmac.compare_digest(request.headers.get("X-Api-Key", ""), api_key):
+        return
+    app.logger.error("Invalid X-Api-Key for %s", request.path)
+    abort(status.HTTP_401_UNAUTHORIZED, "A valid X-Api-Key header is required")
+
+# the routes are only served by the synchronous service, set it up
+from service import server  # pylint: disable=wrong-import-position,unused-import,cyclic-import
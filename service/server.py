@@ -0,0 +1,51 @@
+"""
+ShopCart Service
+
+Sets up the synchronous service on the Flask app of service/application.py:
+the routes, the CLI commands, the request hooks, the logging, the SQL
+database and the health state. Importing service.routes, or using
+service.app, runs it once. The asyncio variant does not.
+"""
+import sys
+import logging
+from service.application import app
+
+# Import the routes After the Flask app is created
+from service import routes, models, tracing, jobs, commands, ratelimit, compression, coalescing, health, profiler
+
+# Set up logging for production
+if __name__ != "__main__":
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+    app.logger.propagate = False
+    # Make all log formats consistent
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+    )
+    for handler in app.logger.handlers:
+        handler.setFormatter(formatter)
+    app.logger.info("Logging handler established")
+
+app.logger.info(70 * "*")
+app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
+app.logger.info(70 * "*")
+
+ratelimit.init_ratelimit(app)
+tracing.init_tracing(app)
+compression.init_compression(app)
+coalescing.init_coalescing(app)
+profiler.init_profiler(app)
+
+try:
+    routes.init_db()  # make our sqlalchemy tables
+except Exception as error:
+    app.logger.critical("%s: Cannot continue", error)
+    # gunicorn requires exit code 4 to stop spawning workers when they die
+    sys.exit(4)
+
+# the background jobs are started by the server, see gunicorn.conf.py
+# before the worker accepts its first request
+health.init_health(app)
+
+app.logger.info("Service initialized!")
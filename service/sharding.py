@@ -0,0 +1,253 @@
+"""
+Sharding and Partitioning
+
+Spreads the per-customer tables by customer_id. Two layouts are supported
+and can be combined:
+
+* PostgreSQL declarative hash partitions of the shop_cart and cart tables,
+  enabled with SHOPCART_PARTITIONS, so per-customer queries are pruned to
+  one partition.
+* Routing across several databases listed in SHARD_DATABASE_URIS. A customer
+  lives on shard ``customer_id % len(SHARD_DATABASE_URIS)`` and the session
+  sends every statement on a sharded table to that shard.
+
+Per-customer routes pick their shard from the customer_id in the URL.
+Cross-shard reads go through fan_out(), which queries every shard in
+parallel and returns the results of each one.
+"""
+import logging
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import g
+from sqlalchemy import DDL, event
+from sqlalchemy.sql.util import find_tables
+
+logger = logging.getLogger("flask.app")
+
+# The customer whose shard the current request or job is using
+_shard_key = contextvars.ContextVar("shard_key", default=None)
+# An explicit shard index that overrides the customer, used by fan_out()
+_shard_index = contextvars.ContextVar("shard_index", default=None)
+
+
+class ShardRoutingError(Exception):
+    """Used when a sharded table is used without a customer to route by"""
+
+
+class ShardMap:
+    """The bind names of the shards and the engines behind them"""
+
+    def __init__(self, db, uris):
+        self.db = db
+        self.binds = ["shard_{}".format(index) for index in range(len(uris))]
+
+    def __len__(self):
+        return len(self.binds)
+
+    def index_for(self, customer_id):
+        """ Returns the index of the shard that owns a customer """
+        return int(customer_id) % len(self.binds)
+
+    def engine(self, app, index):
+        """ Returns the engine for the shard at index """
+        return self.db.get_engine(app, bind=self.binds[index])
+
+
+######################################################################
+#  S H A R D   S E L E C T I O N
+######################################################################
+@contextmanager
+def shard_for(customer_id):
+    """Routes sharded tables to the shard that owns customer_id
+
+    Example:
+        with shard_for(customer_id):
+            ShopCart.find_by_customer_id(customer_id).all()
+    """
+    token = _shard_key.set(customer_id)
+    try:
+        yield
+    finally:
+        _shard_key.reset(token)
+
+
+@contextmanager
+def shard_index(index):
+    """ Routes sharded tables to the shard at index """
+    token = _shard_index.set(index)
+    try:
+        yield
+    finally:
+        _shard_index.reset(token)
+
+
+def _is_sharded(mapper, clause):
+    if mapper is not None:
+        return mapper.persist_selectable.info.get("sharded", False)
+    if clause is not None:
+        return any(table.info.get("sharded", False) for table in find_tables(clause))
+    return False
+
+
+def engine_for(app, mapper=None, clause=None):
+    """Returns the shard engine for a statement or None when it is not sharded
+
+    Args:
+        app (Flask): the application that owns the session
+        mapper (Mapper): the mapper that is being flushed or queried
+        clause (ClauseElement): the statement that is being executed
+    """
+    shard_map = app.extensions.get("sharding")
+    if shard_map is None or not _is_sharded(mapper, clause):
+        return None
+    index = _shard_index.get()
+    if index is None:
+        customer_id = _shard_key.get()
+        if customer_id is None:
+            raise ShardRoutingError(
+                "A sharded table was used without a customer_id; use shard_for() or fan_out()"
+            )
+        index = shard_map.index_for(customer_id)
+    return shard_map.engine(app, index)
+
+
+def shard_count(app):
+    """ Returns the number of shards, 1 when sharding is disabled """
+    shard_map = app.extensions.get("sharding")
+    return len(shard_map) if shard_map else 1
+
+
+def shard_indexes(app):
+    """ Returns the index of every shard, or [None] when sharding is disabled """
+    shard_map = app.extensions.get("sharding")
+    return list(range(len(shard_map))) if shard_map else [None]
+
+
+def fan_out(app, function):
+    """Calls function once per shard in parallel
+
+    Each call runs in its own thread, application context and session with
+    sharded tables routed to one shard. When sharding is disabled function
+    is simply called once in the current context.
+
+    Returns:
+        a list with the result of function for every shard
+    """
+    shard_map = app.extensions.get("sharding")
+    if shard_map is None:
+        return [function()]
+
+    def run(index):
+        with app.app_context(), shard_index(index):
+            return function()
+
+    with ThreadPoolExecutor(max_workers=len(shard_map), thread_name_prefix="shard") as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, run, index)
+            for index in range(len(shard_map))
+        ]
+        return [future.result() for future in futures]
+
+
+######################################################################
+#  S E T U P
+######################################################################
+def _route_by_customer(endpoint, values):
+    # pylint: disable=unused-argument
+    if values and "customer_id" in values:
+        g.shard_token = _shard_key.set(values["customer_id"])
+
+
+def _reset_route(error=None):
+    # pylint: disable=unused-argument
+    token = g.pop("shard_token", None)
+    if token is not None:
+        _shard_key.reset(token)
+
+
+def configure_partitions(table, count):
+    """Declares table as hash partitioned on customer_id in PostgreSQL
+
+    The partitions are created right after the parent table. Other databases
+    ignore the partitioning options.
+
+    Raises:
+        ValueError: when customer_id is not part of the primary key, which
+            PostgreSQL requires of the partition key
+    """
+    if table.dialect_kwargs.get("postgresql_partition_by"):
+        return
+    if "customer_id" not in table.primary_key.columns:
+        raise ValueError("{} cannot be partitioned by customer_id".format(table.name))
+    table.dialect_kwargs["postgresql_partition_by"] = "HASH (customer_id)"
+    for remainder in range(count):
+        event.listen(table, "after_create", DDL(
+            "CREATE TABLE IF NOT EXISTS {name}_p{remainder} PARTITION OF {name} "
+            "FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})".format(
+                name=table.name, remainder=remainder, count=count
+            )
+        ).execute_if(dialect="postgresql"))
+
+
+def sharded_tables(db):
+    """ Returns the tables that are routed by customer_id """
+    return [table for table in db.Model.metadata.sorted_tables if table.info.get("sharded")]
+
+
+def partitioned_tables(db):
+    """Returns the sharded tables that can be hash partitioned by customer_id
+
+    Only the tables whose primary key holds customer_id, the other sharded
+    tables are keyed by a serial id or by product.
+    """
+    return [table for table in sharded_tables(db) if "customer_id" in table.primary_key.columns]
+
+
+def init_sharding(app, db):
+    """Configures partitions and shard binds from the app config
+
+    Must be called after db.init_app() and before the tables are created.
+    """
+    partitions = int(app.config.get("SHOPCART_PARTITIONS") or 0)
+    if partitions > 0:
+        for table in partitioned_tables(db):
+            configure_partitions(table, partitions)
+
+    uris = app.config.get("SHARD_DATABASE_URIS") or []
+    if isinstance(uris, str):
+        uris = [uri.strip() for uri in uris.split(",") if uri.strip()]
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    previous = app.extensions.pop("sharding", None)
+    if previous is not None:
+        for bind in previous.binds:
+            binds.pop(bind, None)
+    if uris:
+        shard_map = ShardMap(db, uris)
+        binds.update(zip(shard_map.binds, uris))
+        app.extensions["sharding"] = shard_map
+        logger.info("Routing carts across %d shards", len(shard_map))
+    app.config["SQLALCHEMY_BINDS"] = binds or None
+
+    if not app.extensions.get("shard_routing"):
+        app.url_value_preprocessor(_route_by_customer)
+        app.teardown_request(_reset_route)
+        app.extensions["shard_routing"] = True
+
+
+def create_all(app, db):
+    """ Creates the sharded tables on every shard """
+    shard_map = app.extensions.get("sharding")
+    if shard_map is None:
+        return
+    for index in range(len(shard_map)):
+        db.Model.metadata.create_all(bind=shard_map.engine(app, index), tables=sharded_tables(db))
+
+
+def drop_all(app, db):
+    """ Drops the sharded tables from every shard """
+    shard_map = app.extensions.get("sharding")
+    if shard_map is None:
+        return
+    for index in range(len(shard_map)):
+        db.Model.metadata.drop_all(bind=shard_map.engine(app, index), tables=sharded_tables(db))
@@ -0,0 +1,103 @@
+"""
+SQLite Profile
+
+Engine settings for running the service on SQLite, used by the test suite
+and by small edge or single-node deployments. The profile is selected when
+DATABASE_URI is a sqlite:// URI and SQLITE_PROFILE is "tuned" (the default):
+
+* every connection switches to WAL so readers never block the writer, uses
+  synchronous=NORMAL, a larger page cache, in-memory temp storage and a
+  busy timeout so concurrent workers wait for the write lock instead of
+  failing with "database is locked"
+* file databases use a QueuePool of SQLITE_POOL_SIZE connections that any
+  thread can check out, or a NullPool that opens a connection per checkout
+  when SQLITE_POOL_SIZE is 0; the busy timeout lets the connections wait
+  for each other's write locks
+* in-memory databases, which only the test suite uses, share a single
+  connection through a StaticPool so every thread sees the same tables
+
+Set SQLITE_PROFILE to "default" to keep the plain driver defaults.
+"""
+import sqlite3
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+logger = logging.getLogger("flask.app")
+
+# The PRAGMAs that are applied to every new SQLite connection
+PRAGMAS = {}
+
+
+@event.listens_for(Engine, "connect")
+def _set_pragmas(dbapi_connection, connection_record):
+    # pylint: disable=unused-argument
+    if not PRAGMAS or not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+
+def is_sqlite(uri):
+    """ True if the database URI points at SQLite """
+    return bool(uri) and uri.startswith("sqlite")
+
+
+def is_memory(uri):
+    """ True if the SQLite URI is an in-memory database """
+    return uri in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in uri
+
+
+def pragmas(config):
+    """ Returns the PRAGMAs for the tuned profile from the app config """
+    busy_timeout = int(config.get("SQLITE_BUSY_TIMEOUT", 5000))
+    return {
+        "journal_mode": config.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": config.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": busy_timeout,
+        "cache_size": int(config.get("SQLITE_CACHE_SIZE", -20000)),
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    }
+
+
+def engine_options(config):
+    """ Returns the SQLAlchemy engine options for the tuned profile """
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    busy_timeout = int(config.get("SQLITE_BUSY_TIMEOUT", 5000))
+    if is_memory(uri):
+        return {
+            "poolclass": StaticPool,
+            "connect_args": {"check_same_thread": False},
+        }
+    connect_args = {"timeout": busy_timeout / 1000.0, "check_same_thread": False}
+    pool_size = int(config.get("SQLITE_POOL_SIZE", 8))
+    if pool_size <= 0:
+        return {"poolclass": NullPool, "connect_args": connect_args}
+    return {
+        "poolclass": QueuePool,
+        "pool_size": pool_size,
+        "max_overflow": 0,
+        "pool_timeout": max(busy_timeout / 1000.0, 1.0),
+        "connect_args": connect_args,
+    }
+
+
+def configure(app):
+    """Applies the SQLite profile to the app config when the database is SQLite
+
+    Must be called before the engine is created.
+    """
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+    if not is_sqlite(uri) or app.config.get("SQLITE_PROFILE", "tuned") != "tuned":
+        PRAGMAS.clear()
+        return
+    PRAGMAS.clear()
+    PRAGMAS.update(pragmas(app.config))
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    options.update(engine_options(app.config))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    logger.info("Using the tuned SQLite profile with %s", PRAGMAS)
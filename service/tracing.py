@@ -0,0 +1,398 @@
+"""
+Request Tracing
+
+Lightweight request-scoped tracing for the ShopCart service. A root span is
+opened for every sampled request, with child spans around the route handler,
+the ShopCart model methods, SQLAlchemy flushes and every SQL statement.
+Trace context is propagated using the W3C ``traceparent`` header and finished
+spans are handed to a pluggable exporter.
+"""
+import json
+import time
+import random
+import logging
+import threading
+import functools
+import contextvars
+from collections import deque
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("flask.app")
+
+TRACEPARENT_HEADER = "traceparent"
+MAX_STATEMENT_LENGTH = 512
+
+# The span that new child spans will be attached to
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_trace_id():
+    return "%032x" % random.getrandbits(128)
+
+
+def _new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+
+def parse_traceparent(header):
+    """Parses a W3C traceparent header
+
+    Args:
+        header (string): the value of the traceparent header
+
+    Returns:
+        a (trace_id, parent_id, sampled) tuple or None if the header is invalid
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff":
+        return None
+    trace_id, parent_id, flags = parts[1], parts[2], parts[3]
+    if len(trace_id) != 32 or len(parent_id) != 16 or len(flags) != 2:
+        return None
+    try:
+        int(trace_id, 16)
+        int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 0x01)
+    except ValueError:
+        return None
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, sampled
+
+
+######################################################################
+#  S P A N S
+######################################################################
+class Span:
+    """A single timed operation within a trace"""
+
+    __slots__ = (
+        "tracer", "trace_id", "span_id", "parent_id", "name",
+        "sampled", "start_time", "end_time", "attributes", "_start",
+    )
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, sampled=True):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = {}
+        self.start_time = time.time()
+        self.end_time = None
+        self._start = time.perf_counter()
+
+    def __repr__(self):
+        return "<Span %r trace_id=[%s] span_id=[%s]>" % (self.name, self.trace_id, self.span_id)
+
+    @property
+    def duration_ms(self):
+        """ Returns the duration of a finished span in milliseconds """
+        if self.end_time is None:
+            return None
+        return (self.end_time - self.start_time) * 1000.0
+
+    @property
+    def traceparent(self):
+        """ Returns the W3C traceparent header value for this span """
+        return "00-{}-{}-{}".format(self.trace_id, self.span_id, "01" if self.sampled else "00")
+
+    def set_attribute(self, key, value):
+        """ Sets an attribute on the span """
+        self.attributes[key] = value
+
+    def finish(self):
+        """ Ends the span and hands it to the exporter if it was sampled """
+        if self.end_time is not None:
+            return
+        self.end_time = self.start_time + (time.perf_counter() - self._start)
+        if self.sampled:
+            self.tracer.export(self)
+
+    def to_dict(self):
+        """ Serializes a Span into a dictionary """
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+        }
+
+
+######################################################################
+#  E X P O R T E R S
+######################################################################
+class InMemoryExporter:
+    """Keeps the last finished spans for local inspection and tests
+
+    Only the newest max_spans are kept, so a long running worker does not
+    grow without limit.
+    """
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        """ Stores a finished span """
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        """ Removes all of the stored spans """
+        with self._lock:
+            self.spans.clear()
+
+
+class FileExporter:
+    """Appends finished spans to a file as newline delimited JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        """ Writes a finished span to the file """
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as trace_file:
+                trace_file.write(line + "\n")
+
+
+######################################################################
+#  T R A C E R
+######################################################################
+class Tracer:
+    """Creates spans and decides which traces are sampled"""
+
+    def __init__(self, exporter=None, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self):
+        """ True when spans can be recorded """
+        return self.exporter is not None and self.sample_rate > 0
+
+    def configure(self, exporter, sample_rate):
+        """ Replaces the exporter and the sampling rate """
+        self.exporter = exporter
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+
+    def export(self, span):
+        """ Sends a finished span to the exporter """
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Unable to export span %s: %s", span.name, error)
+
+    def start_trace(self, name, traceparent=None):
+        """Starts a root span, continuing the trace in traceparent if it is valid
+
+        The sampling decision of an incoming trace is honoured, otherwise a new
+        trace is sampled at the configured rate.
+        """
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = _new_trace_id(), None
+            sampled = random.random() < self.sample_rate
+        return Span(self, name, trace_id, parent_id, sampled and self.enabled)
+
+    def start_span(self, name):
+        """Starts a child of the current span
+
+        Returns None when there is no sampled span to attach to, which keeps
+        the cost of unsampled requests to a single context variable lookup.
+        """
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return None
+        return Span(self, name, parent.trace_id, parent.span_id)
+
+
+# The tracer used by the service, disabled until init_tracing() configures it
+tracer = Tracer()
+
+
+def current_span():
+    """ Returns the active span or None """
+    return _current_span.get()
+
+
+class span:  # pylint: disable=invalid-name
+    """Context manager that records a child span of the current span"""
+
+    __slots__ = ("name", "_span", "_token")
+
+    def __init__(self, name):
+        self.name = name
+        self._span = None
+        self._token = None
+
+    def __enter__(self):
+        self._span = tracer.start_span(self.name)
+        if self._span is not None:
+            self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._span is None:
+            return False
+        if exc_type is not None:
+            self._span.set_attribute("error", exc_type.__name__)
+        _current_span.reset(self._token)
+        self._span.finish()
+        return False
+
+
+def traced(name):
+    """Decorator that records a span named name around every call"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            parent = _current_span.get()
+            if parent is None or not parent.sampled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def trace_handler(view):
+    """Resource decorator that records a span around the route handler"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return view(*args, **kwargs)
+        with span("handler " + str(request.endpoint)):
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+######################################################################
+#  F L A S K   A N D   S Q L A L C H E M Y   H O O K S
+######################################################################
+def _before_request():
+    if not tracer.enabled:
+        return
+    rule = request.url_rule.rule if request.url_rule else request.path
+    root = tracer.start_trace(
+        "{} {}".format(request.method, rule), request.headers.get(TRACEPARENT_HEADER)
+    )
+    root.set_attribute("http.method", request.method)
+    root.set_attribute("http.target", request.full_path.rstrip("?"))
+    g.trace_span = root
+    g.trace_token = _current_span.set(root)
+
+
+def _after_request(response):
+    root = g.get("trace_span")
+    if root is not None:
+        root.set_attribute("http.status_code", response.status_code)
+        response.headers[TRACEPARENT_HEADER] = root.traceparent
+    return response
+
+
+def _teardown_request(error=None):
+    root = g.pop("trace_span", None)
+    if root is None:
+        return
+    if error is not None:
+        root.set_attribute("error", type(error).__name__)
+    _current_span.reset(g.pop("trace_token"))
+    root.finish()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    sql_span = tracer.start_span("db.statement")
+    if sql_span is not None:
+        sql_span.set_attribute("db.system", conn.dialect.name)
+        sql_span.set_attribute("db.statement", statement[:MAX_STATEMENT_LENGTH])
+        conn.info.setdefault("trace_spans", []).append(sql_span)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    spans = conn.info.get("trace_spans")
+    if spans:
+        sql_span = spans.pop()
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            sql_span.set_attribute("db.rowcount", cursor.rowcount)
+        sql_span.finish()
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    spans = exception_context.connection.info.get("trace_spans") if exception_context.connection else None
+    if spans:
+        sql_span = spans.pop()
+        sql_span.set_attribute("error", type(exception_context.original_exception).__name__)
+        sql_span.finish()
+
+
+@event.listens_for(Session, "before_flush")
+def _before_flush(session, flush_context, instances):
+    # pylint: disable=unused-argument
+    flush_span = tracer.start_span("orm.flush")
+    if flush_span is not None:
+        flush_span.set_attribute("orm.new", len(session.new))
+        flush_span.set_attribute("orm.dirty", len(session.dirty))
+        flush_span.set_attribute("orm.deleted", len(session.deleted))
+        session.info["trace_flush_span"] = flush_span
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def _after_flush(session, flush_context):
+    # pylint: disable=unused-argument
+    flush_span = session.info.pop("trace_flush_span", None)
+    if flush_span is not None:
+        flush_span.finish()
+
+
+def init_tracing(app):
+    """Configures the tracer from the app config and installs the request hooks
+
+    Args:
+        app (Flask): the application to trace
+    """
+    if not app.config.get("TRACING_ENABLED"):
+        tracer.configure(None, 0.0)
+    else:
+        exporter_name = app.config.get("TRACE_EXPORTER", "memory")
+        if exporter_name == "file":
+            exporter = FileExporter(app.config.get("TRACE_FILE", "traces.ndjson"))
+        else:
+            exporter = InMemoryExporter(app.config.get("TRACE_MEMORY_SPANS", 10000))
+        tracer.configure(exporter, float(app.config.get("TRACE_SAMPLE_RATE", 1.0)))
+        logger.info("Tracing enabled with %s exporter at sample rate %s",
+                    exporter_name, tracer.sample_rate)
+
+    if not app.extensions.get("tracing"):
+        app.before_request(_before_request)
+        app.after_request(_after_request)
+        app.teardown_request(_teardown_request)
+        app.extensions["tracing"] = tracer
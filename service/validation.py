@@ -0,0 +1,113 @@
+"""
+Payload Validation
+
+A validator for the ShopCart payload that is compiled once at import time
+from the field list and then checks each payload in a single pass. Bad
+payloads are reported as a list of structured errors instead of raising,
+so rejecting a request costs about the same as accepting one.
+
+The same validator is used by ShopCart.deserialize(), by the write routes
+and by the bulk import.
+"""
+import re
+
+# Returned by a converter when a value cannot be converted
+INVALID = object()
+
+_INTEGER = re.compile(r"\s*[+-]?\d+\s*\Z")
+_NUMBER = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*\Z")
+
+
+def _to_int(value):
+    kind = type(value)
+    if kind is int:
+        return value
+    if kind is float and value.is_integer():
+        return int(value)
+    if kind is str and _INTEGER.match(value):
+        return int(value)
+    return INVALID
+
+
+def _to_float(value):
+    kind = type(value)
+    if kind is float or kind is int:
+        return float(value)
+    if kind is str and _NUMBER.match(value):
+        return float(value)
+    return INVALID
+
+
+def _to_str(value):
+    return value if type(value) is str else INVALID  # pylint: disable=unidiomatic-typecheck
+
+
+CONVERTERS = {
+    "integer": (_to_int, "must be an integer"),
+    "number": (_to_float, "must be a number"),
+    "string": (_to_str, "must be a string"),
+}
+
+
+class Validator:
+    """Checks payloads against a list of required (name, type) fields
+
+    Args:
+        fields (list): (name, type) tuples, where type is integer, number or string
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._checks = tuple(
+            (name, CONVERTERS[kind][0], CONVERTERS[kind][1]) for name, kind in self.fields
+        )
+
+    def validate(self, data):
+        """Converts a payload into column values
+
+        Returns:
+            a (values, errors) tuple, where errors is a list of
+            {"field": name, "message": text} dictionaries and is empty
+            when the payload is valid
+        """
+        if type(data) is not dict:  # pylint: disable=unidiomatic-typecheck
+            return None, [{"field": None, "message": "body of request contained bad or no data"}]
+        values = {}
+        errors = []
+        for name, convert, message in self._checks:
+            value = data.get(name, INVALID)
+            if value is INVALID:
+                errors.append({"field": name, "message": "is missing"})
+                continue
+            value = convert(value)
+            if value is INVALID:
+                errors.append({"field": name, "message": message})
+            else:
+                values[name] = value
+        return values, errors
+
+
+def describe(errors):
+    """ Joins structured errors into one message """
+    return "; ".join(
+        error["message"] if error["field"] is None else "{} {}".format(error["field"], error["message"])
+        for error in errors
+    )
+
+
+shopcart = Validator(
+    [
+        ("customer_id", "integer"),
+        ("product_id", "integer"),
+        ("name", "string"),
+        ("quantity", "integer"),
+        ("price", "number"),
+    ]
+)
+
+product = Validator(
+    [
+        ("name", "string"),
+        ("price", "number"),
+    ]
+)
@@ -33,3 +33,9 @@ class ShopCartFactory(factory.Factory):
     quantity = factory.Faker('pyint', min_value=0, max_value=1000000000)
     price = factory.Faker('pyfloat', min_value=0, max_value=10000)
 
+    @classmethod
+    def seed(cls, count, **kwargs):
+        """Builds count ShopCarts and inserts them in one transaction"""
+        shopcarts = cls.build_batch(count, **kwargs)
+        ShopCart.bulk_create(shopcarts)
+        return shopcarts
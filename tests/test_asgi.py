@@ -0,0 +1,156 @@
+"""
+Test cases for the asyncio variant of the ShopCart Service
+
+The service tests are skipped unless quart and the async driver of
+DATABASE_URI are installed, see requirements-async.txt.
+"""
+import sys
+import logging
+import subprocess
+import importlib.util
+from unittest import IsolatedAsyncioTestCase, TestCase, skipUnless
+from unittest.mock import patch
+from service import status  # HTTP Status Codes
+from service.models import CartEvent, DataValidationError, ShopCart, db, reset_db
+from service.routes import app as sync_app, init_db
+from config import DATABASE_URI
+
+DRIVER = "aiosqlite" if DATABASE_URI.startswith("sqlite") else "asyncpg"
+ASYNC_STACK = all(importlib.util.find_spec(name) for name in ("quart", DRIVER))
+BASE_URL = "/shopcarts"
+
+
+######################################################################
+#  I M P O R T   T E S T   C A S E S
+######################################################################
+class TestImports(TestCase):
+    """ Module Import Tests """
+
+    def test_models_without_service(self):
+        """Import the modules the asyncio variant uses without setting up the service"""
+        code = (
+            "import sys\n"
+            "from service import guards, models, status, validation\n"
+            "print(sorted(name for name in ('service.server', 'service.routes', 'service.jobs') if name in sys.modules))"
+        )
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+
+######################################################################
+#  A S Y N C   S E R V I C E   T E S T   C A S E S
+######################################################################
+@skipUnless(ASYNC_STACK, "quart and {} are not installed".format(DRIVER))
+class TestAsyncService(IsolatedAsyncioTestCase):
+    """ Asyncio Variant Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        sync_app.config["TESTING"] = True
+        sync_app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        sync_app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        from service import asgi  # pylint: disable=import-outside-toplevel
+        cls.asgi = asgi
+        asgi.app.config["TESTING"] = True
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        reset_db()
+        self.client = self.asgi.app.test_client()
+
+    async def asyncTearDown(self):
+        await self.asgi.engine.dispose()
+        db.session.remove()
+
+    async def _add(self, customer_id, product_id, quantity=1):
+        resp = await self.client.post("{}/{}/items".format(BASE_URL, customer_id), json={
+            "customer_id": customer_id, "product_id": product_id, "name": "item",
+            "quantity": quantity, "price": 2.5,
+        })
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return await resp.get_json()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    async def test_health(self):
+        """Answer the liveness and readiness probes"""
+        self.assertEqual((await self.client.get("/health/live")).status_code, status.HTTP_200_OK)
+        resp = await self.client.get("/health/ready")
+        self.assertEqual(await resp.get_json(), {"status": "ok", "checks": {"primary": "ok"}})
+
+    async def test_create_and_get(self):
+        """Create items and read them back in the shape of the sync service"""
+        item = await self._add(1, 1, quantity=2)
+        self.assertEqual(item, {"customer_id": 1, "product_id": 1, "name": "item", "quantity": 2, "price": 2.5})
+        await self._add(1, 2)
+        resp = await self.client.get("{}/1".format(BASE_URL))
+        self.assertEqual(len(await resp.get_json()), 2)
+        resp = await self.client.get("{}/1/items/2".format(BASE_URL))
+        self.assertEqual((await resp.get_json())["product_id"], 2)
+        resp = await self.client.get("{}/1/summary".format(BASE_URL))
+        self.assertEqual(await resp.get_json(),
+                         {"customer_id": 1, "item_count": 2, "quantity_total": 3, "subtotal": 7.5})
+        resp = await self.client.get(BASE_URL, query_string={"product_id": 2})
+        self.assertEqual(len(await resp.get_json()), 1)
+        resp = await self.client.get("/products/1/demand")
+        self.assertEqual(await resp.get_json(), {"product_id": 1, "cart_count": 1, "quantity_total": 2})
+
+    async def test_errors(self):
+        """Return the errors of the sync service"""
+        resp = await self.client.get("{}/9".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.post("{}/1/items".format(BASE_URL), data="x", headers={"Content-Type": "text/plain"})
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = await self.client.post("{}/1/items".format(BASE_URL), json={"customer_id": 1, "name": "x"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("errors", await resp.get_json())
+        await self._add(1, 1)
+        resp = await self.client.post("{}/1/items".format(BASE_URL), json={
+            "customer_id": 1, "product_id": 1, "name": "item", "quantity": 1, "price": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_refused_flush(self):
+        """Roll back and return a 400 when the flush refuses the changes"""
+        refusal = DataValidationError("Product 1 cannot be written")
+        with patch("service.models.write_products", side_effect=refusal):
+            resp = await self.client.post("{}/1/items".format(BASE_URL), json={
+                "customer_id": 1, "product_id": 1, "name": "item", "quantity": 1, "price": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(await resp.get_json(), {
+            "status_code": 400, "error": "Bad Request", "message": "Product 1 cannot be written",
+            "errors": [{"field": None, "message": "Product 1 cannot be written"}],
+        })
+        await self._add(1, 1)
+        with patch("service.models.fill_products", side_effect=refusal):
+            resp = await self.client.put("{}/1/items/1".format(BASE_URL), json={
+                "customer_id": 1, "product_id": 1, "name": "item", "quantity": 5, "price": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 1)
+
+    async def test_update_delete_checkout(self):
+        """Change items and record every change in the outbox"""
+        await self._add(1, 1)
+        await self._add(1, 2)
+        await self._add(2, 1)
+        resp = await self.client.put("{}/1/items/1".format(BASE_URL), json={
+            "customer_id": 1, "product_id": 1, "name": "item", "quantity": 5, "price": 2.5})
+        self.assertEqual((await resp.get_json())["quantity"], 5)
+        resp = await self.client.delete("{}/1/items/2".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.put("{}/1/checkout".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = await self.client.delete("{}/2".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual((await self.client.get("{}/1".format(BASE_URL))).status_code, status.HTTP_404_NOT_FOUND)
+        ops = [event.op for event in CartEvent.query.order_by(CartEvent.id)]
+        self.assertEqual(ops, ["create", "create", "create", "update", "delete", "checkout", "delete"])
@@ -0,0 +1,125 @@
+"""
+Test cases for Bulk Import and Export
+"""
+import io
+import json
+import logging
+from unittest import TestCase
+from service import bulk
+from service.models import Cart, CartEvent, ProductCounter, ShopCart, DataValidationError, db
+from service.routes import app, init_db
+from .factories import ShopCartFactory
+from config import DATABASE_URI
+
+
+######################################################################
+#  B U L K   T E S T   C A S E S
+######################################################################
+class TestBulk(TestCase):
+    """ Bulk Import and Export Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        ShopCartFactory.reset_sequence()
+
+    def test_round_trip_csv(self):
+        """Export and re-import the table as CSV"""
+        for shopcart in ShopCartFactory.create_batch(5):
+            shopcart.create()
+        output = io.StringIO()
+        self.assertEqual(bulk.copy_to(output, "csv"), 5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "customer_id,product_id,name,quantity,price")
+        self.assertEqual(len(lines), 6)
+        ShopCart.query.delete()
+        db.session.commit()
+        self.assertEqual(bulk.import_rows(io.StringIO(output.getvalue()), "csv", batch_size=2), 5)
+        self.assertEqual(len(ShopCart.all()), 5)
+
+    def test_round_trip_ndjson(self):
+        """Export and re-import the table as NDJSON"""
+        for shopcart in ShopCartFactory.create_batch(3):
+            shopcart.create()
+        exported = "".join(bulk.export_rows("ndjson", batch_size=2))
+        records = [json.loads(line) for line in exported.splitlines()]
+        self.assertEqual([record["customer_id"] for record in records], [0, 1, 2])
+        ShopCart.query.delete()
+        db.session.commit()
+        self.assertEqual(bulk.import_rows(io.StringIO(exported), "ndjson"), 3)
+        self.assertEqual(ShopCart.find((1, 1)).serialize(), records[1])
+
+    def test_import_is_atomic(self):
+        """Leave the table untouched when a row is invalid"""
+        data = 'customer_id,product_id,name,quantity,price\n1,1,ok,1,1.0\n2,2,bad,many,1.0\n'
+        self.assertRaises(DataValidationError, bulk.import_rows, io.StringIO(data), "csv", 1)
+        self.assertEqual(ShopCart.all(), [])
+
+    def test_import_bad_values(self):
+        """Reject the rows parse_row rejects, with the line they are on"""
+        data = 'customer_id,product_id,name,quantity,price\n1,1,ok,1,1.0\n2,2,bad,1.5,1.0\n'
+        with self.assertRaises(DataValidationError) as context:
+            bulk.import_rows(io.StringIO(data), "csv")
+        self.assertIn("line 3: quantity must be an integer", str(context.exception))
+        data = 'customer_id,product_id,name,quantity,price\n1,1,ok,1,\n'
+        self.assertRaises(DataValidationError, bulk.import_rows, io.StringIO(data), "csv")
+        self.assertEqual(ShopCart.all(), [])
+
+    def test_import_updates_carts(self):
+        """Keep the headers, counters and outbox of the imported carts"""
+        ShopCart(customer_id=1, product_id=1, name="item", quantity=1, price=1).create()
+        ShopCart.checkout_cart(1)
+        ShopCart(customer_id=3, product_id=3, name="other", quantity=4, price=1).create()
+        events = CartEvent.query.count()
+        data = 'customer_id,product_id,name,quantity,price\n1,1,item,2,1.0\n2,1,item,3,1.0\n'
+        self.assertEqual(bulk.import_rows(io.StringIO(data), "csv"), 2)
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 2)
+        self.assertEqual(Cart.check(), [])
+        self.assertEqual(Cart.find(3).quantity_total, 4)
+        self.assertEqual(ProductCounter.totals(1), (2, 5))
+        created = CartEvent.query.filter(CartEvent.id > events).order_by(CartEvent.id).all()
+        self.assertEqual([(event.op, event.customer_id) for event in created], [("create", 1), ("create", 2)])
+        self.assertEqual(created[1].after["quantity"], 3)
+
+    def test_import_keeps_other_prices(self):
+        """Keep the prices of other customers when a row disagrees with the catalog"""
+        ShopCart(customer_id=1, product_id=1, name="item", quantity=1, price=1).create()
+        data = 'customer_id,product_id,name,quantity,price\n2,1,item,1,3000\n'
+        self.assertEqual(bulk.import_rows(io.StringIO(data), "csv"), 1)
+        self.assertEqual(ShopCart.find((1, 1)).price, 1.0)
+        self.assertEqual(ShopCart.find((2, 1)).price, 3000.0)
+        self.assertEqual(Cart.find(1).serialize()["subtotal"], 1.0)
+        output = io.StringIO()
+        bulk.copy_to(output, "csv")
+        self.assertEqual(output.getvalue().splitlines()[1:], ["1,1,item,1,1.0", "2,1,item,1,3000.0"])
+
+    def test_import_duplicates(self):
+        """Reject rows that already exist"""
+        ShopCart(customer_id=1, product_id=1, name="item", quantity=1, price=1).create()
+        data = '{"customer_id": 1, "product_id": 1, "name": "item", "quantity": 2, "price": 1}\n'
+        self.assertRaises(DataValidationError, bulk.import_rows, io.StringIO(data), "ndjson")
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 1)
+
+    def test_unsupported_format(self):
+        """Reject unknown formats"""
+        self.assertRaises(DataValidationError, list, bulk.export_rows("xml"))
+        self.assertRaises(DataValidationError, bulk.import_rows, io.StringIO(""), "xml")
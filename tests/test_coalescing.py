@@ -0,0 +1,158 @@
+"""
+Test cases for Request Coalescing
+"""
+import time
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from service import status  # HTTP Status Codes
+from service import coalescing
+from service.models import ShopCart, db, reset_db
+from service.routes import app, init_db
+from tests.factories import ShopCartFactory
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+
+
+def wait_until(condition, timeout=5):
+    """ Polls condition until it is true or the timeout passes """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """ Single Flight Tests """
+
+    def _burst(self, flights, function, count=8):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flights.do("key", function))
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_share_one_call(self):
+        """Run one call for concurrent callers of the same key"""
+        flights = coalescing.SingleFlight()
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return object()
+
+        threads, results, _ = self._burst(flights, slow)
+        wait_until(lambda: flights.shared == 7)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(flights.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result is results[0] for result in results))
+        # nothing is kept once the call is over
+        self.assertEqual(flights.do("key", lambda: 2), 2)
+
+    def test_share_errors(self):
+        """Raise the error of the shared call in every caller"""
+        flights = coalescing.SingleFlight()
+        release = threading.Event()
+
+        def failing():
+            release.wait(5)
+            raise ValueError("boom")
+
+        threads, _, errors = self._burst(flights, failing, count=3)
+        wait_until(lambda: flights.shared == 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(flights.calls, 1)
+        self.assertEqual(len(errors), 3)
+
+
+######################################################################
+#  C O A L E S C E D   R O U T E   T E S T   C A S E S
+######################################################################
+class TestCoalescedRoutes(TestCase):
+    """ Coalesced Route Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        coalescing.init_coalescing(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        reset_db()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_concurrent_reads(self):
+        """Share one query between concurrent reads of a cart"""
+        ShopCartFactory.seed(3, customer_id=1)
+        flights = coalescing.flights
+        shared = flights.shared
+        find = ShopCart.list_by_customer_id
+        calls = []
+
+        def slow_find(customer_id):
+            calls.append(customer_id)
+            wait_until(lambda: flights.shared - shared >= 5)
+            return find(customer_id)
+
+        responses = []
+
+        def get(url):
+            with app.test_client() as client:
+                responses.append(client.get(url))
+
+        with patch.object(ShopCart, "list_by_customer_id", side_effect=slow_find):
+            threads = [
+                threading.Thread(target=get, args=(url,))
+                for url in ["{}/1".format(BASE_URL), "{}/1/items".format(BASE_URL)] * 3
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual([resp.status_code for resp in responses], [status.HTTP_200_OK] * 6)
+        self.assertTrue(all(resp.get_json() == responses[0].get_json() for resp in responses))
+        self.assertEqual(len(responses[0].get_json()), 3)
+
+    def test_writes_forget_reads(self):
+        """Start a new query after a cart changes"""
+        flights = coalescing.flights
+        key = ("get_shopcarts", (("customer_id", 1),), False)
+        other = ("get_shopcarts", (("customer_id", 2),), False)
+        flights._flights.update({key: object(), other: object()})  # pylint: disable=protected-access
+        with app.test_client() as client:
+            resp = client.post("{}/1/items".format(BASE_URL), content_type="application/json",
+                               json={"customer_id": 1, "product_id": 1, "name": "x", "quantity": 1, "price": 1})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn(key, flights._flights)  # pylint: disable=protected-access
+        self.assertIn(other, flights._flights)  # pylint: disable=protected-access
+        flights.forget(other)
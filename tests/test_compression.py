@@ -0,0 +1,138 @@
+"""
+Test cases for Response Compression and Static Assets
+"""
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+from flask import request
+from service import status  # HTTP Status Codes
+from service import assets, compression
+from service.models import db, reset_db
+from service.routes import app, init_db
+from tests.factories import ShopCartFactory
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(TestCase):
+    """ Response Compression Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        compression.init_compression(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        reset_db()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_gzip_large_list(self):
+        """Compress a large cart list with gzip"""
+        ShopCartFactory.seed(50)
+        plain = self.app.get(BASE_URL)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        resp = self.app.get(BASE_URL, headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertLess(len(resp.data), len(plain.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+    def test_small_response(self):
+        """Send responses below the threshold uncompressed"""
+        ShopCartFactory.seed(1)
+        resp = self.app.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(len(resp.get_json()), 1)
+
+    def test_negotiate(self):
+        """Pick the encoding with the highest quality"""
+        with app.test_request_context(headers={"Accept-Encoding": "gzip;q=0.5, br;q=1.0"}):
+            self.assertEqual(compression.negotiate(request.accept_encodings, ("br", "gzip")), "br")
+            self.assertEqual(compression.negotiate(request.accept_encodings, ("gzip",)), "gzip")
+        with app.test_request_context(headers={"Accept-Encoding": "identity"}):
+            self.assertIsNone(compression.negotiate(request.accept_encodings, ("gzip",)))
+
+    def test_api_cache_control(self):
+        """Mark API responses as private"""
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.headers["Cache-Control"], compression.API_CACHE_CONTROL)
+
+
+######################################################################
+#  S T A T I C   A S S E T   T E S T   C A S E S
+######################################################################
+class TestAssets(TestCase):
+    """ Static Asset Tests """
+
+    def setUp(self):
+        """Runs before each test"""
+        self.static_folder = app.static_folder
+        self.tempdir = tempfile.TemporaryDirectory()
+        app.static_folder = os.path.join(self.tempdir.name, "static")
+        shutil.copytree(self.static_folder, app.static_folder, ignore=shutil.ignore_patterns(assets.DIST))
+        app.extensions.pop("assets", None)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.static_folder
+        app.extensions.pop("assets", None)
+        self.tempdir.cleanup()
+
+    def test_without_build(self):
+        """Serve the original index.html when the assets are not built"""
+        resp = self.app.get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(b"static/js/rest_api.js", resp.data)
+        resp.close()
+
+    def test_fingerprinted_assets(self):
+        """Serve fingerprinted, precompressed assets with long cache headers"""
+        manifest = assets.build(app.static_folder)
+        target = manifest["js/rest_api.js"]
+        self.assertRegex(target, r"^js/rest_api\.[0-9a-f]{12}\.js$")
+        self.assertTrue(os.path.isfile(os.path.join(app.static_folder, assets.DIST, target + ".gz")))
+        icon = manifest["images/newapp-icon.png"]
+        self.assertFalse(os.path.exists(os.path.join(app.static_folder, assets.DIST, icon + ".gz")))
+
+        resp = self.app.get("/")
+        self.assertIn(("assets/" + target).encode(), resp.data)
+        self.assertNotIn(b"static/js/rest_api.js", resp.data)
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+
+        resp = self.app.get("/assets/" + target, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("javascript", resp.mimetype)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age={}".format(assets.MAX_AGE), resp.headers["Cache-Control"])
+        with open(os.path.join(app.static_folder, "js", "rest_api.js"), "rb") as file:
+            self.assertEqual(gzip.decompress(resp.data), file.read())
+        resp.close()
+
+        resp = self.app.get("/assets/" + target)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
+        self.assertEqual(self.app.get("/assets/js/missing.js").status_code, status.HTTP_404_NOT_FOUND)
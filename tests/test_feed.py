@@ -0,0 +1,177 @@
+"""
+Test cases for the Cart Change Feed
+"""
+import json
+import time
+import logging
+from datetime import datetime
+from unittest import TestCase, skipIf, skipUnless
+from sqlalchemy import func
+from service import status  # HTTP Status Codes
+from service import feed
+from service.models import CartEvent, ShopCart, DataValidationError, db, reset_db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+EVENTS_URL = "/admin/shopcarts/events"
+ADMIN_KEY = "secret"
+
+
+######################################################################
+#  C H A N G E   F E E D   T E S T   C A S E S
+######################################################################
+class TestChangeFeed(TestCase):
+    """ Change Feed Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        cls.saved = {key: app.config[key] for key in
+                     ("FEED_SETTLE_SECONDS", "FEED_POLL_INTERVAL", "STREAM_MAX_SECONDS")}
+        app.config.update(FEED_SETTLE_SECONDS=0, FEED_POLL_INTERVAL=0.05, STREAM_MAX_SECONDS=0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        app.config.update(cls.saved)
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        reset_db()
+        app.config["ADMIN_API_KEY"] = ADMIN_KEY
+        self.client = app.test_client()
+        self.client.environ_base["HTTP_X_API_KEY"] = ADMIN_KEY
+
+    def tearDown(self):
+        app.config["ADMIN_API_KEY"] = None
+        db.session.remove()
+
+    def _add(self, customer_id, product_id, quantity=1):
+        item = ShopCart(customer_id=customer_id, product_id=product_id, name="item",
+                        price=2.5, quantity=quantity)
+        item.create()
+        return item
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_record_changes(self):
+        """Record an event for every change to a cart"""
+        item = self._add(1, 1)
+        item.quantity = 3
+        item.update()
+        ShopCart.find((1, 1)).delete()
+        self._add(2, 1)
+        ShopCart.checkout_cart(2)
+        resp = self.client.get(EVENTS_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        events = resp.get_json()["events"]
+        self.assertEqual([event["op"] for event in events],
+                         ["create", "update", "delete", "create", "checkout"])
+        create, update = events[0], events[1]
+        self.assertIsNone(create["before"])
+        self.assertEqual(create["after"]["quantity"], 1)
+        self.assertEqual(update["before"]["quantity"], 1)
+        self.assertEqual(update["after"]["quantity"], 3)
+        self.assertIsNone(events[2]["after"])
+        self.assertEqual(events[4]["customer_id"], 2)
+
+    def test_page_with_cursor(self):
+        """Read the feed a page at a time"""
+        for product_id in range(5):
+            self._add(product_id, product_id)
+        resp = self.client.get(EVENTS_URL, query_string={"limit": 3})
+        first = resp.get_json()
+        self.assertEqual(len(first["events"]), 3)
+        resp = self.client.get(EVENTS_URL, query_string={"limit": 3, "cursor": first["cursor"]})
+        second = resp.get_json()
+        self.assertEqual(len(second["events"]), 2)
+        seen = [event["customer_id"] for event in first["events"] + second["events"]]
+        self.assertEqual(sorted(seen), list(range(5)))
+        resp = self.client.get(EVENTS_URL, query_string={"cursor": second["cursor"]})
+        self.assertEqual(resp.get_json(), {"events": [], "cursor": second["cursor"]})
+
+    def test_invalid_cursor(self):
+        """Reject a cursor that was not returned by the feed"""
+        resp = self.client.get(EVENTS_URL, query_string={"cursor": "nope"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(EVENTS_URL, query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertRaises(DataValidationError, feed.decode_cursor, "1.2.3", 2)
+        self.assertRaises(DataValidationError, feed.decode_cursor, "12", 1)
+        self.assertEqual(feed.decode_cursor(feed.encode_cursor([(7, 3), (0, 9)]), 2), [(7, 3), (0, 9)])
+
+    def test_admin_key(self):
+        """Require the admin key to read the feed"""
+        client = app.test_client()
+        self.assertEqual(client.get(EVENTS_URL).status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = client.get(EVENTS_URL, headers={"X-Api-Key": ADMIN_KEY})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_long_poll(self):
+        """Return an empty page once the wait is over"""
+        resp = self.client.get(EVENTS_URL, query_string={"wait": 0.1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["events"], [])
+
+    @skipIf(DATABASE_URI.startswith("postgres"), "PostgreSQL holds back events by transaction")
+    def test_settle_delay(self):
+        """Hold back events younger than the settle delay"""
+        self._add(1, 1)
+        events, cursor = feed.read_events(app, None, 10, settle=60)
+        self.assertEqual(events, [])
+        self.assertEqual(feed.decode_cursor(cursor, len(feed.sharding.shard_indexes(app))),
+                         [(0, 0)] * len(feed.sharding.shard_indexes(app)))
+
+    @skipUnless(DATABASE_URI.startswith("postgres"), "the transaction watermark needs PostgreSQL")
+    def test_open_transaction(self):
+        """Read the event of a transaction that commits late, after newer ones"""
+        table = CartEvent.__table__
+        insert = table.insert().values(xid=func.txid_current())
+        event = {"customer_id": 1, "product_id": 1, "op": "create", "created_at": datetime.utcnow()}
+        with db.engine.connect() as older, db.engine.connect() as slow:
+            # the older transaction takes its xid first, the slow one takes the first event id
+            older_transaction = older.begin()
+            older.execute(func.txid_current().select())
+            slow_transaction = slow.begin()
+            slow.execute(insert, dict(event, customer_id=2))
+            older.execute(insert, dict(event, customer_id=1))
+            older_transaction.commit()
+            time.sleep(0.2)
+            events, cursor = feed.read_events(app, None, 10, settle=0.1)
+            db.session.rollback()
+            self.assertEqual([event["customer_id"] for event in events], [1])
+            slow_transaction.commit()
+        events, cursor = feed.read_events(app, cursor, 10, settle=0.1)
+        self.assertEqual([event["customer_id"] for event in events], [2])
+
+    def test_stream(self):
+        """Stream the events as server-sent events"""
+        self._add(1, 1)
+        self._add(1, 2)
+        resp = self.client.get(EVENTS_URL + "/stream")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        messages = [message for message in resp.get_data(as_text=True).split("\n\n") if message.startswith("id:")]
+        self.assertEqual(len(messages), 2)
+        lines = messages[1].split("\n")
+        self.assertEqual(json.loads(lines[2][len("data: "):])["product_id"], 2)
+        # resuming after the first event only sends the second one
+        cursor = messages[0].split("\n")[0][len("id: "):]
+        resp = self.client.get(EVENTS_URL + "/stream", headers={"Last-Event-ID": cursor})
+        self.assertEqual(resp.get_data(as_text=True).count("\nevent: cart\n"), 1)
+
+    def test_no_events_on_rollback(self):
+        """Write no events when the change is rolled back"""
+        db.session.add(ShopCart(customer_id=1, product_id=1, name="item", price=1, quantity=1))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(CartEvent.query.count(), 0)
@@ -0,0 +1,114 @@
+"""
+Test cases for the Warmup and Health Checks
+"""
+import time
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from service import status  # HTTP Status Codes
+from service import health
+from service.models import db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+
+######################################################################
+#  H E A L T H   T E S T   C A S E S
+######################################################################
+class TestHealth(TestCase):
+    """ Warmup and Health Check Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.saved = app.extensions["health"]
+        app.extensions["health"] = health.HealthCheck(timeout=0.5, interval=0)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions["health"] = self.saved
+        db.session.remove()
+
+    def test_liveness(self):
+        """Answer the liveness probe without the database"""
+        with patch.object(health, "ping", side_effect=AssertionError("no database")):
+            resp = self.client.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"status": "ok"})
+
+    def test_ready(self):
+        """Answer the readiness probe once warmed up"""
+        self.assertTrue(health.warmup(app))
+        resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"status": "ok", "checks": {"primary": "ok"}})
+
+    def test_not_warmed(self):
+        """Warm up a worker whose warmup failed before reporting it ready"""
+        with patch.object(health, "warmup", return_value=False) as warmup:
+            resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        warmup.assert_called_once_with(app)
+        resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_database_down(self):
+        """Report the database that cannot be reached"""
+        app.extensions["health"].warmed = True
+        with patch.object(health, "ping", return_value={"primary": "OperationalError"}):
+            resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["checks"], {"primary": "OperationalError"})
+
+    def test_timeout(self):
+        """Time out a hung check and keep a single one running"""
+        app.extensions["health"].warmed = True
+        release = threading.Event()
+        calls = []
+
+        def hung(*args):
+            calls.append(args)
+            release.wait(5)
+            return {"primary": "ok"}
+
+        with patch.object(health, "ping", side_effect=hung):
+            began = time.monotonic()
+            resp = self.client.get("/health/ready")
+            self.assertLess(time.monotonic() - began, 2)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.get_json()["checks"], {"primary": "timeout"})
+            self.client.get("/health/ready")
+            self.assertEqual(len(calls), 1)
+            release.set()
+            resp = self.client.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_cached_checks(self):
+        """Reuse a check within the interval"""
+        app.extensions["health"] = health.HealthCheck(timeout=0.5, interval=60)
+        app.extensions["health"].warmed = True
+        with patch.object(health, "ping", return_value={"primary": "ok"}) as ping:
+            for _ in range(3):
+                self.assertEqual(self.client.get("/health/ready").status_code, status.HTTP_200_OK)
+        self.assertEqual(ping.call_count, 1)
+
+    def test_warmup_failure(self):
+        """Report a warmup that could not reach the database"""
+        with patch.object(health, "_engines", side_effect=RuntimeError("down")):
+            self.assertFalse(health.warmup(app))
+        self.assertFalse(app.extensions["health"].warmed)
@@ -0,0 +1,110 @@
+"""
+Test cases for the Background Jobs
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+from service import jobs
+from service.models import CartEvent, ShopCart, ShopCartArchive, db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+
+######################################################################
+#  J O B   T E S T   C A S E S
+######################################################################
+class TestJobs(TestCase):
+    """ Background Job Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_purge_job(self):
+        """Run the purge job and report the rows reclaimed"""
+        old = datetime.utcnow() - timedelta(days=30)
+        ShopCart(customer_id=1, product_id=1, name="old", price=1, quantity=1, last_modified=old).create()
+        ShopCart(customer_id=2, product_id=1, name="new", price=1, quantity=1).create()
+        app.config["CART_TTL_SECONDS"] = 60
+        job = jobs.PeriodicJob(app, "purge", 60, jobs.purge_expired_carts)
+        self.assertEqual(job.run_once(), 1)
+        self.assertEqual(len(ShopCart.all()), 1)
+
+    def test_failed_job(self):
+        """A failing job is logged and does not raise"""
+        def broken(_app):
+            raise RuntimeError("boom")
+        job = jobs.PeriodicJob(app, "broken", 60, broken)
+        self.assertIsNone(job.run_once())
+
+    def test_purge_events_job(self):
+        """Delete the outbox events past their retention"""
+        ShopCart(customer_id=1, product_id=1, name="item", price=1, quantity=1).create()
+        ShopCart.find((1, 1)).delete()
+        CartEvent.query.filter(CartEvent.op == "create").update(
+            {"created_at": datetime.utcnow() - timedelta(days=30)}
+        )
+        db.session.commit()
+        app.config["EVENT_RETENTION_SECONDS"] = 24 * 60 * 60
+        job = jobs.PeriodicJob(app, "purge-events", 60, jobs.purge_old_events)
+        self.assertEqual(job.run_once(), 1)
+        self.assertEqual([event.op for event in CartEvent.query.all()], ["delete"])
+
+    def test_archive_job(self):
+        """Move the checked out items to the archive"""
+        for product_id in range(1, 4):
+            ShopCart(customer_id=1, product_id=product_id, name="item", price=1, quantity=1).create()
+        ShopCart.find((1, 1)).checkout()
+        app.config["ARCHIVE_BATCH_SIZE"] = 1
+        job = jobs.PeriodicJob(app, "archive", 60, jobs.archive_checked_out)
+        self.assertEqual(job.run_once(), 1)
+        self.assertEqual(job.run_once(), 0)
+        self.assertEqual(ShopCartArchive.query.count(), 1)
+        app.config["ARCHIVE_BATCH_SIZE"] = 500
+
+    def test_no_jobs_on_import(self):
+        """Do not start jobs in a process that only imports the service"""
+        names = {"purge-expired-carts", "purge-old-events", "archive-checked-out"}
+        self.assertEqual([thread for thread in threading.enumerate() if thread.name in names], [])
+
+    def test_start_jobs_disabled(self):
+        """Do not start the jobs unless an interval is configured"""
+        app.config["CART_PURGE_INTERVAL"] = 0
+        app.config["ARCHIVE_INTERVAL"] = 0
+        self.assertEqual(jobs.start_jobs(app), [])
+
+    def test_start_and_stop_jobs(self):
+        """Start the jobs when an interval is configured"""
+        app.config["CART_PURGE_INTERVAL"] = 3600
+        app.config["ARCHIVE_INTERVAL"] = 3600
+        app.config["CART_TTL_SECONDS"] = 60
+        started = jobs.start_jobs(app)
+        app.config["CART_PURGE_INTERVAL"] = 0
+        app.config["ARCHIVE_INTERVAL"] = 0
+        self.assertEqual([job.name for job in started],
+                         ["purge-expired-carts", "purge-old-events", "archive-checked-out"])
+        for job in started:
+            self.assertTrue(job.is_alive())
+            job.stop()
+            job.join(timeout=5)
+            self.assertFalse(job.is_alive())
@@ -4,8 +4,12 @@ Test cases for ShopCart Model
 import logging
 import unittest
 import os
+from datetime import datetime, timedelta
 from werkzeug.exceptions import NotFound
-from service.models import ShopCart, DataValidationError, db
+from sqlalchemy.exc import IntegrityError
+from service.models import (
+    Cart, CartRow, Product, ProductCounter, ShopCart, ShopCartArchive, DataValidationError, db, product_cache, reset_db
+)
 from service import app
 from config import DATABASE_URI
 from .factories import ShopCartFactory
@@ -28,18 +32,23 @@ class TestShopCart(unittest.TestCase):
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
+        db.drop_all()
 
     def setUp(self):
         """This runs before each test"""
-        db.drop_all()  # clean up the last tests
-        db.create_all()  # make our sqlalchemy tables
+        reset_db()  # clean up the last tests
 
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
-        db.drop_all()
         ShopCartFactory.reset_sequence()
 
+    @staticmethod
+    def _insert_shopcarts(*rows):
+        """Inserts the rows of test items with multi-row INSERTs"""
+        ShopCart.insert_rows(rows)
+        db.session.commit()
+
     ######################################################################
     #  T E S T   C A S E S
     ######################################################################
@@ -113,9 +122,7 @@ class TestShopCart(unittest.TestCase):
         shopcarts = ShopCart.all()
         self.assertEqual(shopcarts, [])
         # Create 5 ShopCarts
-        for i in range(5):
-            shopcart = ShopCartFactory()
-            shopcart.create()
+        ShopCartFactory.seed(5)
         # See if we get back 5 shopcarts
         shopcarts = ShopCart.all()
         self.assertEqual(len(shopcarts), 5)
@@ -166,9 +173,7 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_shopcart(self):
         """Find a ShopCart by ID"""
-        shopcarts = ShopCartFactory.create_batch(3)
-        for shopcart in shopcarts:
-            shopcart.create()
+        shopcarts = ShopCartFactory.seed(3)
         logging.debug(shopcarts)
         # make sure they got saved
         self.assertEqual(len(ShopCart.all()), 3)
@@ -182,17 +187,57 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_by_customer_id(self):
         """Find a ShopCart by customer id"""
-        ShopCart(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1).create()
-        ShopCart(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2).create()
+        self._insert_shopcarts(
+            dict(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1),
+            dict(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2),
+        )
 
         shopcarts = ShopCart.find_by_customer_id(3)
         self.assertEqual(shopcarts[0].price, 50)
         self.assertEqual(shopcarts[0].quantity, 2)
+
+    def test_list_by_customer_id(self):
+        """List the ShopCarts of a customer"""
+        ShopCartFactory.seed(3, customer_id=4)
+        ShopCartFactory.seed(1, customer_id=5)
+        shopcarts = ShopCart.list_by_customer_id(4)
+        self.assertEqual(len(shopcarts), 3)
+        self.assertTrue(all(shopcart.customer_id == 4 for shopcart in shopcarts))
+        self.assertEqual(ShopCart.list_by_customer_id(6), [])
+
+    def test_find_in_session(self):
+        """Find the ShopCart the session already holds"""
+        self._insert_shopcarts(dict(name="a", customer_id=1, product_id=1, price=1, quantity=1))
+        shopcart = ShopCart.find((1, 1))
+        self.assertIs(ShopCart.find((1, 1)), shopcart)
+        shopcart.quantity = 7
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 7)
+        db.session.delete(shopcart)
+        db.session.flush()
+        self.assertIsNone(ShopCart.find((1, 1)))
+        db.session.rollback()
+        db.session.expunge_all()
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 1)
+        self.assertIsNone(ShopCart.find((1, 2)))
     
+    def test_rows(self):
+        """List items as CartRows"""
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=2, name="a", quantity=3, price=1.5),
+            dict(customer_id=2, product_id=4, name="b", quantity=1, price=2.0),
+        )
+        rows = ShopCart.rows()
+        self.assertEqual(sorted(rows), [CartRow(1, 2, "a", 3, 1.5), CartRow(2, 4, "b", 1, 2.0)])
+        self.assertEqual(rows[0]._asdict(), ShopCart.find((rows[0].customer_id, rows[0].product_id)).serialize())
+        self.assertEqual(ShopCart.rows(quantity="1"), [CartRow(2, 4, "b", 1, 2.0)])
+        self.assertEqual(ShopCart.rows(product_id="2"), [CartRow(1, 2, "a", 3, 1.5)])
+
     def test_find_by_price(self):
         """Find a ShopCarts by price"""
-        ShopCart(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1).create()
-        ShopCart(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2).create()
+        self._insert_shopcarts(
+            dict(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1),
+            dict(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2),
+        )
         shopcarts = ShopCart.find_by_price(50)
         self.assertEqual(shopcarts[0].customer_id, 3)
         self.assertEqual(shopcarts[0].product_id, 5)
@@ -200,8 +245,10 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_by_quantity(self):
         """Find a ShopCarts by quantity"""
-        ShopCart(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1).create()
-        ShopCart(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2).create()
+        self._insert_shopcarts(
+            dict(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1),
+            dict(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2),
+        )
         shopcarts = ShopCart.find_by_quantity(2)
         self.assertEqual(shopcarts[0].customer_id, 3)
         self.assertEqual(shopcarts[0].product_id, 5)
@@ -209,8 +256,10 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_by_product_id(self):
         """Find a ShopCarts by product_id"""
-        ShopCart(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1).create()
-        ShopCart(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2).create()
+        self._insert_shopcarts(
+            dict(name="MyCart1", customer_id=12, product_id=3, price=100, quantity=1),
+            dict(name="MyCart2", customer_id=3, product_id=5, price=50, quantity=2),
+        )
         shopcarts = ShopCart.find_by_product_id(5)
         self.assertEqual(shopcarts[0].customer_id, 3)
         self.assertEqual(shopcarts[0].quantity, 2)
@@ -218,9 +267,7 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_or_404_found(self):
         """Find or return 404 found"""
-        shopcarts = ShopCartFactory.create_batch(3)
-        for shopcart in shopcarts:
-            shopcart.create()
+        shopcarts = ShopCartFactory.seed(3)
 
         shopcart = ShopCart.find_or_404((shopcarts[1].product_id, shopcarts[1].product_id))
         self.assertIsNot(shopcart, None)
@@ -230,4 +277,284 @@ class TestShopCart(unittest.TestCase):
 
     def test_find_or_404_not_found(self):
         """Find or return 404 NOT found"""
-        self.assertRaises(NotFound, ShopCart.find_or_404, (0, 0))
\ No newline at end of file
+        self.assertRaises(NotFound, ShopCart.find_or_404, (0, 0))
+
+    def test_last_modified(self):
+        """Set the last modified timestamp on create and update"""
+        shopcart = ShopCartFactory()
+        shopcart.create()
+        self.assertIsNotNone(shopcart.last_modified)
+        created = shopcart.last_modified
+        shopcart.quantity += 1
+        shopcart.update()
+        self.assertGreaterEqual(shopcart.last_modified, created)
+
+    def test_purge_expired(self):
+        """Purge the carts that have expired in batches"""
+        self._insert_shopcarts(
+            *(dict(customer_id=1, product_id=product_id, name="old", price=1, quantity=1) for product_id in range(5)),
+            dict(customer_id=2, product_id=1, name="old", price=1, quantity=1),
+            dict(customer_id=2, product_id=2, name="new", price=1, quantity=1),
+            dict(customer_id=3, product_id=1, name="new", price=1, quantity=1),
+        )
+        old = datetime.utcnow() - timedelta(days=30)
+        ShopCart.query.filter(
+            (ShopCart.customer_id == 1) | ((ShopCart.customer_id == 2) & (ShopCart.product_id == 1))
+        ).update({"last_modified": old})
+        db.session.commit()
+        reclaimed = ShopCart.purge_expired(ttl=24 * 60 * 60, batch_size=2)
+        self.assertEqual(reclaimed, 5)
+        self.assertEqual(ShopCart.find_by_customer_id(1).count(), 0)
+        self.assertIsNone(Cart.find(1))
+        self.assertEqual(Cart.find(2).item_count, 2)
+        # a cart with one recent item is still alive
+        self.assertEqual(ShopCart.find_by_customer_id(2).count(), 2)
+        self.assertEqual(ShopCart.find_by_customer_id(3).count(), 1)
+        self.assertEqual(ProductCounter.totals(1), (2, 2))
+        self.assertEqual(ProductCounter.check(), [])
+        self.assertEqual(ShopCart.purge_expired(ttl=24 * 60 * 60), 0)
+
+
+    def test_bulk_create(self):
+        """Seed many ShopCarts in one transaction"""
+        shopcarts = ShopCartFactory.seed(25)
+        self.assertEqual(len(ShopCart.all()), 25)
+        found = ShopCart.find_by_customer_id(shopcarts[3].customer_id).first()
+        self.assertEqual(found.product_id, shopcarts[3].product_id)
+        self.assertEqual(found.name, shopcarts[3].name)
+        # a duplicate key rolls the whole batch back
+        self.assertRaises(IntegrityError, ShopCart.bulk_create, [shopcarts[0]])
+        self.assertEqual(len(ShopCart.all()), 25)
+
+    def test_reset_db(self):
+        """Reset the database without dropping the tables"""
+        ShopCartFactory.seed(10)
+        reset_db()
+        self.assertEqual(ShopCart.all(), [])
+        ShopCartFactory.seed(1)
+        self.assertEqual(len(ShopCart.all()), 1)
+
+    def test_cart_header(self):
+        """Keep the cart header in step with its items"""
+        self.assertIsNone(Cart.find(1))
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=1, name="a", quantity=2, price=1.5),
+            dict(customer_id=1, product_id=2, name="b", quantity=1, price=4.0),
+            dict(customer_id=2, product_id=1, name="a", quantity=5, price=1.5),
+        )
+        self.assertEqual(Cart.find(1).serialize(),
+                         {"customer_id": 1, "item_count": 2, "quantity_total": 3, "subtotal": 7.0})
+        shopcart = ShopCart.find((1, 1))
+        shopcart.quantity = 4
+        shopcart.update()
+        self.assertEqual((Cart.find(1).quantity_total, Cart.find(1).serialize()["subtotal"]), (5, 10.0))
+        ShopCart.find((1, 2)).delete()
+        self.assertEqual(Cart.find(1).item_count, 1)
+        ShopCart.find((1, 1)).delete()
+        self.assertIsNone(Cart.find(1))
+        self.assertEqual(Cart.find(2).item_count, 1)
+        self.assertEqual(Cart.check(), [])
+
+    def test_cart_header_failed_flush(self):
+        """Leave the header alone when the item cannot be written"""
+        ShopCart(customer_id=1, product_id=1, name="a", quantity=2, price=1.5).create()
+        duplicate = ShopCart(customer_id=1, product_id=1, name="a", quantity=2, price=1.5)
+        self.assertRaises(IntegrityError, duplicate.create)
+        db.session.rollback()
+        self.assertEqual(Cart.find(1).item_count, 1)
+
+    def test_failed_commit_rolls_back(self):
+        """Leave nothing of a failed write in the session for the next one"""
+        ShopCart(customer_id=1, product_id=1, name="a", quantity=2, price=1.5).create()
+        duplicate = ShopCart(customer_id=1, product_id=1, name="a", quantity=2, price=1.5)
+        self.assertRaises(IntegrityError, duplicate.create)
+        self.assertNotIn(duplicate, db.session)
+        ShopCart(customer_id=2, product_id=5, name="b", quantity=1, price=2.0).create()
+        self.assertEqual(len(ShopCart.all()), 2)
+        shopcart = ShopCart.find((2, 5))
+        shopcart.quantity = 3
+        shopcart.product_id = None
+        self.assertRaises(DataValidationError, shopcart.update)
+        self.assertFalse(db.session.dirty)
+        self.assertEqual(ShopCart.find((2, 5)).quantity, 1)
+
+    def test_cart_header_check(self):
+        """Find and rebuild inconsistent cart headers"""
+        ShopCartFactory.seed(5, customer_id=3)
+        ShopCartFactory.seed(2, customer_id=4)
+        self.assertEqual(Cart.find(3).item_count, 5)
+        self.assertEqual(Cart.check(), [])
+        Cart.query.filter(Cart.customer_id == 3).update({"item_count": 9})
+        Cart.query.filter(Cart.customer_id == 4).delete()
+        db.session.commit()
+        self.assertEqual([mismatch[0] for mismatch in Cart.check()], [3, 4])
+        Cart.rebuild()
+        db.session.commit()
+        self.assertEqual(Cart.check(), [])
+        self.assertEqual(Cart.find(4).item_count, 2)
+
+    def test_repair_counts(self):
+        """Correct the headers and counters by the difference to their items"""
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=1, name="a", quantity=2, price=1.0),
+            dict(customer_id=2, product_id=1, name="a", quantity=3, price=1.0),
+        )
+        Cart.query.filter(Cart.customer_id == 1).update({"item_count": 4})
+        Cart.query.filter(Cart.customer_id == 2).delete()
+        ProductCounter.query.delete()
+        db.session.commit()
+        self.assertEqual(ProductCounter.check(), [(1, None, (2, 5))])
+        Cart.repair(Cart.check())
+        ProductCounter.repair(ProductCounter.check())
+        db.session.commit()
+        self.assertEqual(Cart.check(), [])
+        self.assertEqual(ProductCounter.check(), [])
+        self.assertEqual(Cart.find(2).quantity_total, 3)
+
+    def test_product_counter(self):
+        """Count the carts holding a product across counter slots"""
+        app.config["PRODUCT_COUNTER_SLOTS"] = 4
+        # one write per item, so the writes spread over the slots
+        for customer_id in range(1, 21):
+            ShopCart(customer_id=customer_id, product_id=9, name="hot", quantity=2, price=1.0).create()
+        self.assertEqual(ProductCounter.totals(9), (20, 40))
+        self.assertGreater(ProductCounter.query.filter_by(product_id=9).count(), 1)
+        shopcart = ShopCart.find((1, 9))
+        shopcart.quantity = 5
+        shopcart.update()
+        ShopCart.find((2, 9)).delete()
+        self.assertEqual(ProductCounter.totals(9), (19, 41))
+        self.assertEqual(ProductCounter.totals(8), (0, 0))
+        ProductCounter.rebuild([9])
+        db.session.commit()
+        self.assertEqual(ProductCounter.query.filter_by(product_id=9).count(), 1)
+        self.assertEqual(ProductCounter.totals(9), (19, 41))
+        app.config["PRODUCT_COUNTER_SLOTS"] = 16
+
+    def test_merge(self):
+        """Merge a guest cart into a customer cart"""
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=1, name="old", quantity=2, price=1.0),
+            dict(customer_id=1, product_id=2, name="kept", quantity=1, price=3.0),
+            dict(customer_id=9, product_id=1, name="new", quantity=3, price=1.5),
+            dict(customer_id=9, product_id=3, name="moved", quantity=4, price=2.0),
+        )
+        # the name and price of the item changed last are kept
+        ShopCart.query.filter(ShopCart.customer_id == 1).update(
+            {"last_modified": datetime.utcnow() - timedelta(hours=1)}
+        )
+        db.session.commit()
+        kept = ShopCart.find((1, 2))
+        shopcarts = ShopCart.merge(9, 1)
+        self.assertEqual([(shopcart.product_id, shopcart.name, shopcart.quantity, shopcart.price)
+                          for shopcart in shopcarts],
+                         [(1, "new", 5, 1.5), (2, "kept", 1, 3.0), (3, "moved", 4, 2.0)])
+        self.assertEqual(kept.quantity, 1)
+        self.assertEqual(ShopCart.list_by_customer_id(9), [])
+        self.assertIsNone(Cart.find(9))
+        self.assertEqual(Cart.find(1).serialize(),
+                         {"customer_id": 1, "item_count": 3, "quantity_total": 10, "subtotal": 18.5})
+        self.assertEqual(Cart.check(), [])
+        self.assertEqual(ProductCounter.totals(1), (1, 5))
+        self.assertEqual(ProductCounter.totals(3), (1, 4))
+        self.assertEqual(ShopCart.merge(9, 1)[0].quantity, 5)
+
+    def test_checkout(self):
+        """Hide checked out items and archive them later"""
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=1, name="a", quantity=2, price=1.0),
+            dict(customer_id=1, product_id=2, name="b", quantity=1, price=3.0),
+        )
+        shopcart = ShopCart.find((1, 1))
+        shopcart.checkout()
+        self.assertIsNone(ShopCart.find((1, 1)))
+        self.assertEqual([item.product_id for item in ShopCart.all()], [2])
+        self.assertEqual(ShopCart.find_by_customer_id(1).count(), 1)
+        self.assertEqual(Cart.find(1).item_count, 1)
+        self.assertEqual(ProductCounter.totals(1), (0, 0))
+        self.assertEqual(ShopCart.checkout_cart(1), 1)
+        self.assertEqual(ShopCart.checkout_cart(1), 0)
+        self.assertIsNone(Cart.find(1))
+        self.assertEqual(ShopCart.list_by_customer_id(1), [])
+        self.assertEqual(Cart.check(), [])
+        self.assertEqual(ShopCart.query.filter(ShopCart.checked_out_at.isnot(None)).count(), 2)
+        # the archive keeps the price paid, not the one of the catalog
+        Product.write(1, "a", 9.0)
+        self.assertEqual(ShopCart.archive_checked_out(batch_size=1), 2)
+        self.assertEqual(ShopCart.query.count(), 0)
+        archived = ShopCartArchive.query.order_by(ShopCartArchive.product_id).all()
+        self.assertEqual([(item.product_id, item.quantity, item.price) for item in archived],
+                         [(1, 2, 1.0), (2, 1, 3.0)])
+        self.assertTrue(all(item.checked_out_at and item.archived_at for item in archived))
+
+    def test_checkout_and_add_again(self):
+        """Add a product again before its checked out item is archived"""
+        ShopCart(customer_id=1, product_id=1, name="a", quantity=2, price=1.0).create()
+        ShopCart.checkout_cart(1)
+        ShopCart(customer_id=1, product_id=1, name="a", quantity=5, price=1.0).create()
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 5)
+        self.assertEqual(ShopCartArchive.query.count(), 1)
+        ShopCart.checkout_cart(1)
+        ShopCart.insert_rows([{"customer_id": 1, "product_id": 1, "name": "a", "quantity": 7, "price": 1.0}])
+        db.session.commit()
+        self.assertEqual(ShopCart.find((1, 1)).quantity, 7)
+        self.assertEqual(ShopCartArchive.query.count(), 2)
+        self.assertEqual(Cart.find(1).quantity_total, 7)
+
+    def test_repr(self):
+        """Identify a ShopCart by its keys only"""
+        shopcart = ShopCart(customer_id=1, product_id=2, name="secret", quantity=1, price=1.0)
+        self.assertEqual(repr(shopcart), "<ShopCart customer_id=[1] product_id=[2]>")
+
+    def test_product_catalog(self):
+        """Store a product once and read it through the cache"""
+        self._insert_shopcarts(
+            dict(customer_id=1, product_id=1, name="a", quantity=2, price=1.0),
+            dict(customer_id=2, product_id=1, name="a", quantity=1, price=1.0),
+        )
+        self.assertEqual(Product.query.count(), 1)
+        # a cart keeps its own price instead of changing the product
+        shopcart = ShopCart.find((1, 1))
+        shopcart.price = 2.5
+        shopcart.update()
+        ShopCart(customer_id=3, product_id=1, name="b", quantity=1, price=1.0).create()
+        self.assertEqual(db.session.get(Product, 1).price, 1.0)
+        self.assertEqual([(row.customer_id, row.name, row.price) for row in ShopCart.rows(product_id=1)],
+                         [(1, "a", 2.5), (2, "a", 1.0), (3, "b", 1.0)])
+        self.assertEqual([row.customer_id for row in ShopCart.rows(price=1.0)], [2, 3])
+        self.assertEqual([shopcart.customer_id for shopcart in ShopCart.find_by_price(2.5)], [1])
+        # a product change shows in every cart that does not override it
+        Product.write(1, "a", 3.0)
+        db.session.expunge_all()
+        hits = product_cache.hits
+        self.assertEqual(ShopCart.find((2, 1)).serialize(),
+                         {"customer_id": 2, "product_id": 1, "name": "a", "quantity": 1, "price": 3.0})
+        self.assertEqual(product_cache.hits, hits + 1)
+        self.assertEqual(ShopCart.find((1, 1)).price, 2.5)
+        self.assertEqual(ShopCart.find((3, 1)).name, "b")
+        self.assertEqual(Cart.find(1).serialize()["subtotal"], 5.0)
+        self.assertEqual(Cart.find(2).serialize()["subtotal"], 3.0)
+        # the price of the catalog drops the override
+        shopcart = ShopCart.find((1, 1))
+        shopcart.price = 3.0
+        shopcart.update()
+        self.assertIsNone(shopcart.price_override)
+        db.session.rollback()
+        product_cache.clear()
+        shopcart = ShopCart.find((1, 1))
+        shopcart.name = "b"
+        db.session.rollback()
+        self.assertEqual(shopcart.name, "a")
+        self.assertEqual(ShopCart.find((2, 1)).name, "a")
+
+    def test_merge_policies(self):
+        """Combine the items held by both carts with each policy"""
+        for policy, quantity in (("sum", 5), ("max", 3), ("newest", 2)):
+            reset_db()
+            ShopCart(customer_id=9, product_id=1, name="guest", quantity=3, price=1.0).create()
+            ShopCart(customer_id=1, product_id=1, name="customer", quantity=2, price=2.0).create()
+            shopcart = ShopCart.merge(9, 1, policy)[0]
+            self.assertEqual((shopcart.name, shopcart.quantity), ("customer", quantity))
+        self.assertRaises(DataValidationError, ShopCart.merge, 9, 1, "min")
+        self.assertRaises(DataValidationError, ShopCart.merge, 1, 1)
+
@@ -0,0 +1,144 @@
+"""
+Test cases for the Sampling Profiler
+"""
+import time
+import logging
+import threading
+from unittest import TestCase
+from flask import Flask
+from service import status  # HTTP Status Codes
+from service import profiler
+from service.models import db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+PROFILE_URL = "/admin/profile"
+HEADERS = {"X-Api-Key": "secret"}
+
+
+def busy_loop(stop):
+    """ Keeps a thread on the CPU until stop is set """
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def wait_for(profile):
+    """ Waits for the running profile to finish """
+    deadline = time.monotonic() + 10
+    while profile.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestProfiler(TestCase):
+    """ Sampling Profiler Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.saved = app.extensions.get("profiler")
+        self.profile = profiler.Profiler(interval=0.002, max_seconds=1)
+        app.extensions["profiler"] = self.profile
+        app.config["ADMIN_API_KEY"] = "secret"
+        self.client = app.test_client()
+        self.stop = threading.Event()
+        self.worker = threading.Thread(target=busy_loop, args=(self.stop,), name="busy worker")
+        self.worker.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.worker.join()
+        self.profile.stop()
+        app.extensions["profiler"] = self.saved
+        app.config["ADMIN_API_KEY"] = None
+
+    def test_collapsed_stacks(self):
+        """Count the stacks of the other threads in collapsed form"""
+        self.profile.start(0.2)
+        self.assertTrue(self.profile.running)
+        wait_for(self.profile)
+        result = self.profile.result
+        self.assertGreater(result["samples"], 10)
+        self.assertIsNone(result["memory"])
+        lines = result["collapsed"].splitlines()
+        busy = [line for line in lines if line.startswith("busy_worker;")]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(" ", 1)
+        self.assertIn("busy_loop (", stack)
+        self.assertGreater(int(count), 0)
+        # the sampler never samples itself
+        self.assertFalse([line for line in lines if line.startswith("profiler;")])
+
+    def test_memory_snapshot(self):
+        """List the lines that allocated memory during the profile"""
+        self.profile.start(0.2, memory=True)
+        held = [bytearray(1024) for _ in range(1000)]
+        wait_for(self.profile)
+        memory = self.profile.result["memory"]
+        self.assertGreaterEqual(memory["peak_bytes"], 1024 * 1000)
+        self.assertTrue(any(entry["file"].endswith("test_profiler.py") for entry in memory["top"]))
+        self.assertEqual(len(held), 1000)
+
+    def test_profile_routes(self):
+        """Start a profile and read it back through the API"""
+        resp = self.client.get(PROFILE_URL, headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.post(PROFILE_URL + "?seconds=0.2", headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(resp.get_json()["status"], "running")
+        resp = self.client.post(PROFILE_URL, headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.client.get(PROFILE_URL, headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        wait_for(self.profile)
+        resp = self.client.get(PROFILE_URL, headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertGreater(resp.get_json()["samples"], 0)
+        resp = self.client.get(PROFILE_URL + "?format=collapsed", headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/plain")
+        self.assertIn("busy_loop (", resp.get_data(as_text=True))
+
+    def test_profile_access(self):
+        """Hide the profiler unless it is enabled with an admin key"""
+        resp = self.client.post(PROFILE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = self.client.post(PROFILE_URL + "?seconds=0", headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        app.config["ADMIN_API_KEY"] = None
+        resp = self.client.post(PROFILE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        app.config["ADMIN_API_KEY"] = "secret"
+        app.extensions["profiler"] = None
+        resp = self.client.post(PROFILE_URL, headers=HEADERS)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(self.profile.running)
+
+    def test_init_profiler(self):
+        """Leave the profiler off unless it is enabled with an admin key"""
+        other = Flask("profiled")
+        other.config.update(PROFILER_ENABLED=True, ADMIN_API_KEY=None)
+        profiler.init_profiler(other)
+        self.assertIsNone(other.extensions["profiler"])
+        other.config["ADMIN_API_KEY"] = "secret"
+        profiler.init_profiler(other)
+        self.assertIsInstance(other.extensions["profiler"], profiler.Profiler)
+        other.config["PROFILER_ENABLED"] = False
+        profiler.init_profiler(other)
+        self.assertIsNone(other.extensions["profiler"])
@@ -0,0 +1,196 @@
+"""
+Test cases for Rate Limiting and Admission Control
+"""
+import logging
+from unittest import TestCase
+from service import status  # HTTP Status Codes
+from service import ratelimit
+from service.models import db, reset_db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+SETTINGS = (
+    "RATE_LIMIT_ENABLED", "CUSTOMER_RATE_BURST", "CLIENT_RATE_BURST", "MAX_CONCURRENT_REQUESTS", "TRUSTED_PROXY_HOPS",
+    "CLIENT_RATE_LIMIT",
+)
+
+
+class LocalRedis:
+    """A stand-in for a Redis client that runs the token bucket script in Python"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.calls = 0
+
+    def eval(self, script, numkeys, *keys_and_args):
+        assert script == ratelimit.TOKEN_BUCKET_SCRIPT
+        self.calls += 1
+        keys, now, args = keys_and_args[:numkeys], keys_and_args[numkeys], keys_and_args[numkeys + 1:]
+        taken = []
+        for index, key in enumerate(keys):
+            rate, capacity, cost = args[index * 3:index * 3 + 3]
+            tokens, updated = self.hashes.get(key, (capacity, now))
+            taken.append(ratelimit.take(tokens, updated, now, rate, capacity, cost) + (cost,))
+        allowed = all(ok for ok, _, _, _ in taken)
+        for key, (ok, _, tokens, cost) in zip(keys, taken):
+            self.hashes[key] = (tokens + cost if ok and not allowed else tokens, now)
+        return [int(allowed), str(max(wait for _, wait, _, _ in taken))]
+
+
+class BrokenRedis:
+    """A stand-in for a Redis server that cannot be reached"""
+
+    def eval(self, *args):
+        raise ConnectionError("connection refused")
+
+
+######################################################################
+#  R A T E   L I M I T   T E S T   C A S E S
+######################################################################
+class TestRateLimit(TestCase):
+    """ Rate Limiting Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        cls.settings = {name: app.config.get(name) for name in SETTINGS}
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        db.drop_all()
+
+    def setUp(self):
+        """Runs before each test"""
+        reset_db()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config.update(self.settings)
+        ratelimit.init_ratelimit(app)
+
+    def _add_item(self, customer_id, product_id):
+        data = {"customer_id": customer_id, "product_id": product_id,
+                "name": "item", "quantity": 1, "price": 2.5}
+        return self.app.post("{}/{}/items".format(BASE_URL, customer_id), json=data,
+                             content_type="application/json")
+
+    def test_take(self):
+        """Refill a token bucket over time"""
+        self.assertEqual(ratelimit.take(2, 0, 0, 1, 2, 1), (True, 0.0, 1))
+        allowed, wait, tokens = ratelimit.take(0.5, 0, 0, 2, 2, 1)
+        self.assertFalse(allowed)
+        self.assertEqual(wait, 0.25)
+        self.assertEqual(ratelimit.take(0, 0, 10, 1, 2, 1), (True, 0.0, 1))
+
+    def test_memory_backend(self):
+        """Allow a burst and then reject until the bucket refills"""
+        backend = ratelimit.MemoryBackend(max_keys=2)
+        self.assertEqual([backend.consume("a", 0.001, 2)[0] for _ in range(3)], [True, True, False])
+        self.assertTrue(backend.consume("b", 1e9, 2)[0])
+        # a new key evicts the buckets that have refilled when the table is full
+        self.assertTrue(backend.consume("c", 0.001, 2)[0])
+        self.assertEqual(sorted(backend._buckets), ["a", "c"])  # pylint: disable=protected-access
+
+    def test_memory_backend_eviction(self):
+        """Evict the least recently used buckets instead of resetting every one"""
+        backend = ratelimit.MemoryBackend(max_keys=2)
+        self.assertEqual([backend.consume("a", 0.001, 2)[0] for _ in range(3)], [True, True, False])
+        self.assertTrue(backend.consume("b", 0.001, 2)[0])
+        self.assertFalse(backend.consume("a", 0.001, 2)[0])
+        # no bucket has refilled, "b" is the one used least recently
+        self.assertTrue(backend.consume("c", 0.001, 2)[0])
+        self.assertEqual(list(backend._buckets), ["a", "c"])  # pylint: disable=protected-access
+        self.assertFalse(backend.consume("a", 0.001, 2)[0])
+        self.assertTrue(backend.consume_all([("d", 0.001, 2, 1), ("e", 0.001, 2, 1)])[0])
+        self.assertEqual(list(backend._buckets), ["d", "e"])  # pylint: disable=protected-access
+
+    def test_customer_limit(self):
+        """Answer 429 when one customer sends too many requests"""
+        app.config.update(RATE_LIMIT_ENABLED=True, CUSTOMER_RATE_BURST=2)
+        ratelimit.init_ratelimit(app, ratelimit.MemoryBackend())
+        self.assertEqual(self._add_item(1, 1).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._add_item(1, 2).status_code, status.HTTP_201_CREATED)
+        resp = self._add_item(1, 3)
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+        self.assertEqual(resp.get_json()["status_code"], status.HTTP_429_TOO_MANY_REQUESTS)
+        # other customers are not affected
+        self.assertEqual(self._add_item(2, 1).status_code, status.HTTP_201_CREATED)
+
+    def test_list_cost(self):
+        """Charge more tokens for listing every cart"""
+        app.config.update(RATE_LIMIT_ENABLED=True, CLIENT_RATE_BURST=15)
+        ratelimit.init_ratelimit(app, ratelimit.MemoryBackend())
+        self.assertEqual(self.app.get(BASE_URL).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(BASE_URL).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.app.get("{}/1".format(BASE_URL)).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_shared_backend(self):
+        """Keep the buckets in a shared Redis backend"""
+        app.config.update(RATE_LIMIT_ENABLED=True, CUSTOMER_RATE_BURST=1)
+        client = LocalRedis()
+        ratelimit.init_ratelimit(app, ratelimit.RedisBackend(client))
+        self.assertEqual(self._add_item(1, 1).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._add_item(1, 2).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(client.calls, 2)
+        self.assertIn("shopcart:ratelimit:customer:1", client.hashes)
+
+    def test_both_buckets(self):
+        """Charge the client only when the customer bucket lets the request through"""
+        for backend in (ratelimit.MemoryBackend(), ratelimit.RedisBackend(LocalRedis())):
+            reset_db()
+            app.config.update(RATE_LIMIT_ENABLED=True, CLIENT_RATE_LIMIT=0.001, CLIENT_RATE_BURST=2,
+                              CUSTOMER_RATE_BURST=1)
+            ratelimit.init_ratelimit(app, backend)
+            self.assertEqual(self._add_item(1, 1).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self._add_item(1, 2).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(self._add_item(2, 1).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self._add_item(3, 1).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_trusted_proxy(self):
+        """Limit the client address a trusted proxy forwarded"""
+        app.config.update(RATE_LIMIT_ENABLED=True, CLIENT_RATE_LIMIT=0.001, CLIENT_RATE_BURST=1,
+                          TRUSTED_PROXY_HOPS=1)
+        ratelimit.init_ratelimit(app, ratelimit.MemoryBackend())
+        first = {"X-Forwarded-For": "203.0.113.1"}
+        self.assertEqual(self.app.get(BASE_URL + "/1", headers=first).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get(BASE_URL + "/1", headers=first)
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        resp = self.app.get(BASE_URL + "/1", headers={"X-Forwarded-For": "203.0.113.2"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        # without trusted proxies the header is ignored
+        app.config["TRUSTED_PROXY_HOPS"] = 0
+        ratelimit.init_ratelimit(app, ratelimit.MemoryBackend())
+        self.assertEqual(self.app.get(BASE_URL + "/1", headers=first).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get(BASE_URL + "/1", headers={"X-Forwarded-For": "203.0.113.2"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_backend_failure(self):
+        """Allow requests when the shared backend is down"""
+        app.config.update(RATE_LIMIT_ENABLED=True, CUSTOMER_RATE_BURST=1)
+        ratelimit.init_ratelimit(app, ratelimit.RedisBackend(BrokenRedis()))
+        self.assertEqual(self._add_item(1, 1).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._add_item(1, 2).status_code, status.HTTP_201_CREATED)
+
+    def test_load_shedding(self):
+        """Answer 503 when every request slot is taken"""
+        app.config.update(MAX_CONCURRENT_REQUESTS=1)
+        ratelimit.init_ratelimit(app)
+        limiter = app.extensions["ratelimit"]
+        self.assertTrue(limiter.admit())
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        limiter.release()
+        self.assertEqual(self.app.get(BASE_URL).status_code, status.HTTP_200_OK)
+        # the slot was given back after the request
+        self.assertEqual(self.app.get(BASE_URL).status_code, status.HTTP_200_OK)
@@ -0,0 +1,163 @@
+"""
+Test cases for Read Replica Routing
+"""
+import os
+import time
+import logging
+import tempfile
+from unittest import TestCase
+from service import status  # HTTP Status Codes
+from service import replicas
+from service.models import Cart, Product, ReplicaHeartbeat, ShopCart, db, product_cache
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+CONTENT_TYPE_JSON = "application/json"
+
+
+######################################################################
+#  R E P L I C A   T E S T   C A S E S
+######################################################################
+class TestReplicas(TestCase):
+    """ Read Replica Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        cls.tempdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        app.config["REPLICA_DATABASE_URIS"] = []
+        replicas.init_replicas(app, db)
+        cls.tempdir.cleanup()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.replica_uri = "sqlite:///" + os.path.join(self.tempdir.name, "replica.db")
+        app.config["REPLICA_DATABASE_URIS"] = [self.replica_uri]
+        app.config["REPLICA_STICKY_SECONDS"] = 60
+        replicas.init_replicas(app, db)
+        db.drop_all()
+        db.create_all()
+        product_cache.clear()
+        self.replica = db.get_engine(app, bind="replica_0")
+        db.Model.metadata.drop_all(bind=self.replica)
+        db.Model.metadata.create_all(bind=self.replica)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.Model.metadata.drop_all(bind=self.replica)
+        db.drop_all()
+
+    def _add_to_replica(self, customer_id, product_id, name):
+        with self.replica.begin() as conn:
+            conn.execute(ShopCart.__table__.insert(), {
+                "customer_id": customer_id, "product_id": product_id, "quantity": 1
+            })
+            conn.execute(Product.__table__.insert(), {"product_id": product_id, "name": name, "price": 1.0})
+            conn.execute(Cart.__table__.insert(), {
+                "customer_id": customer_id, "item_count": 1, "quantity_total": 1
+            })
+
+    def test_reads_use_replica(self):
+        """Send GET requests to the replica"""
+        self._add_to_replica(1, 1, "replica")
+        resp = self.app.get("{}/1".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]["name"], "replica")
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 1)
+
+    def test_read_your_writes(self):
+        """Read from the primary right after a write"""
+        self._add_to_replica(1, 1, "replica")
+        data = {"customer_id": 1, "product_id": 2, "name": "primary", "quantity": 1, "price": 1.0}
+        resp = self.app.post("{}/1/items".format(BASE_URL), json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn(replicas.STICKY_COOKIE, resp.headers.get("Set-Cookie"))
+        resp = self.app.get("{}/1".format(BASE_URL))
+        self.assertEqual([item["name"] for item in resp.get_json()], ["primary"])
+        # a fresh client without the cookie is still pinned by customer
+        resp = app.test_client().get("{}/1".format(BASE_URL))
+        self.assertEqual([item["name"] for item in resp.get_json()], ["primary"])
+        # other customers keep reading from the replica
+        resp = app.test_client().get("{}/1/items/1".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_fallback_to_primary(self):
+        """Read from the primary when no replica is healthy"""
+        app.config["REPLICA_DATABASE_URIS"] = ["sqlite:////nonexistent/directory/replica.db"]
+        replicas.init_replicas(app, db)
+        try:
+            ShopCart(customer_id=1, product_id=1, name="primary", quantity=1, price=1).create()
+            resp = self.app.get("{}/1".format(BASE_URL))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()[0]["name"], "primary")
+        finally:
+            app.config["REPLICA_DATABASE_URIS"] = [self.replica_uri]
+            replicas.init_replicas(app, db)
+
+    def test_lagging_replica(self):
+        """Skip a replica that lags too far behind"""
+        replica_set = app.extensions["replicas"]
+        replica_set.max_lag = -1
+        self.assertIsNone(replica_set.engine(app))
+
+    def test_replica_per_request(self):
+        """Read every query of a request from the same replica"""
+        second_uri = "sqlite:///" + os.path.join(self.tempdir.name, "second.db")
+        app.config["REPLICA_DATABASE_URIS"] = [self.replica_uri, second_uri]
+        replicas.init_replicas(app, db)
+        try:
+            for _ in range(2):
+                with app.test_request_context(BASE_URL, method="GET"):
+                    replicas._route_reads()  # pylint: disable=protected-access
+                    engine = replicas.engine_for(app, db.session)
+                    self.assertIsNotNone(engine)
+                    self.assertTrue(all(replicas.engine_for(app, db.session) is engine for _ in range(3)))
+                    replicas._reset_reads()  # pylint: disable=protected-access
+                    self.assertIsNone(replicas.engine_for(app, db.session))
+        finally:
+            app.config["REPLICA_DATABASE_URIS"] = [self.replica_uri]
+            replicas.init_replicas(app, db)
+
+    def test_sticky_customers_bounded(self):
+        """Forget the sticky customers that expired or are the oldest"""
+        replica_set = replicas.ReplicaSet(db, [self.replica_uri], max_lag=5, sticky_seconds=60,
+                                          health_interval=5, sticky_max=3)
+        for customer_id in range(1, 6):
+            replica_set.stick(customer_id)
+        self.assertEqual(list(replica_set._sticky), [3, 4, 5])  # pylint: disable=protected-access
+        self.assertFalse(replica_set.is_sticky(1))
+        self.assertTrue(replica_set.is_sticky(5))
+        replica_set.stick(3)
+        self.assertEqual(list(replica_set._sticky), [4, 5, 3])  # pylint: disable=protected-access
+        replica_set = replicas.ReplicaSet(db, [self.replica_uri], max_lag=5, sticky_seconds=0.01,
+                                          health_interval=5)
+        replica_set.stick(1)
+        time.sleep(0.02)
+        self.assertFalse(replica_set.is_sticky(1))
+        replica_set.stick(2)
+        self.assertEqual(list(replica_set._sticky), [2])  # pylint: disable=protected-access
+
+    def test_heartbeat(self):
+        """Only write a heartbeat for PostgreSQL primaries"""
+        replica_set = app.extensions["replicas"]
+        if DATABASE_URI.startswith("postgres"):
+            first = replica_set.heartbeat(app)
+            self.assertIsNone(first)
+            self.assertEqual(db.session.get(ReplicaHeartbeat, 1).id, 1)
+        else:
+            self.assertIsNone(replica_set.heartbeat(app))
+            self.assertEqual(ReplicaHeartbeat.query.count(), 0)
+        self.assertEqual(replica_set.lag(app, 0, None), 0.0)
@@ -5,17 +5,19 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
-from service import status  # HTTP Status Codes
-from service.models import db
+from service import executor, guards, status  # HTTP Status Codes
+from service.models import Cart, clear_carts, db, reset_db
 from service.routes import app, init_db
 from .factories import ShopCartFactory
 from config import DATABASE_URI
 
 BASE_URL = "/shopcarts"
 CONTENT_TYPE_JSON = "application/json"
+ADMIN_KEY = "secret"
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
@@ -35,34 +37,23 @@ class TestShopCart(TestCase):
     def tearDownClass(cls):
         """Run once after all tests"""
         db.session.close()
+        db.drop_all()
 
     def setUp(self):
         """Runs before each test"""
-        db.drop_all()  # clean up the last tests
-        db.create_all()  # create new tables
+        reset_db()  # clean up the last tests
+        app.config["ADMIN_API_KEY"] = ADMIN_KEY
         self.app = app.test_client()
+        # the administrative endpoints are disabled without a key
+        self.app.environ_base["HTTP_X_API_KEY"] = ADMIN_KEY
 
     def tearDown(self):
+        app.config["ADMIN_API_KEY"] = None
         db.session.remove()
-        db.drop_all()
 
     def _create_shopcarts(self, count):
         """Factory method to create shopcarts in bulk"""
-        shopcarts = []
-        for _ in range(count):
-            test_shopcart = ShopCartFactory()
-            resp = self.app.post(
-                f'{BASE_URL}/{test_shopcart.customer_id}/items', 
-                json=test_shopcart.serialize(), content_type=CONTENT_TYPE_JSON
-            )
-            self.assertEqual(
-                resp.status_code, status.HTTP_201_CREATED, "Could not create test shopcart"
-            )
-            new_shopcart = resp.get_json()
-            test_shopcart.customer_id = new_shopcart["customer_id"]
-            test_shopcart.product_id = new_shopcart["product_id"]
-            shopcarts.append(test_shopcart)
-        return shopcarts
+        return ShopCartFactory.seed(count)
 
     ######################################################################
     #  P L A C E   T E S T   C A S E S   H E R E
@@ -279,6 +270,79 @@ class TestShopCart(TestCase):
         resp = self.app.post(BASE_URL, json={}, content_type=CONTENT_TYPE_JSON)
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_get_shopcart_summary(self):
+        """Get the totals of a ShopCart"""
+        ShopCartFactory.seed(3, customer_id=7, quantity=2, price=1.25)
+        resp = self.app.get("{}/7/summary".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(),
+                         {"customer_id": 7, "item_count": 3, "quantity_total": 6, "subtotal": 7.5})
+        resp = self.app.delete("{}/7".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("{}/7/summary".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("{}/7".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_demand(self):
+        """Get the demand for a product"""
+        for customer_id in range(1, 4):
+            ShopCartFactory.seed(1, customer_id=customer_id, product_id=5, quantity=3)
+        resp = self.app.get("/products/5/demand")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"product_id": 5, "cart_count": 3, "quantity_total": 9})
+        resp = self.app.get("/products/6/demand")
+        self.assertEqual(resp.get_json(), {"product_id": 6, "cart_count": 0, "quantity_total": 0})
+
+    def test_update_product(self):
+        """Change a product in every ShopCart that does not override it"""
+        ShopCartFactory.seed(1, customer_id=1, product_id=5, name="item", price=1.0)
+        ShopCartFactory.seed(1, customer_id=2, product_id=5, name="item", price=2.0)
+        resp = self.app.get("/products/5")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"product_id": 5, "name": "item", "price": 1.0})
+        resp = self.app.put("/products/5", json={"name": "renamed", "price": 3.0})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"product_id": 5, "name": "renamed", "price": 3.0})
+        resp = self.app.get("{}/1/items/5".format(BASE_URL))
+        self.assertEqual((resp.get_json()["name"], resp.get_json()["price"]), ("renamed", 3.0))
+        resp = self.app.get("{}/2/items/5".format(BASE_URL))
+        self.assertEqual((resp.get_json()["name"], resp.get_json()["price"]), ("renamed", 2.0))
+        resp = self.app.put("/products/5", json={"name": "renamed"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["errors"], [{"field": "price", "message": "is missing"}])
+        resp = app.test_client().put("/products/5", json={"name": "free", "price": 0.0})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = self.app.get("/products/6")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_merge_shopcarts(self):
+        """Merge a guest ShopCart into a customer ShopCart"""
+        ShopCartFactory.seed(1, customer_id=1, product_id=1, quantity=2)
+        ShopCartFactory.seed(1, customer_id=9, product_id=1, quantity=5)
+        ShopCartFactory.seed(1, customer_id=9, product_id=2, quantity=1)
+        resp = self.app.put("{}/1/merge?source=9&policy=max".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([(item["product_id"], item["quantity"]) for item in resp.get_json()], [(1, 5), (2, 1)])
+        resp = self.app.get("{}/9".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put("{}/1/merge?source=9&policy=min".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("{}/1/merge".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("{}/1/merge?source=1".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_shopcart_bad_data(self):
+        """Create a ShopCart with invalid fields"""
+        resp = self.app.post(
+            "{}/1/items".format(BASE_URL), content_type=CONTENT_TYPE_JSON,
+            json={"customer_id": 1, "product_id": "x", "name": "item", "price": 1.5}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        fields = [error["field"] for error in resp.get_json()["errors"]]
+        self.assertEqual(fields, ["product_id", "quantity"])
+
     def test_create_shopcart_no_content_type(self):
         """Create a ShopCart with no content type"""
         resp = self.app.post(BASE_URL)
@@ -336,4 +400,177 @@ class TestShopCart(TestCase):
         self.assertEqual(len(data), len(product_id_shopcarts))
         # check the data just to be sure
         for shopcart in data:
-            self.assertEqual(shopcart["product_id"], test_product_id)
\ No newline at end of file
+            self.assertEqual(shopcart["product_id"], test_product_id)
+
+    def test_export_shopcarts(self):
+        """Export all ShopCarts as CSV and NDJSON"""
+        self._create_shopcarts(3)
+        resp = self.app.get("/admin/shopcarts/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 4)
+        resp = self.app.get("/admin/shopcarts/export", query_string="format=ndjson")
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 3)
+        resp = self.app.get("/admin/shopcarts/export", query_string="format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_shopcarts(self):
+        """Import ShopCarts from an NDJSON body"""
+        body = "".join(
+            json.dumps(ShopCartFactory().serialize()) + "\n" for _ in range(3)
+        )
+        resp = self.app.post("/admin/shopcarts/import", data=body, content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["imported"], 3)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.app.post("/admin/shopcarts/import", data="x", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.post("/admin/shopcarts/import", data="{}\n", content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reset_shopcarts(self):
+        """Delete every ShopCart in one call"""
+        ShopCartFactory.seed(5)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 5)
+        resp = self.app.delete("/admin/shopcarts")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_admin_api_key(self):
+        """Require the X-Api-Key header when an admin key is configured"""
+        client = app.test_client()
+        resp = client.get("/admin/shopcarts/export")
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = client.get("/admin/shopcarts/export", headers={"X-Api-Key": "wrong"})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = client.get("/admin/shopcarts/export", headers={"X-Api-Key": ADMIN_KEY})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_admin_routes_without_key(self):
+        """Refuse every administrative route without a valid admin key"""
+        ShopCartFactory.seed(2)
+        body = json.dumps(ShopCartFactory().serialize()) + "\n"
+        calls = [
+            ("get", "/admin/shopcarts/export", {}),
+            ("post", "/admin/shopcarts/import", {"data": body, "content_type": "application/x-ndjson"}),
+            ("get", "/admin/shopcarts/events", {}),
+            ("get", "/admin/shopcarts/events/stream", {}),
+            ("post", "/admin/shopcarts/clear", {"json": {"customer_ids": [1, 2]}}),
+            ("post", "/admin/shopcarts/rebuild", {"json": {"customer_ids": [1, 2]}}),
+            ("put", "/products/1", {"json": {"name": "item", "price": 1.0}}),
+        ]
+        client = app.test_client()
+        for method, url, options in calls:
+            resp = getattr(client, method)(url, headers={"X-Api-Key": "wrong"}, **options)
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED, url)
+        app.config["ADMIN_API_KEY"] = None
+        for method, url, options in calls:
+            for headers in ({}, {"X-Api-Key": ""}, {"X-Api-Key": ADMIN_KEY}):
+                resp = getattr(client, method)(url, headers=headers, **options)
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND, url)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+
+    def test_reset_without_admin_key(self):
+        """Refuse to reset the database when no admin key is configured"""
+        ShopCartFactory.seed(2)
+        app.config["ADMIN_API_KEY"] = None
+        for headers in ({}, {"X-Api-Key": ""}, {"X-Api-Key": ADMIN_KEY}):
+            resp = app.test_client().delete("/admin/shopcarts", headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+
+    def test_reset_outside_of_tests(self):
+        """Refuse to reset the database unless TESTING is set"""
+        ShopCartFactory.seed(2)
+        app.config["TESTING"] = False
+        try:
+            resp = self.app.delete("/admin/shopcarts")
+        finally:
+            app.config["TESTING"] = True
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+
+
+    def test_list_guards(self):
+        """Refuse lists that cost too much and page through them instead"""
+        shopcarts = ShopCartFactory.seed(5)
+        app.config.update(LIST_MAX_ROWS=3, LIST_MAX_SCAN_ROWS=4)
+        try:
+            resp = self.app.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("limit and after", resp.get_json()["message"])
+            resp = self.app.get(BASE_URL, query_string={"product_id": shopcarts[0].product_id})
+            self.assertEqual(len(resp.get_json()), 1)
+            app.config["LIST_MAX_SCAN_ROWS"] = 0
+            resp = self.app.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("more than 3", resp.get_json()["message"])
+            pages, url = [], BASE_URL + "?limit=2"
+            while url:
+                resp = self.app.get(url)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                pages.append([item["customer_id"] for item in resp.get_json()])
+                url = resp.headers.get("Link", "<>").split(">")[0][1:]
+            expected = sorted(shopcart.customer_id for shopcart in shopcarts)
+            self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+            for query in ("limit=0", "limit=4", "after=x", "quantity=abc", "price=cheap"):
+                resp = self.app.get(BASE_URL + "?" + query)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        finally:
+            app.config.update(LIST_MAX_ROWS=10000, LIST_MAX_SCAN_ROWS=100000)
+
+    def test_statement_timeout(self):
+        """Cancel a statement that runs longer than the timeout"""
+        connection = db.session.connection()
+        slow = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+        with self.assertRaises(guards.QueryTooExpensive):
+            with guards.statement_timeout(connection, 50):
+                connection.exec_driver_sql(slow)
+        db.session.rollback()
+        connection = db.session.connection()
+        with guards.statement_timeout(connection, 1000):
+            self.assertEqual(connection.exec_driver_sql("SELECT 1").scalar(), 1)
+
+    def test_fan_out_operations(self):
+        """Clear and rebuild the ShopCarts of many customers in chunks"""
+        shopcarts = ShopCartFactory.seed(6)
+        app.config.update(FANOUT_WORKERS=2, FANOUT_CHUNK_SIZE=2)
+        try:
+            cleared = [shopcart.customer_id for shopcart in shopcarts[:3]]
+            resp = self.app.post("/admin/shopcarts/clear", json={"customer_ids": cleared})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            report = resp.get_json()
+            self.assertEqual((report["customers"], report["rows"], report["errors"]), (3, 3, 0))
+            self.assertEqual([chunk["customers"] for chunk in report["chunks"]], [2, 1])
+            self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+            db.session.execute(Cart.__table__.delete())
+            db.session.commit()
+            resp = self.app.post("/admin/shopcarts/rebuild")
+            self.assertEqual(resp.get_json()["customers"], 3)
+            self.assertEqual(Cart.check(), [])
+            for body in ({}, {"customer_ids": "1"}, {"customer_ids": [1, "x"]}):
+                resp = self.app.post("/admin/shopcarts/clear", json=body)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config.update(FANOUT_WORKERS=4, FANOUT_CHUNK_SIZE=100)
+
+    def test_fan_out_errors(self):
+        """Keep the chunks that succeed when another one fails"""
+        shopcarts = ShopCartFactory.seed(4)
+        def clear_or_fail(session, customer_ids):
+            if shopcarts[0].customer_id in customer_ids:
+                raise ValueError("boom")
+            return clear_carts(session, customer_ids)
+        results = []
+        report = executor.FanOutExecutor(app, workers=2, chunk_size=1).run(
+            "clear", clear_or_fail, [shopcart.customer_id for shopcart in shopcarts], results.append
+        )
+        self.assertEqual((report["rows"], report["errors"]), (3, 1))
+        self.assertEqual(report["chunks"][0]["error"], "boom")
+        self.assertEqual(len(results), 4)
+        self.assertEqual([item["customer_id"] for item in self.app.get(BASE_URL).get_json()],
+                         [shopcarts[0].customer_id])
@@ -0,0 +1,134 @@
+"""
+Test cases for Sharding and Partitioning
+"""
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from sqlalchemy import Column, Integer, MetaData, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+from service import status  # HTTP Status Codes
+from service import sharding
+from service.models import ShopCart, db
+from service.routes import app, init_db
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+CONTENT_TYPE_JSON = "application/json"
+
+
+######################################################################
+#  S H A R D I N G   T E S T   C A S E S
+######################################################################
+class TestSharding(TestCase):
+    """ Sharding Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+        cls.tempdir = tempfile.TemporaryDirectory()
+        app.config["SHARD_DATABASE_URIS"] = [
+            "sqlite:///" + os.path.join(cls.tempdir.name, "shard{}.db".format(index))
+            for index in range(2)
+        ]
+        sharding.init_sharding(app, db)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+        app.config["SHARD_DATABASE_URIS"] = []
+        sharding.init_sharding(app, db)
+        cls.tempdir.cleanup()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.drop_all()
+        db.create_all()
+        sharding.drop_all(app, db)
+        sharding.create_all(app, db)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        sharding.drop_all(app, db)
+        db.drop_all()
+
+    def _shard_rows(self, index):
+        engine = app.extensions["sharding"].engine(app, index)
+        with engine.connect() as conn:
+            return conn.execute(ShopCart.__table__.select()).fetchall()
+
+    def _add_item(self, customer_id, product_id):
+        data = {"customer_id": customer_id, "product_id": product_id,
+                "name": "item", "quantity": 1, "price": 2.5}
+        resp = self.app.post(
+            "{}/{}/items".format(BASE_URL, customer_id), json=data, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_routes_write_to_one_shard(self):
+        """Store each cart on the shard that owns the customer"""
+        self._add_item(2, 1)
+        self._add_item(2, 2)
+        self._add_item(3, 1)
+        self.assertEqual(sorted((row.customer_id, row.product_id) for row in self._shard_rows(0)),
+                         [(2, 1), (2, 2)])
+        self.assertEqual([(row.customer_id, row.product_id) for row in self._shard_rows(1)], [(3, 1)])
+        resp = self.app.get("{}/3".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.delete("{}/2".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._shard_rows(0), [])
+        self.assertEqual(len(self._shard_rows(1)), 1)
+
+    def test_list_fans_out(self):
+        """List the carts of every shard"""
+        for customer_id in range(4):
+            self._add_item(customer_id, 7)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(item["customer_id"] for item in resp.get_json()), [0, 1, 2, 3])
+        resp = self.app.get(BASE_URL, query_string="product_id=7")
+        self.assertEqual(len(resp.get_json()), 4)
+
+    def test_shard_for(self):
+        """Route model calls with shard_for()"""
+        with sharding.shard_for(5):
+            ShopCart(customer_id=5, product_id=1, name="item", quantity=1, price=1).create()
+            self.assertEqual(ShopCart.find_by_customer_id(5).count(), 1)
+        self.assertEqual(len(self._shard_rows(1)), 1)
+        self.assertRaises(sharding.ShardRoutingError, ShopCart.all)
+
+    def test_hash_partitions(self):
+        """Declare hash partitions for PostgreSQL"""
+        table = Table("partitioned", MetaData(),
+                      Column("customer_id", Integer, primary_key=True),
+                      Column("product_id", Integer, primary_key=True))
+        sharding.configure_partitions(table, 4)
+        ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        self.assertIn("PARTITION BY HASH (customer_id)", ddl)
+
+    def test_partitioned_models(self):
+        """Partition only the models keyed by customer_id"""
+        app.config["SHOPCART_PARTITIONS"] = 4
+        try:
+            sharding.init_sharding(app, db)
+        finally:
+            app.config["SHOPCART_PARTITIONS"] = 0
+        partitioned = []
+        for table in sharding.sharded_tables(db):
+            ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+            if "PARTITION BY HASH (customer_id)" in ddl:
+                partitioned.append(table.name)
+                self.assertIn("customer_id", table.primary_key.columns)
+        self.assertEqual(sorted(partitioned), ["cart", "shop_cart"])
+        table = Table("events", MetaData(), Column("id", Integer, primary_key=True), Column("customer_id", Integer))
+        self.assertRaises(ValueError, sharding.configure_partitions, table, 4)
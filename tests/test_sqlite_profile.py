@@ -0,0 +1,99 @@
+"""
+Test cases for the SQLite Profile
+"""
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+from service import sqlite_profile
+
+
+######################################################################
+#  S Q L I T E   P R O F I L E   T E S T   C A S E S
+######################################################################
+class TestSqliteProfile(TestCase):
+    """ SQLite Profile Tests """
+
+    def setUp(self):
+        """Runs before each test"""
+        self.saved_pragmas = dict(sqlite_profile.PRAGMAS)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.uri = "sqlite:///" + os.path.join(self.tempdir.name, "profile.db")
+
+    def tearDown(self):
+        sqlite_profile.PRAGMAS.clear()
+        sqlite_profile.PRAGMAS.update(self.saved_pragmas)
+        self.tempdir.cleanup()
+
+    def test_detect_sqlite(self):
+        """Detect SQLite and in-memory URIs"""
+        self.assertTrue(sqlite_profile.is_sqlite(self.uri))
+        self.assertFalse(sqlite_profile.is_sqlite("postgresql://postgres@localhost/postgres"))
+        self.assertFalse(sqlite_profile.is_sqlite(None))
+        self.assertTrue(sqlite_profile.is_memory("sqlite://"))
+        self.assertFalse(sqlite_profile.is_memory(self.uri))
+
+    def test_engine_options(self):
+        """Pool file connections across threads and share one in memory"""
+        options = sqlite_profile.engine_options({"SQLALCHEMY_DATABASE_URI": self.uri})
+        self.assertIs(options["poolclass"], QueuePool)
+        self.assertEqual(options["pool_size"], 8)
+        self.assertEqual(options["connect_args"]["timeout"], 5.0)
+        self.assertFalse(options["connect_args"]["check_same_thread"])
+        options = sqlite_profile.engine_options({"SQLALCHEMY_DATABASE_URI": self.uri, "SQLITE_POOL_SIZE": 0})
+        self.assertIs(options["poolclass"], NullPool)
+        options = sqlite_profile.engine_options({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+        self.assertIs(options["poolclass"], StaticPool)
+
+    def test_pragmas_applied(self):
+        """Apply WAL, synchronous and the busy timeout to new connections"""
+        sqlite_profile.PRAGMAS.clear()
+        sqlite_profile.PRAGMAS.update(sqlite_profile.pragmas({"SQLITE_BUSY_TIMEOUT": 1234}))
+        engine = create_engine(self.uri, **sqlite_profile.engine_options({"SQLALCHEMY_DATABASE_URI": self.uri}))
+        try:
+            with engine.connect() as conn:
+                self.assertEqual(conn.execute(text("PRAGMA journal_mode")).scalar(), "wal")
+                self.assertEqual(conn.execute(text("PRAGMA synchronous")).scalar(), 1)
+                self.assertEqual(conn.execute(text("PRAGMA busy_timeout")).scalar(), 1234)
+        finally:
+            engine.dispose()
+
+    def test_threads_share_pool(self):
+        """Hand the pooled connections to other threads without errors"""
+        config = {"SQLALCHEMY_DATABASE_URI": self.uri, "SQLITE_POOL_SIZE": 2}
+        engine = create_engine(self.uri, **sqlite_profile.engine_options(config))
+        errors = []
+
+        def work():
+            try:
+                for _ in range(20):
+                    with engine.begin() as conn:
+                        conn.execute(text("INSERT INTO hits VALUES (1)"))
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE TABLE hits (n INTEGER)"))
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertLessEqual(engine.pool.checkedin(), 2)
+            with engine.connect() as conn:
+                self.assertEqual(conn.execute(text("SELECT count(*) FROM hits")).scalar(), 80)
+        finally:
+            engine.dispose()
+
+    def test_default_profile(self):
+        """Leave the driver defaults alone for the default profile"""
+        class FakeApp:  # pylint: disable=too-few-public-methods
+            """ Stands in for the Flask app config """
+            config = {"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLITE_PROFILE": "default"}
+        sqlite_profile.configure(FakeApp)
+        self.assertEqual(sqlite_profile.PRAGMAS, {})
+        self.assertNotIn("SQLALCHEMY_ENGINE_OPTIONS", FakeApp.config)
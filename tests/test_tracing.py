@@ -0,0 +1,128 @@
+"""
+Test cases for Request Tracing
+"""
+import os
+import json
+import logging
+import tempfile
+from unittest import TestCase
+from service import status  # HTTP Status Codes
+from service import tracing
+from service.models import db
+from service.routes import app, init_db
+from .factories import ShopCartFactory
+from config import DATABASE_URI
+
+BASE_URL = "/shopcarts"
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+######################################################################
+#  T R A C I N G   T E S T   C A S E S
+######################################################################
+class TestTracing(TestCase):
+    """ Tracing Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        app.config["TRACING_ENABLED"] = False
+        tracing.init_tracing(app)
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.drop_all()
+        db.create_all()
+        app.config["TRACING_ENABLED"] = True
+        app.config["TRACE_EXPORTER"] = "memory"
+        app.config["TRACE_SAMPLE_RATE"] = 1.0
+        tracing.init_tracing(app)
+        self.exporter = tracing.tracer.exporter
+        self.app = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_parse_traceparent(self):
+        """Parse valid and invalid traceparent headers"""
+        trace_id, parent_id, sampled = tracing.parse_traceparent(TRACEPARENT)
+        self.assertEqual(trace_id, "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(parent_id, "b7ad6b7169203331")
+        self.assertTrue(sampled)
+        self.assertIsNone(tracing.parse_traceparent(None))
+        self.assertIsNone(tracing.parse_traceparent("not-a-header"))
+        self.assertIsNone(tracing.parse_traceparent("00-" + "0" * 32 + "-b7ad6b7169203331-01"))
+
+    def test_request_spans(self):
+        """Record spans for the route, the model and SQL"""
+        shopcart = ShopCartFactory()
+        resp = self.app.post(
+            "{}/{}/items".format(BASE_URL, shopcart.customer_id),
+            json=shopcart.serialize(), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        names = [span.name for span in self.exporter.spans]
+        self.assertIn("POST /shopcarts/<int:customer_id>/items", names)
+        self.assertIn("ShopCart.find", names)
+        self.assertIn("ShopCart.create", names)
+        self.assertIn("orm.flush", names)
+        self.assertIn("db.statement", names)
+        root = self.exporter.spans[-1]
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(root.attributes["http.status_code"], status.HTTP_201_CREATED)
+        for span in self.exporter.spans:
+            self.assertEqual(span.trace_id, root.trace_id)
+        self.assertEqual(resp.headers["traceparent"], root.traceparent)
+
+    def test_traceparent_propagation(self):
+        """Continue a trace from an incoming traceparent header"""
+        resp = self.app.get(BASE_URL, headers={"traceparent": TRACEPARENT})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        root = self.exporter.spans[-1]
+        self.assertEqual(root.trace_id, "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(root.parent_id, "b7ad6b7169203331")
+        self.assertTrue(resp.headers["traceparent"].startswith("00-0af7651916cd43dd8448eb211c80319c-"))
+
+    def test_unsampled_trace(self):
+        """Do not export spans for unsampled traces"""
+        app.config["TRACE_SAMPLE_RATE"] = 0.0
+        tracing.init_tracing(app)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(self.exporter.spans), [])
+        self.assertNotIn("traceparent", resp.headers)
+
+    def test_memory_exporter_bound(self):
+        """Keep only the newest spans in memory"""
+        tracer = tracing.Tracer(tracing.InMemoryExporter(max_spans=3))
+        for index in range(5):
+            tracer.start_trace("span {}".format(index)).finish()
+        self.assertEqual([span.name for span in tracer.exporter.spans], ["span 2", "span 3", "span 4"])
+
+    def test_file_exporter(self):
+        """Write finished spans to a file"""
+        handle, path = tempfile.mkstemp(suffix=".ndjson")
+        os.close(handle)
+        try:
+            tracer = tracing.Tracer(tracing.FileExporter(path))
+            root = tracer.start_trace("test")
+            root.set_attribute("key", "value")
+            root.finish()
+            with open(path, encoding="utf-8") as trace_file:
+                data = json.loads(trace_file.readline())
+            self.assertEqual(data["name"], "test")
+            self.assertEqual(data["attributes"], {"key": "value"})
+            self.assertGreaterEqual(data["duration_ms"], 0)
+        finally:
+            os.remove(path)
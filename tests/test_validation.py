@@ -0,0 +1,55 @@
+"""
+Test cases for Payload Validation
+"""
+from unittest import TestCase
+from service import validation
+
+PAYLOAD = {"customer_id": 1, "product_id": 2, "name": "item", "quantity": 3, "price": 4.5}
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(TestCase):
+    """ Payload Validator Tests """
+
+    def test_valid_payload(self):
+        """Convert a valid payload"""
+        values, errors = validation.shopcart.validate(PAYLOAD)
+        self.assertEqual(errors, [])
+        self.assertEqual(values, PAYLOAD)
+        self.assertIsInstance(values["price"], float)
+
+    def test_string_values(self):
+        """Convert the string values of CSV rows"""
+        values, errors = validation.shopcart.validate(
+            {"customer_id": "1", "product_id": " -2 ", "name": "item", "quantity": "3", "price": "4.5e1"}
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(values["product_id"], -2)
+        self.assertEqual(values["price"], 45.0)
+
+    def test_invalid_payload(self):
+        """Report every invalid field"""
+        values, errors = validation.shopcart.validate(
+            {"customer_id": "one", "product_id": 2.5, "name": 7, "price": "nan"}
+        )
+        self.assertEqual(
+            errors,
+            [
+                {"field": "customer_id", "message": "must be an integer"},
+                {"field": "product_id", "message": "must be an integer"},
+                {"field": "name", "message": "must be a string"},
+                {"field": "quantity", "message": "is missing"},
+                {"field": "price", "message": "must be a number"},
+            ],
+        )
+        self.assertEqual(values, {})
+        self.assertIn("quantity is missing", validation.describe(errors))
+
+    def test_not_a_dictionary(self):
+        """Reject a body that is not an object"""
+        values, errors = validation.shopcart.validate(["not", "a", "dict"])
+        self.assertIsNone(values)
+        self.assertIsNone(errors[0]["field"])
+        self.assertEqual(validation.shopcart.validate(None)[1], errors)